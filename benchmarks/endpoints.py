@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""
+Measure the latency of the main API endpoints.
+
+Run it with ``python manage.py bench`` or ``python -m benchmarks.endpoints``.
+The API is served in process with the testing configuration: an in-memory
+database, Celery tasks run eagerly and the simulated salt master, so no salt
+installation nor Redis is needed. Each scenario is run ``--requests`` times
+and reported with its throughput and latency percentiles.
+
+``--output`` writes the results as json, ``--compare`` prints the change
+from a previous json file, to compare two versions of the API.
+"""
+from __future__ import print_function
+
+import argparse
+import base64
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+import logging
+import math
+import time
+import uuid
+
+from benchmarks.wsproxy_base64 import relay, vnc_reads
+
+PERCENTILES = (50, 95, 99)
+
+# Methods of Bench, run in this order
+SCENARIOS = ('tokens', 'minions', 'ping', 'ping_list', 'tasks', 'acls',
+             'status', 'wsproxy')
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def summarize(name, latencies, errors, seconds):
+    """Return the statistics of a scenario."""
+    values = sorted(latencies)
+    result = {'name': name,
+              'requests': len(values),
+              'errors': errors,
+              'seconds': seconds,
+              'throughput': len(values) / seconds if seconds else 0.0,
+              'mean_ms': sum(values) / len(values) * 1000 if values else 0.0}
+    for percent in PERCENTILES:
+        result['p{0}_ms'.format(percent)] = percentile(values, percent) * 1000
+    return result
+
+
+class Bench(object):
+    """
+    Client of the API, with one method per scenario.
+
+    A scenario method runs one iteration and returns the number of requests
+    that did not get the expected status.
+    """
+
+    def __init__(self, minions=1000, latency=0.0):
+        """Create the app, its database and a user."""
+        # Eager Celery tasks load the auxiliary app with the same config,
+        # load it first so that ours decides of the salt backend
+        os.environ['PROJETY_CONFIG'] = 'testing'
+        os.environ.setdefault('SALT_BACKEND', 'simulated')
+        import projety.wsgi_aux  # noqa
+        from projety import celery, create_app, db, salt
+        from projety.models import Acl, Role, User
+
+        self.app = create_app('testing')
+        logging.disable(logging.INFO)
+        # Task states are kept in memory instead of Redis
+        celery.conf.update(CELERY_RESULT_BACKEND='cache+memory://')
+        self.app.config['SALT_SIMULATED_MINIONS'] = minions
+        self.app.config['SALT_SIMULATED_LATENCY'] = latency
+        self.app.config['SALT_SIMULATED_DISTRIBUTION'] = 'constant'
+        salt.init_app(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+
+        db.app = self.app
+        db.drop_all()
+        db.create_all()
+        user = User(nickname='bench', password='bench')
+        db.session.add(user)
+        db.session.commit()
+        db.session.add_all([Acl(minions='.*', functions='.*',
+                                user_id=user.id),
+                            Role(name='admin', user_id=user.id)])
+        db.session.commit()
+        self.user_id = user.id
+
+        self.client = self.app.test_client()
+        self.minions = salt.get_minions()
+        self.token = self.request('POST', '/api/v1.0/tokens', 200,
+                                  basic=True)[1]['token']
+        self.reads = None
+
+    def request(self, method, url, status, data=None, basic=False):
+        """Return (errors, json body, response) of a request."""
+        headers = {'Accept': 'application/json',
+                   'Content-Type': 'application/json'}
+        if basic:
+            headers['Authorization'] = 'Basic ' + base64.b64encode(
+                b'bench:bench').decode('utf-8')
+        else:
+            headers['Authorization'] = 'Bearer ' + self.token
+        response = self.client.open(url, method=method, headers=headers,
+                                    data=json.dumps(data) if data else None)
+        body = None
+        if response.data and \
+                response.headers.get('Content-Type') == 'application/json':
+            body = json.loads(response.data.decode('utf-8'))
+        return int(response.status_code != status), body, response
+
+    def minion(self):
+        """Return a random minion."""
+        return random.choice(self.minions)
+
+    def scenario_tokens(self):
+        """Get a token with a password."""
+        return self.request('POST', '/api/v1.0/tokens', 200, basic=True)[0]
+
+    def scenario_minions(self):
+        """List the minions."""
+        return self.request('GET', '/api/v1.0/minions', 200)[0]
+
+    def scenario_ping(self):
+        """Ping a minion."""
+        return self.request('POST', '/api/v1.0/ping/{0}'.format(
+            self.minion()), 200)[0]
+
+    def scenario_ping_list(self):
+        """Ping 50 minions at once."""
+        targets = random.sample(self.minions, min(50, len(self.minions)))
+        return self.request('POST', '/api/v1.0/ping', 200,
+                            {'target': targets})[0]
+
+    def scenario_tasks(self):
+        """List the functions of a minion, then run one."""
+        minion = self.minion()
+        url = '/api/v1.0/minions/{0}/tasks'.format(minion)
+        errors = self.request('GET', url, 200)[0]
+        return errors + self.request('POST', url + '/test.ping', 200,
+                                     {'async': 'sync'})[0]
+
+    def scenario_acls(self):
+        """Create, read, update and delete an ACL."""
+        url = '/api/v1.0/users/{0}/acls'.format(self.user_id)
+        errors, body, response = self.request(
+            'POST', url, 200, {'minions': self.minion(),
+                               'functions': 'test.ping'})
+        if errors:
+            return errors
+        acl_url = '{0}/{1}'.format(url, body['id'])
+        return errors + \
+            self.request('GET', acl_url, 200)[0] + \
+            self.request('PUT', acl_url, 200, {'functions': 'test.*'})[0] + \
+            self.request('DELETE', acl_url, 200)[0]
+
+    def scenario_status(self):
+        """Start an asynchronous ping, then poll a pending task."""
+        # Eager tasks answer at once, the poll gets a task still pending
+        errors = self.request('POST', '/api/v1.0/tasks/ping/{0}'.format(
+            self.minion()), 200)[0]
+        url = '/api/v1.0/tasks/status/{0}'.format(uuid.uuid4())
+        return errors + self.request('GET', url, 202)[0]
+
+    def scenario_wsproxy(self):
+        """Relay 4MB of VNC updates to a websocket, in base64."""
+        if self.reads is None:
+            self.reads = vnc_reads(4 * 1024 * 1024)
+        relay('base64', self.reads, 8)
+        return 0
+
+    def run(self, name, requests, warmup=5):
+        """Run a scenario and return its statistics."""
+        scenario = getattr(self, 'scenario_' + name)
+        for i in range(warmup):
+            scenario()
+        latencies = []
+        errors = 0
+        started = time.time()
+        for i in range(requests):
+            start = time.time()
+            errors += scenario()
+            latencies.append(time.time() - start)
+        return summarize(name, latencies, errors, time.time() - started)
+
+
+def compare(results, previous):
+    """Return lines comparing results with a previous run."""
+    before = dict((r['name'], r) for r in previous['results'])
+    lines = []
+    for result in results:
+        old = before.get(result['name'])
+        if old is None:
+            continue
+        changes = []
+        for key in ['throughput'] + ['p{0}_ms'.format(p)
+                                     for p in PERCENTILES]:
+            if old[key]:
+                changes.append('{0} {1:+.1f}%'.format(
+                    key, (result[key] - old[key]) / old[key] * 100))
+        lines.append('{0:<12} {1}'.format(result['name'], ', '.join(changes)))
+    return lines
+
+
+def main(argv=None):
+    """Run the scenarios and print the results as a table."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-n', '--requests', type=int, default=200,
+                        help='iterations of each scenario')
+    parser.add_argument('-s', '--scenario', action='append',
+                        choices=SCENARIOS,
+                        help='scenario to run, all by default')
+    parser.add_argument('--minions', type=int, default=1000,
+                        help='minions of the simulated salt master')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the simulated minions take to answer')
+    parser.add_argument('-o', '--output', help='write the results as json')
+    parser.add_argument('-c', '--compare', help='json of a previous run')
+    args = parser.parse_args(argv)
+
+    random.seed(42)
+    bench = Bench(minions=args.minions, latency=args.latency)
+    results = []
+    print('{0:<12} {1:>8} {2:>6} {3:>10} {4:>9} {5:>9} {6:>9}'.format(
+        'scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+        'p99 ms'))
+    for name in args.scenario or SCENARIOS:
+        result = bench.run(name, args.requests)
+        results.append(result)
+        print('{name:<12} {requests:>8} {errors:>6} {throughput:>10.1f} '
+              '{p50_ms:>9.2f} {p95_ms:>9.2f} {p99_ms:>9.2f}'.format(**result))
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        print('\nChanges from {0}:'.format(args.compare))
+        for line in compare(results, previous):
+            print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'date': datetime.datetime.utcnow().isoformat(),
+                       'python': platform.python_version(),
+                       'minions': args.minions,
+                       'latency': args.latency,
+                       'requests': args.requests,
+                       'results': results}, f, indent=2, sort_keys=True)
+    return int(any(result['errors'] for result in results))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+Compare the json backends on realistic salt payloads.
+
+Run it with ``python -m benchmarks.json_backends``, every installed backend
+is timed on encoding and decoding each payload.
+"""
+from __future__ import print_function
+
+import random
+import string
+import timeit
+
+from projety.json_backend import BACKENDS, JsonBackend
+
+
+def _word(length=8):
+    return ''.join(random.choice(string.ascii_lowercase)
+                   for i in range(length))
+
+
+def _minions(count):
+    return ['minion-{0:05d}.example.com'.format(i) for i in range(count)]
+
+
+def ping_payload(count=5000):
+    """Return a test.ping on a big fleet."""
+    return dict((minion, random.random() > 0.05)
+                for minion in _minions(count))
+
+
+def grains_payload(count=500):
+    """Return a grains.items on a medium fleet."""
+    result = {}
+    for minion in _minions(count):
+        result[minion] = {
+            'id': minion,
+            'os': 'Debian',
+            'osrelease': '8.6',
+            'kernelrelease': '3.16.0-4-amd64',
+            'num_cpus': random.randint(1, 32),
+            'mem_total': random.randint(512, 65536),
+            'ipv4': ['10.0.{0}.{1}'.format(random.randint(0, 255),
+                                           random.randint(0, 255))
+                     for i in range(3)],
+            'fqdn_ip4': ['192.168.1.{0}'.format(random.randint(0, 255))],
+            'saltversion': '2016.11.5',
+            'master': 'salt.example.com',
+        }
+    return result
+
+
+def pkg_payload(count=100, packages=800):
+    """Return a pkg.list_pkgs on a small fleet."""
+    names = [_word() for i in range(packages)]
+
+    def version():
+        return '{0}.{1}-{2}'.format(random.randint(0, 9),
+                                    random.randint(0, 99),
+                                    random.randint(0, 9))
+    return dict((minion, dict((name, version()) for name in names))
+                for minion in _minions(count))
+
+
+def cmd_payload(count=50, lines=2000):
+    """Return a cmd.run with big outputs."""
+    return dict((minion,
+                 '\n'.join(' '.join(_word() for i in range(10))
+                           for line in range(lines)))
+                for minion in _minions(count))
+
+
+PAYLOADS = [
+    ('test.ping', ping_payload),
+    ('grains.items', grains_payload),
+    ('pkg.list_pkgs', pkg_payload),
+    ('cmd.run', cmd_payload),
+]
+
+
+def installed_backends():
+    """Return the list of backends that can be imported."""
+    backends = []
+    for name in BACKENDS:
+        try:
+            backends.append(JsonBackend(name))
+        except ImportError:
+            pass
+    return backends
+
+
+def run(number=10):
+    """Return a list of (payload, backend, operation, seconds per call)."""
+    random.seed(42)
+    results = []
+    for payload_name, factory in PAYLOADS:
+        payload = factory()
+        for backend in installed_backends():
+            encoded = backend.dumps(payload)
+            dumps = timeit.timeit(lambda: backend.dumps(payload),
+                                  number=number)
+            loads = timeit.timeit(lambda: backend.loads(encoded),
+                                  number=number)
+            results.append((payload_name, backend.name, 'dumps',
+                            dumps / number))
+            results.append((payload_name, backend.name, 'loads',
+                            loads / number))
+    return results
+
+
+def main():
+    """Print the results as a table."""
+    print('{0:<15} {1:<10} {2:<6} {3:>10}'.format('payload', 'backend',
+                                                  'op', 'ms/call'))
+    for payload, backend, operation, seconds in run():
+        print('{0:<15} {1:<10} {2:<6} {3:>10.2f}'.format(
+            payload, backend, operation, seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Compare the throughput of the wsproxy relay in binary and base64 modes.
+
+Run it with ``python -m benchmarks.wsproxy_base64``, the reads of a VNC
+target are queued on a session and sent to a websocket that only counts the
+bytes, so only the relay and the encoding are timed. The naive mode encodes
+each read on its own, as websockify does.
+"""
+from __future__ import print_function
+
+import os
+import random
+import timeit
+
+from base64 import b64encode
+
+from projety.wsproxy import WsProxy
+from projety.wsproxy.socket import ProxySocket
+
+
+class CountingWebSocket(object):
+    """Websocket counting what is sent."""
+
+    def __init__(self):
+        """Init."""
+        self.messages = 0
+        self.size = 0
+
+    def send(self, message):
+        """Count a message."""
+        self.messages += 1
+        self.size += len(message)
+
+
+def vnc_reads(total=16 * 1024 * 1024):
+    """Return reads of a target, small updates mixed with big ones."""
+    data = os.urandom(65536)
+    reads = []
+    size = 0
+    while size < total:
+        length = random.choice((12, 64, 512, 4096, 65536))
+        reads.append(data[:length])
+        size += length
+    return reads
+
+
+def session(mode):
+    """Return a session relaying to a counting websocket."""
+    server = WsProxy(async_mode='threading')
+    s = ProxySocket(server, server._generate_id())
+    environ = {'HTTP_SEC_WEBSOCKET_VERSION': '13',
+               'HTTP_SEC_WEBSOCKET_KEY': 'dGhlIHNhbXBsZSBub25jZQ==',
+               'HTTP_SEC_WEBSOCKET_PROTOCOL': mode}
+    s.do_websocket_handshake(environ, lambda status, headers: None)
+    s.ws = CountingWebSocket()
+    return s
+
+
+def relay(mode, reads, burst):
+    """Relay the reads, the websocket is writable every ``burst`` reads."""
+    s = session(mode)
+    for i in range(0, len(reads), burst):
+        for data in reads[i:i + burst]:
+            s.cqueue.append(data)
+        s._send_to_ws()
+    return s.ws
+
+
+def naive(reads):
+    """Encode every read on its own."""
+    ws = CountingWebSocket()
+    for data in reads:
+        ws.send(b64encode(data).decode('ascii'))
+    return ws
+
+
+def run(number=5):
+    """Return a list of (mode, burst, messages, MB/s)."""
+    random.seed(42)
+    reads = vnc_reads()
+    size = sum(len(data) for data in reads)
+    results = []
+    for burst in (1, 8, 64):
+        for mode, function in (
+                ('binary', lambda: relay('binary', reads, burst)),
+                ('base64', lambda: relay('base64', reads, burst)),
+                ('naive', lambda: naive(reads))):
+            messages = function().messages
+            seconds = timeit.timeit(function, number=number) / number
+            results.append((mode, burst, messages,
+                            size / seconds / 1024 / 1024))
+    return results
+
+
+def main():
+    """Print the results as a table."""
+    print('{0:<8} {1:>6} {2:>10} {3:>10}'.format('mode', 'burst',
+                                                 'messages', 'MB/s'))
+    for mode, burst, messages, throughput in run():
+        print('{0:<8} {1:>6} {2:>10} {3:>10.1f}'.format(
+            mode, burst, messages, throughput))
+
+
+if __name__ == '__main__':
+    main()
@@ -14,8 +14,46 @@ class Config(object):
                                 '51f52814-0071-11e6-a247-000ec6c2372c')
     # App Settings
     AUTO_PING_SLEEP = 30
+    # Send the auto ping of every minion to every client, instead of only to
+    # the clients subscribed to them
+    AUTO_PING_BROADCAST = os.environ.get('AUTO_PING_BROADCAST', '') == '1'
+    # Pings asked by socket.io clients within PING_BATCH_WINDOW seconds are
+    # sent as one salt job, 0 to send each one at once
+    PING_BATCH_WINDOW = float(os.environ.get('PING_BATCH_WINDOW', 0.05))
+    # Seconds between two maintenances of the pool of tunnels
     CLEANING_SLEEP = 10
 
+    # Password hashes and token signatures are computed in a native thread
+    # pool with eventlet or gevent, at most LOGIN_MAX_CONCURRENCY at once (0
+    # for no limit)
+    LOGIN_MAX_CONCURRENCY = int(os.environ.get('LOGIN_MAX_CONCURRENCY', 4))
+
+    # Salt master running the jobs: salt, or simulated for tests and load
+    # tests without salt (jobs only live in the current process)
+    SALT_BACKEND = os.environ.get('SALT_BACKEND', 'salt')
+    SALT_MASTER_CONFIG = os.environ.get('SALT_MASTER_CONFIG',
+                                        '/etc/salt/master')
+    # Fake minions of the simulated master, answering with a latency of
+    # mean SALT_SIMULATED_LATENCY seconds (constant, uniform or exponential
+    # distribution), a SALT_SIMULATED_FAILURE_RATE of them not answering.
+    # Their functions are comma separated in the environment, all the
+    # simulated ones by default
+    SALT_SIMULATED_MINIONS = int(os.environ.get('SALT_SIMULATED_MINIONS',
+                                                1000))
+    SALT_SIMULATED_LATENCY = float(os.environ.get('SALT_SIMULATED_LATENCY',
+                                                  0.05))
+    SALT_SIMULATED_DISTRIBUTION = os.environ.get(
+        'SALT_SIMULATED_DISTRIBUTION', 'exponential')
+    SALT_SIMULATED_FAILURE_RATE = float(os.environ.get(
+        'SALT_SIMULATED_FAILURE_RATE', 0))
+    SALT_SIMULATED_FUNCTIONS = [f for f in os.environ.get(
+        'SALT_SIMULATED_FUNCTIONS', '').split(',') if f]
+    SALT_SIMULATED_SEED = None
+
+    # Json encoding: auto, orjson, ujson, rapidjson or json
+    JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')
+    JSONIFY_PRETTYPRINT_REGULAR = False
+
     # Extension CORS
     CORS_ORIGINS = '*'
 
@@ -25,13 +63,93 @@ class Config(object):
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
     # Extension celery
-    CELERY_CONFIG = {}
+    CELERY_CONFIG = {
+        'CELERY_TASK_SERIALIZER': 'projety_json',
+        'CELERY_RESULT_SERIALIZER': 'projety_json',
+        'CELERY_ACCEPT_CONTENT': ['projety_json', 'json'],
+    }
 
     # Extension socket.io
     SOCKETIO_MESSAGE_QUEUE = os.environ.get('CELERY_BROKER_URL', 'redis://')
+    # Encoding of the messages on a redis queue: pickle, msgpack (smaller and
+    # faster, needs the msgpack package) or json
+    SOCKETIO_MESSAGE_QUEUE_SERIALIZER = os.environ.get(
+        'SOCKETIO_MESSAGE_QUEUE_SERIALIZER', 'pickle')
+
+    # The last JOB_REPLAY_SIZE socket.io job results of each user are kept
+    # JOB_REPLAY_TTL seconds, for the clients resuming after a reconnection:
+    # in redis (shared with the Celery workers) or in memory (one process)
+    JOB_REPLAY_STORE = os.environ.get('JOB_REPLAY_STORE', 'redis')
+    JOB_REPLAY_STORE_URL = os.environ.get('CELERY_BROKER_URL', 'redis://')
+    JOB_REPLAY_SIZE = 50
+    JOB_REPLAY_TTL = 3600
+
+    # Every process publishes its metrics every METRICS_PUBLISH_INTERVAL
+    # seconds, /api/metrics returns those of all the gunicorn and Celery
+    # workers: in redis, or in memory to only read the answering process
+    METRICS_STORE = os.environ.get('METRICS_STORE', 'redis')
+    METRICS_STORE_URL = os.environ.get('CELERY_BROKER_URL', 'redis://')
+    METRICS_PUBLISH_INTERVAL = int(os.environ.get('METRICS_PUBLISH_INTERVAL',
+                                                  10))
+
+    # Requests of admins with the X-Profile: 1 header are profiled, the last
+    # PROFILE_STORE_SIZE profiles are kept PROFILE_TTL seconds: in redis to
+    # read them from any worker, or in memory
+    PROFILE_STORE = os.environ.get('PROFILE_STORE', 'redis')
+    PROFILE_STORE_URL = os.environ.get('CELERY_BROKER_URL', 'redis://')
+    PROFILE_STORE_SIZE = 50
+    PROFILE_TTL = 3600
 
     # Extension websockify
     WEBSOCKET_MESSAGE_QUEUE = os.environ.get('CELERY_BROKER_URL', 'redis://')
+    # Buffer sizes (bytes) where we stop reading from the other side, and
+    # where we resume, for data going to the browser (client) and to the
+    # minion tunnel (target)
+    WSPROXY_CLIENT_HIGH_WATERMARK = 4 * 1024 * 1024
+    WSPROXY_CLIENT_LOW_WATERMARK = 1024 * 1024
+    WSPROXY_TARGET_HIGH_WATERMARK = 1024 * 1024
+    WSPROXY_TARGET_LOW_WATERMARK = 256 * 1024
+    # Small packets for the browser are merged in frames of up to
+    # WSPROXY_COALESCE_SIZE bytes, waiting at most WSPROXY_COALESCE_DELAY
+    # seconds for more (0 to never wait)
+    WSPROXY_COALESCE_SIZE = 64 * 1024
+    WSPROXY_COALESCE_DELAY = float(os.environ.get('WSPROXY_COALESCE_DELAY',
+                                                  0.0005))
+    # Compress remote control streams with permessage-deflate (eventlet
+    # only): level 1 (fast) to 9 (small), keeping the compression context
+    # between messages costs memory but compresses better
+    WSPROXY_DEFLATE = os.environ.get('WSPROXY_DEFLATE', '') == '1'
+    WSPROXY_DEFLATE_LEVEL = int(os.environ.get('WSPROXY_DEFLATE_LEVEL', 6))
+    WSPROXY_DEFLATE_CONTEXT_TAKEOVER = True
+    WSPROXY_DEFLATE_MAX_WINDOW_BITS = 15
+    WSPROXY_DEFLATE_MIN_SIZE = 64
+    # Where remote control tokens are kept: memory (one worker only) or
+    # redis (shared by all workers)
+    WSPROXY_TOKEN_STORE = os.environ.get('WSPROXY_TOKEN_STORE', 'memory')
+    WSPROXY_TOKEN_STORE_URL = os.environ.get('CELERY_BROKER_URL', 'redis://')
+    # Tokens expire on time, the token store is also reloaded every
+    # WSPROXY_EXPIRY_RESYNC seconds to catch tokens of other workers
+    WSPROXY_EXPIRY_RESYNC = 60
+    # Public ssh host key sent to the minions, and local ports used by the
+    # tunnels (first-last in the environment), reserved in the token store
+    WSPROXY_HOST_KEY = os.environ.get('WSPROXY_HOST_KEY',
+                                      '/etc/ssh/ssh_host_rsa_key.pub')
+    WSPROXY_PORT_RANGE = tuple(int(p) for p in os.environ.get(
+        'WSPROXY_PORT_RANGE', '40000-40999').split('-'))
+    # Tunnels opened in advance, for the minions listed (comma separated in
+    # the environment) and for the most requested ones, replaced after
+    # WSPROXY_PREWARM_MAX_AGE seconds
+    WSPROXY_PREWARM_MINIONS = [m for m in os.environ.get(
+        'WSPROXY_PREWARM_MINIONS', '').split(',') if m]
+    WSPROXY_PREWARM_TOP = int(os.environ.get('WSPROXY_PREWARM_TOP', 0))
+    WSPROXY_PREWARM_SIZE = 1
+    WSPROXY_PREWARM_MAX_AGE = 3600
+    # Remote control sessions open at once on a worker, 0 for no limit
+    WSPROXY_MAX_SESSIONS = int(os.environ.get('WSPROXY_MAX_SESSIONS', 500))
+    # Sessions opened with mode=control or mode=view share one connection to
+    # the tunnel, viewers can join while the first WSPROXY_SHARED_RING_SIZE
+    # bytes of the stream are kept (VNC needs the stream from its start)
+    WSPROXY_SHARED_RING_SIZE = 8 * 1024 * 1024
 
     # Extension swagger
     SWAGGER = {'specs':
@@ -62,6 +180,7 @@ class DevelopmentConfig(Config):
     """Specific for dev."""
 
     DEBUG = True
+    JSONIFY_PRETTYPRINT_REGULAR = True
 
 
 class ProductionConfig(Config):
@@ -77,6 +196,19 @@ class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     CELERY_CONFIG = {'CELERY_ALWAYS_EAGER': True}
     SOCKETIO_MESSAGE_QUEUE = None
+    PING_BATCH_WINDOW = 0
+    # Tests run without salt, unless SALT_BACKEND=salt
+    SALT_BACKEND = os.environ.get('SALT_BACKEND', 'simulated')
+    SALT_SIMULATED_MINIONS = 10
+    SALT_SIMULATED_LATENCY = 0.001
+    SALT_SIMULATED_FAILURE_RATE = 0
+    SALT_SIMULATED_SEED = 0
+    JOB_REPLAY_STORE = 'memory'
+    METRICS_STORE = 'memory'
+    PROFILE_STORE = 'memory'
+    WSPROXY_TOKEN_STORE = 'memory'
+    WSPROXY_PREWARM_MINIONS = []
+    WSPROXY_PREWARM_TOP = 0
 
 
 config = {
@@ -8,6 +8,7 @@ It can be use to :
 - seed the database
 - test syntax with lint
 - test the app with py.test
+- benchmark the endpoints
 """
 
 import os
@@ -119,6 +120,21 @@ class CeleryWorker(Command):
 manager.add_command("celery", CeleryWorker())
 
 
+class Bench(Command):
+    """Benchmark the API endpoints, see benchmarks/endpoints.py."""
+
+    name = 'bench'
+    capture_all_args = True
+
+    def run(self, argv):
+        """Execute the benchmarks."""
+        from benchmarks import endpoints
+        sys.exit(endpoints.main(argv))
+
+
+manager.add_command("bench", Bench())
+
+
 @manager.command
 def createdb(drop_first=False):
     """Create the database."""
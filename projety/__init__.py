@@ -19,6 +19,13 @@ from celery import Celery
 from config import config
 
 from wsproxy import FlaskWsProxy
+from wsproxy.metrics import samples as wsproxy_samples
+
+from . import json_backend, message_queue
+from .metrics import metrics
+from .offload import Offloader
+from .profiling import RequestProfiler
+from .replay import JobReplay
 
 # Flask extensions
 db = SQLAlchemy()
@@ -30,6 +37,9 @@ celery = Celery(__name__,
                 backend=os.environ.get('CELERY_BROKER_URL', 'redis://'))
 swagger = Swagger()
 principal = Principal(use_sessions=False)
+offloader = Offloader()
+job_replay = JobReplay()
+profiler = RequestProfiler()
 
 # Import models so that they are registered with SQLAlchemy
 from . import models  # noqa
@@ -64,28 +74,45 @@ def create_app(config_name=None, main=True):
     app = Flask(__name__)
     app.config.from_object(config[config_name])
 
+    # Select the json backend before extensions use it
+    json_backend.init_app(app)
+
+    # Select the salt master, real or simulated
+    salt.init_app(app)
+
     # Initialize flask extensions
     db.init_app(app)
     cors.init_app(app)
     swagger.init_app(app)
     principal.init_app(app)
+    job_replay.init_app(app)
+    metrics.init_app(app)
+    profiler.init_app(app)
     if main:
         # Initialize socketio server and attach it to the message queue, so
         # that everything works even when there are multiple servers or
         # additional processes such as Celery workers wanting to access
         # Socket.IO
-        socketio.init_app(app,
-                          message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'])
+        socketio.init_app(app, json=json_backend,
+                          **message_queue.socketio_options(app))
+
+        # CPU heavy auth work runs in the thread pool of the async mode
+        offloader.init_app(app, socketio.async_mode)
 
         # Our wsproxy is only needed for the main app
         remote_proxy.init_app(app)
+        metrics.add_collector(
+            'wsproxy', lambda: wsproxy_samples(remote_proxy.collect_metrics()))
     else:
         # Initialize socketio to emit events through through the message queue
         # Note that since Celery does not use eventlet, we have to be explicit
         # in setting the async mode to not use it.
         socketio.init_app(None,
-                          message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'],
-                          async_mode='threading')
+                          async_mode='threading',
+                          json=json_backend,
+                          **message_queue.socketio_options(app,
+                                                           write_only=True))
+        offloader.init_app(app)
     celery.conf.update(config[config_name].CELERY_CONFIG)
 
     # Reset logging due to salt mess
@@ -95,6 +122,10 @@ def create_app(config_name=None, main=True):
     from .api import api as api_blueprint
     app.register_blueprint(api_blueprint, url_prefix='/api')
 
+    # Precompute url templates used to serialize models
+    from . import serializers
+    serializers.init_app(app)
+
     # Register handlers
     from .errors import not_found, method_not_supported, internal_server_error
     app.register_error_handler(404, not_found)
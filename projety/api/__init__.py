@@ -4,4 +4,5 @@ from flask import Blueprint
 
 api = Blueprint('api', __name__)
 
-from . import tokens, users, minions, tasks, ping, errors, acls, roles, jobs  # noqa
+from . import tokens, users, minions, tasks, ping, errors, acls, roles, jobs, \
+    remote, metrics, profiles  # noqa
@@ -1,12 +1,14 @@
 """Handles users endpoints."""
 import logging
 
-from flask import jsonify, abort, request
+from flask import abort, request
 
 
 from .. import db
 from ..auth import token_auth
+from ..json_backend import jsonify
 from ..models import User, Acl
+from ..serializers import serialize
 from ..permissions import AclReadPermission, AclWritePermission
 from ..exceptions import RoleError, ValidationError
 from . import api
@@ -49,7 +51,7 @@ def get_acls(user_id):
         raise RoleError(permission)
 
     acls = User.query.get_or_404(user_id).acls
-    return jsonify([acl.to_dict() for acl in acls])
+    return jsonify(serialize(acls))
 
 
 @api.route('/v1.0/users/<user_id>/acls', methods=['POST'])
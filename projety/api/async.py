@@ -1,4 +1,5 @@
 """Handles /keys endpoints."""
+import base64
 import logging
 import time
 from functools import wraps
@@ -11,12 +12,8 @@ from flask import g, request
 from werkzeug.exceptions import InternalServerError
 from celery import states
 
-import salt.runner
-import salt.client
-
-from .. import celery, socketio
+from .. import celery, job_replay, salt, socketio
 from ..utils import url_for
-from ..salt import opts as salt_opts
 from ..exceptions import SaltMinionError
 
 
@@ -30,37 +27,62 @@ except NameError:
 logger = logging.getLogger(__name__)
 
 
+def request_environ():
+    """
+    Return the environ of the current request, for run_flask_request.
+
+    Only strings are kept. The body is base64 encoded, as Celery serializes
+    tasks in json which only carries text.
+    """
+    environ = {k: v for k, v in request.environ.items()
+               if isinstance(v, text_types)}
+    if 'wsgi.input' in request.environ:
+        environ['_wsgi.input'] = base64.b64encode(
+            request.get_data()).decode('ascii')
+    return environ
+
+
+def restore_environ(environ):
+    """Return an environ of request_environ, as WSGI expects it."""
+    # json gives back unicode, WSGI wants native strings on Python 2
+    environ = dict((str(k), v.encode('utf-8')
+                    if isinstance(v, text_types) and not isinstance(v, str)
+                    else v)
+                   for k, v in environ.items())
+    if '_wsgi.input' in environ:
+        environ['wsgi.input'] = BytesIO(
+            base64.b64decode(environ.pop('_wsgi.input')))
+    return environ
+
+
 @celery.task
-def salt_socketio(jid, minion, sid):
-    """Wait for a salt job and emit result."""
+def salt_socketio(jid, minion, sid, user_id=None):
+    """Wait for a salt job and emit result, kept for the user to resume."""
     from ..wsgi_aux import app
     with app.app_context():
 
         try:
             # Wait for salt-completion
-            client = salt.client.get_local_client()
-            status = client.cmd(minion, 'saltutil.find_job', [jid])
+            status = salt.backend.cmd(minion, 'saltutil.find_job', [jid])
 
             time_iteration = 1
             while 'jid' in status:
                 time.sleep(time_iteration)
-                status = client.cmd(minion, 'saltutil.find_job', [jid])
+                status = salt.backend.cmd(minion, 'saltutil.find_job', [jid])
 
             # When finish call salt-run
-            runner = salt.runner.RunnerClient(salt_opts)
-            result = runner.cmd('jobs.lookup_jid', [jid])
+            result = salt.backend.lookup_jid(jid)
 
             if minion not in result:
                 raise SaltMinionError(minion)
 
-            # Push data back
-            socketio.emit('job_result',
-                          {'jid': jid, 'status': 'success', 'result': result},
-                          room=sid)
+            data = {'jid': jid, 'status': 'success', 'result': result}
         except SaltMinionError as e:
-            socketio.emit('job_result',
-                          {'jid': jid, 'status': 'error', 'result': str(e)},
-                          room=sid)
+            data = {'jid': jid, 'status': 'error', 'result': str(e)}
+
+        # Push data back, to the sid of the client if it resumed the job
+        sid = job_replay.record(user_id, sid, data)
+        socketio.emit('job_result', data, room=sid)
 
 
 def salt_async(minion, task):
@@ -69,11 +91,7 @@ def salt_async(minion, task):
     # passing the request environment, which will be used to reconstruct
     # the request object. The request body has to be handled as a special
     # case, since WSGI requires it to be provided as a file-like object.
-    environ = {k: v for k, v in request.environ.items()
-               if isinstance(v, text_types)}
-    if 'wsgi.input' in request.environ:
-        environ['_wsgi.input'] = request.get_data()
-
+    environ = request_environ()
     t = run_flask_request.apply_async(args=(environ,))
 
     # Return a 202 response, with a link that the client can use to
@@ -86,7 +104,7 @@ def salt_async(minion, task):
 
     # If the task already finished, return its return value as response.
     # This would be the case when CELERY_ALWAYS_EAGER is set to True.
-    return t.info
+    return tuple(t.info)
 
 
 @celery.task
@@ -94,8 +112,7 @@ def run_flask_request(environ):
     """Run our flask request using celery workers."""
     from ..wsgi_aux import app
 
-    if '_wsgi.input' in environ:
-        environ['wsgi.input'] = BytesIO(environ['_wsgi.input'])
+    environ = restore_environ(environ)
 
     # Create a request context similar to that of the original request
     # so that the task can have access to flask.g, flask.request, etc.
@@ -112,7 +129,7 @@ def run_flask_request(environ):
             if app.debug:
                 raise
             rv = app.make_response(InternalServerError())
-        return (rv.get_data(), rv.status_code, rv.headers)
+        return (rv.get_data(), rv.status_code, rv.headers.to_wsgi_list())
 
 
 def async(f):
@@ -133,10 +150,7 @@ def async(f):
         # passing the request environment, which will be used to reconstruct
         # the request object. The request body has to be handled as a special
         # case, since WSGI requires it to be provided as a file-like object.
-        environ = {k: v for k, v in request.environ.items()
-                   if isinstance(v, text_types)}
-        if 'wsgi.input' in request.environ:
-            environ['_wsgi.input'] = request.get_data()
+        environ = request_environ()
         t = run_flask_request.apply_async(args=(environ,))
 
         # Return a 202 response, with a link that the client can use to
@@ -149,5 +163,5 @@ def async(f):
 
         # If the task already finished, return its return value as response.
         # This would be the case when CELERY_ALWAYS_EAGER is set to True.
-        return t.info
+        return tuple(t.info)
     return wrapped
@@ -1,9 +1,9 @@
 """Custom handles of API errors."""
 import logging
 
-from flask import jsonify
 from sqlalchemy.exc import IntegrityError
 from ..exceptions import ApiError
+from ..json_backend import jsonify
 from . import api
 
 logger = logging.getLogger(__name__)
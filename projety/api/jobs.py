@@ -5,6 +5,7 @@ import time
 
 from flask import current_app
 
+from ..events import push_subscriptions
 from ..salt import Job, get_minions
 from . import api
 
@@ -13,22 +14,24 @@ logger = logging.getLogger(__name__)
 
 @api.before_app_first_request
 def cleaning():
-    """Start a background thread to clean old tokens."""
-    def clean_old_tokens(app):
+    """Start the token expiry scheduler, and the tunnel pool maintenance."""
+    def maintain_tunnel_pool(app):
         with app.app_context():
-            logger.info('thread clean_old_tokens started')
+            logger.info('thread maintain_tunnel_pool started')
             while True:
                 websockify = app.extensions['websockify']
-                token_manager = websockify.server.token_manager
-                token_manager.clean_old_tokens()
+                websockify.server.tunnel_pool.maintain()
                 time.sleep(app.config['CLEANING_SLEEP'])
 
     if 'websockify' in current_app.extensions:
         if not current_app.config['TESTING']:
-            thread = threading.Thread(
-                target=clean_old_tokens,
-                args=(current_app._get_current_object(),))
-            thread.start()
+            server = current_app.extensions['websockify'].server
+            server.token_manager.scheduler.start()
+            if server.tunnel_pool.enabled:
+                thread = threading.Thread(
+                    target=maintain_tunnel_pool,
+                    args=(current_app._get_current_object(),))
+                thread.start()
 
 
 @api.before_app_first_request
@@ -49,8 +52,12 @@ def auto_ping():
                     if minion not in result:
                         result[minion] = False
 
-                # Push data back using socketio
-                socketio.emit('auto_ping', result)
+                # Push data back using socketio, to the clients subscribed
+                # to the minions, or to everyone for older dashboards
+                if app.config['AUTO_PING_BROADCAST']:
+                    socketio.emit('auto_ping', result)
+                else:
+                    push_subscriptions('auto_ping', result)
 
                 # Sleep 30 seconds between calls
                 time.sleep(app.config['AUTO_PING_SLEEP'])
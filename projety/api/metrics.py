@@ -0,0 +1,41 @@
+"""Handles the /metrics endpoint."""
+import logging
+
+from flask import Response
+
+from ..auth import token_auth
+from ..permissions import AdminPermission
+from ..exceptions import RoleError
+from ..metrics import metrics
+from . import api
+
+logger = logging.getLogger(__name__)
+
+
+@api.route('/metrics', methods=['GET'])
+@token_auth.login_required
+def get_metrics():
+    """
+    Return the metrics of all the workers in the Prometheus text format.
+
+    ---
+    tags:
+      - metrics
+    security:
+      - token: []
+    produces:
+      - text/plain
+    responses:
+      200:
+        description: Returns the request, salt, cache, Celery and proxy
+                     metrics
+      403:
+        description: When not admin
+
+    """
+    permission = AdminPermission()
+    if not permission.can():
+        raise RoleError(permission)
+
+    return Response(metrics.exposition(),
+                    mimetype='text/plain; version=0.0.4')
@@ -1,7 +1,7 @@
 """Handles /keys endpoints."""
 import logging
 
-from flask import jsonify, request, g
+from flask import request, g
 
 
 from ..exceptions import SaltTaskError, ValidationError
@@ -9,6 +9,7 @@ from ..salt import (get_minions as _get_minions,
                     get_minion_functions as _get_minion_functions,
                     Job)
 from ..auth import token_auth
+from ..json_backend import jsonify
 from .. import remote_proxy
 from . import api
 from async import salt_async, salt_socketio
@@ -220,7 +221,8 @@ def post_minion_task(minion, task):
     if async == 'socket.io':
         job = Job(async=True)
         jid = job.run(minion, task)
-        salt_socketio.apply_async(args=(jid, minion, sid))
+        salt_socketio.apply_async(args=(jid, minion, sid,
+                                        g.current_user.id))
         return jsonify({'jid': jid})
 
     if async == 'async':
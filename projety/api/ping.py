@@ -1,10 +1,9 @@
 """Handles /keys endpoints."""
 import logging
 
-from flask import jsonify
-
 from ..salt import (ping_one as _ping_one, ping as _ping)
 from ..auth import token_auth
+from ..json_backend import jsonify
 from . import api
 from .async import async
 
@@ -0,0 +1,113 @@
+"""Handles /profiles endpoints, the requests profiled with X-Profile."""
+import logging
+
+from flask import current_app, abort
+
+from ..auth import token_auth
+from ..json_backend import jsonify
+from ..permissions import AdminPermission
+from ..exceptions import RoleError
+from . import api
+
+logger = logging.getLogger(__name__)
+
+# Fields of the profiles listed, the report and queries are left out
+SUMMARY = ('id', 'date', 'method', 'path', 'endpoint', 'status', 'duration',
+           'sql_count', 'sql_time')
+
+
+@api.route('/v1.0/profiles', methods=['GET'])
+@token_auth.login_required
+def get_profiles():
+    """
+    Return the last profiled requests.
+
+    ---
+    tags:
+      - profiles
+    security:
+      - token: []
+    responses:
+      200:
+        description: Returns the profiles, newest first, without their
+                     report
+        schema:
+          type: array
+          items:
+            id: profile_summary
+            properties:
+              id:
+                type: string
+              path:
+                type: string
+              status:
+                type: integer
+              duration:
+                type: number
+              sql_count:
+                type: integer
+              sql_time:
+                type: number
+      403:
+        description: When not admin
+
+    """
+    permission = AdminPermission()
+    if not permission.can():
+        raise RoleError(permission)
+
+    profiler = current_app.extensions['profiler']
+    return jsonify([dict((key, profile.get(key)) for key in SUMMARY)
+                    for profile in profiler.recent()])
+
+
+@api.route('/v1.0/profiles/<profile_id>', methods=['GET'])
+@token_auth.login_required
+def get_profile(profile_id):
+    """
+    Return the profile of a request, by the id of its X-Profile-Id header.
+
+    ---
+    tags:
+      - profiles
+    security:
+      - token: []
+    parameters:
+      - name: profile_id
+        in: path
+        description: ID of the profile
+        required: true
+        type: string
+    responses:
+      200:
+        description: Returns the profile, with its SQL queries and its
+                     cProfile report
+        schema:
+          id: profile
+          properties:
+            id:
+              type: string
+            sql_count:
+              type: integer
+            sql_time:
+              type: number
+            queries:
+              type: array
+              items:
+                type: object
+            stats:
+              type: string
+      403:
+        description: When not admin
+      404:
+        description: When the profile doesn't exist anymore
+
+    """
+    permission = AdminPermission()
+    if not permission.can():
+        raise RoleError(permission)
+
+    profile = current_app.extensions['profiler'].get(profile_id)
+    if profile is None:
+        abort(404)
+    return jsonify(profile)
@@ -0,0 +1,148 @@
+"""Handles /remote endpoints, to inspect and manage remote control."""
+import logging
+
+from flask import Response, abort
+
+from ..auth import token_auth
+from ..json_backend import jsonify
+from ..permissions import AdminPermission
+from ..exceptions import RoleError
+from .. import remote_proxy
+from . import api
+
+logger = logging.getLogger(__name__)
+
+
+@api.route('/v1.0/remote/expiries', methods=['GET'])
+@token_auth.login_required
+def get_remote_expiries():
+    """
+    Return the remote control tokens scheduled to expire.
+
+    ---
+    tags:
+      - remote
+    security:
+      - token: []
+    responses:
+      200:
+        description: Returns the tokens, the next to expire first
+        schema:
+          type: array
+          items:
+            id: expiry
+            properties:
+              id:
+                type: string
+              deadline:
+                type: integer
+      403:
+        description: When not admin
+
+    """
+    permission = AdminPermission()
+    if not permission.can():
+        raise RoleError(permission)
+
+    return jsonify(remote_proxy.pending_expiries())
+
+
+@api.route('/v1.0/remote/sessions', methods=['GET'])
+@token_auth.login_required
+def get_remote_sessions():
+    """
+    Return the open remote control sessions and the proxy metrics.
+
+    ---
+    tags:
+      - remote
+    security:
+      - token: []
+    responses:
+      200:
+        description: Returns the sessions, with their counters, durations
+                     and buffers, and the metrics of the proxy
+        schema:
+          id: remote_sessions
+          properties:
+            sessions:
+              type: array
+              items:
+                type: object
+            metrics:
+              type: object
+      403:
+        description: When not admin
+
+    """
+    permission = AdminPermission()
+    if not permission.can():
+        raise RoleError(permission)
+
+    sessions = remote_proxy.stats()
+    return jsonify({'sessions': sessions,
+                    'metrics': remote_proxy.collect_metrics()})
+
+
+@api.route('/v1.0/remote/sessions/<sid>', methods=['DELETE'])
+@token_auth.login_required
+def kill_remote_session(sid):
+    """
+    Kill a remote control session.
+
+    ---
+    tags:
+      - remote
+    security:
+      - token: []
+    parameters:
+      - name: sid
+        in: path
+        description: ID of the session
+        required: true
+        type: string
+    responses:
+      200:
+        description: When the session is closing
+      403:
+        description: When not admin
+      404:
+        description: When the session doesn't exist
+
+    """
+    permission = AdminPermission()
+    if not permission.can():
+        raise RoleError(permission)
+
+    if not remote_proxy.kill_session(sid):
+        abort(404)
+
+    return ''
+
+
+@api.route('/v1.0/remote/metrics', methods=['GET'])
+@token_auth.login_required
+def get_remote_metrics():
+    """
+    Return the proxy metrics in the Prometheus text format.
+
+    ---
+    tags:
+      - remote
+    security:
+      - token: []
+    produces:
+      - text/plain
+    responses:
+      200:
+        description: Returns the metrics
+      403:
+        description: When not admin
+
+    """
+    permission = AdminPermission()
+    if not permission.can():
+        raise RoleError(permission)
+
+    return Response(remote_proxy.metrics_exposition(),
+                    mimetype='text/plain; version=0.0.4')
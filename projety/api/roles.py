@@ -1,11 +1,13 @@
 """Handles users endpoints."""
 import logging
 
-from flask import jsonify, abort, request
+from flask import abort, request
 
 from .. import db
 from ..auth import token_auth
+from ..json_backend import jsonify
 from ..models import User, Role
+from ..serializers import serialize
 from ..permissions import RoleReadPermission, RoleWritePermission
 from ..exceptions import RoleError, ValidationError
 from . import api
@@ -48,7 +50,7 @@ def get_roles(user_id):
         raise RoleError(permission)
 
     roles = User.query.get_or_404(user_id).roles
-    return jsonify([role.to_dict() for role in roles])
+    return jsonify(serialize(roles))
 
 
 @api.route('/v1.0/users/<user_id>/roles', methods=['POST'])
@@ -47,4 +47,5 @@ def get_status(id):
     if task.state in [states.PENDING, states.RECEIVED, states.STARTED]:
         return '', 202, {'Location': url_for('api.get_status', id=id),
                          'Access-Control-Expose-Headers': 'Location'}
-    return task.info
+    # Results are json serialized, so we get back a list
+    return tuple(task.info)
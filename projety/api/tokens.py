@@ -1,10 +1,11 @@
 """Handle tokens endpoints."""
 import logging
 
-from flask import jsonify, g, request
+from flask import g, request
 
 from ..exceptions import ValidationError
 from ..auth import basic_auth
+from ..json_backend import jsonify
 from . import api
 
 logger = logging.getLogger(__name__)
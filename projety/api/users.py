@@ -1,9 +1,9 @@
 """Handles users endpoints."""
 
-from flask import jsonify
-
 from ..auth import token_auth
+from ..json_backend import jsonify
 from ..models import User
+from ..serializers import serialize
 from . import api
 
 
@@ -28,7 +28,7 @@ def get_users():
 
     """
     users = User.query.order_by(User.updated_at.asc(), User.nickname.asc())
-    return jsonify([user.to_dict() for user in users.all()])
+    return jsonify(serialize(users.all()))
 
 
 @api.route('/v1.0/users/<id>', methods=['GET'])
@@ -1,13 +1,15 @@
 """Module that manage authentification."""
 import logging
 
-from flask import jsonify, g, current_app
+from flask import g, current_app
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 from flask_principal import (Identity, AnonymousIdentity,
                              UserNeed, RoleNeed,
                              identity_changed)
 
 from . import db
+from .json_backend import jsonify
+from .metrics import metrics
 from .models import User
 
 # Authentication objects for username/password auth or a token auth
@@ -61,8 +63,10 @@ def verify_password(nickname, password):
       UserSecurity:
         type: basic
     """
-    user = User.query.filter_by(nickname=nickname).first()
-    if user is None or not user.verify_password(password):
+    with metrics.timer('auth_duration_seconds', scheme='basic'):
+        user = User.query.filter_by(nickname=nickname).first()
+        valid = user is not None and user.verify_password(password)
+    if not valid:
         update_user()
         return False
     else:
@@ -92,7 +96,8 @@ def verify_token(token):
         in: header
         name: token
     """
-    user = User.verify_auth_token(token)
+    with metrics.timer('auth_duration_seconds', scheme='token'):
+        user = User.verify_auth_token(token)
     if user is None:
         update_user()
         return False
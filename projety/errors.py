@@ -1,7 +1,7 @@
 """Handle nice json response for error."""
 import logging
 
-from flask import jsonify
+from .json_backend import jsonify
 
 logger = logging.getLogger(__name__)
 
@@ -1,17 +1,91 @@
 """Handle socket.io events."""
 
+import collections
+import fnmatch
 import logging
+import threading
+import time
 
-from flask import g, request
+from flask import current_app, g, request
+from flask_socketio import join_room, leave_room, rooms
 
-from . import socketio, celery
+from . import socketio, celery, job_replay
 from .models import User
 from .auth import verify_token, verify_password
-from .salt import ping_one
-from .exceptions import SaltError, ValidationError
+from .salt import get_minions, is_task_allowed, ping_many, ping_one
+from .exceptions import SaltACLError, SaltError, ValidationError
 
 logger = logging.getLogger(__name__)
 
+# Clients subscribe to minions by joining rooms named after a minion or a
+# glob pattern
+SUBSCRIPTION_PREFIX = 'minion:'
+
+# Last state of every minion, sent to new subscribers
+latest_results = {}
+
+# Users bound to the socket.io sessions of this server by authenticate, by
+# sid, so their events don't need a token
+BoundUser = collections.namedtuple('BoundUser', 'user_id expiration')
+bound_users = {}
+
+
+def bind_user(sid, user_id, expiration):
+    """Bind a user to a session until a timestamp."""
+    bound_users[sid] = BoundUser(user_id, expiration)
+
+
+def current_user_id(token=None):
+    """
+    Return the id of the user sending the event, None if not authenticated.
+
+    A user bound to the session is used until its expiration, without
+    reading the database, else the token of the event is verified.
+    """
+    bound = bound_users.get(request.sid)
+    if bound is not None:
+        if bound.expiration > time.time():
+            return bound.user_id
+        del bound_users[request.sid]
+        socketio.emit('authentication_expired', {}, room=request.sid)
+    if token is not None and verify_token(token):
+        return g.current_user.id
+    return None
+
+
+def _subscription_targets(targets):
+    """Return the minions or patterns of a subscribe event as a list."""
+    if isinstance(targets, basestring):
+        targets = [targets]
+    if not isinstance(targets, (list, tuple)):
+        return []
+    return [t for t in targets if isinstance(t, basestring) and t]
+
+
+def subscription_rooms():
+    """Return the subscription rooms having clients on this server."""
+    namespace_rooms = socketio.server.manager.rooms.get('/', {})
+    return [room for room in list(namespace_rooms)
+            if isinstance(room, basestring) and
+            room.startswith(SUBSCRIPTION_PREFIX)]
+
+
+def filter_results(results, target):
+    """Return the results of the minions matching a name or a pattern."""
+    if target in results:
+        return {target: results[target]}
+    return dict((minion, results[minion])
+                for minion in fnmatch.filter(results, target))
+
+
+def push_subscriptions(event, results):
+    """Emit to every subscription room the results it is interested in."""
+    latest_results.update(results)
+    for room in subscription_rooms():
+        data = filter_results(results, room[len(SUBSCRIPTION_PREFIX):])
+        if data:
+            socketio.emit(event, data, room=room)
+
 
 def push_result(data, sid):
     """Push the job to all connected Socket.IO clients."""
@@ -41,29 +115,206 @@ def ping_minion(user_id, data, sid):
         push_result(result, sid)
 
 
+@celery.task
+def ping_minions(requests):
+    """Run the pings gathered by the ping batcher."""
+    from .wsgi_aux import app
+    with app.app_context():
+        run_pings(requests)
+
+
+def run_pings(requests):
+    """
+    Ping the minions of many requests with one salt job.
+
+    Requests are ``(user_id, minion, sid)``, the ACL of each user is checked
+    before the job, and every sid gets the results of its own minions in one
+    job_result.
+    """
+    by_user = collections.defaultdict(list)
+    for user_id, minion, sid in requests:
+        by_user[user_id].append((minion, sid))
+
+    known = get_minions()
+    allowed = collections.defaultdict(set)
+    for user_id, pings in by_user.items():
+        user = User.query.get(user_id)
+        if user is None:
+            continue
+        g.current_user = user
+
+        # Check all the minions of a user at once, one by one if refused
+        minions = sorted(set(m for m, sid in pings if m in known))
+        everything = minions and is_task_allowed(
+            ','.join(minions), 'test.ping', (), 'list')
+        for minion, sid in pings:
+            if minion not in known:
+                error = ValidationError('Minion {0} is not valid'.format(
+                    minion))
+            elif everything or is_task_allowed(minion, 'test.ping', (),
+                                               'glob'):
+                allowed[minion].add(sid)
+                continue
+            else:
+                error = SaltACLError(minion, 'test.ping', ())
+            push_result(error.to_dict(), sid)
+
+    if not allowed:
+        return
+    try:
+        result = ping_many(sorted(allowed))
+    except SaltError as e:
+        for sid in set.union(*allowed.values()):
+            push_result(e.to_dict(), sid)
+        return
+
+    results = collections.defaultdict(dict)
+    for minion, sids in allowed.items():
+        for sid in sids:
+            results[sid][minion] = result[minion]
+    for sid, data in results.items():
+        push_result(data, sid)
+
+
+class PingBatcher(object):
+    """
+    Gather the ping_minion events of a short window in one celery task.
+
+    A dashboard opening pings all its minions at once, the first request
+    starts a timer of PING_BATCH_WINDOW seconds and all the requests
+    received until it fires share one task and one salt job. With a window
+    of 0 every request is sent at once.
+    """
+
+    def __init__(self):
+        """Init."""
+        self.lock = threading.Lock()
+        self.requests = []
+        self.scheduled = False
+
+    def add(self, user_id, minion, sid):
+        """Queue the ping of a minion for a session."""
+        window = current_app.config['PING_BATCH_WINDOW']
+        with self.lock:
+            self.requests.append((user_id, minion, sid))
+            schedule = window > 0 and not self.scheduled
+            if schedule:
+                self.scheduled = True
+        if window <= 0:
+            self.flush()
+        elif schedule:
+            socketio.start_background_task(self._flush_later, window)
+
+    def _flush_later(self, window):
+        socketio.sleep(window)
+        self.flush()
+
+    def flush(self):
+        """Send the queued requests in one task."""
+        with self.lock:
+            requests, self.requests = self.requests, []
+            self.scheduled = False
+        if requests:
+            ping_minions.apply_async(args=(requests,))
+
+
+ping_batcher = PingBatcher()
+
+
 @socketio.on('login')
 def on_login(nickname, password, expiration=600):
     """Define the login callback used by socket.io."""
     if verify_password(nickname, password):
         token = g.current_user.generate_auth_token(expiration)
+        bind_user(request.sid, g.current_user.id, time.time() + expiration)
         socketio.emit('login', {'token': token}, room=request.sid)
     else:
         socketio.emit('login_error', {'error': 'wrong login'},
                       room=request.sid)
 
 
+@socketio.on('authenticate')
+def on_authenticate(token):
+    """Bind the user of a token to the session, until the token expires."""
+    loaded = User.load_auth_token(token)
+    if loaded is None or User.query.get(loaded[0]) is None:
+        bound_users.pop(request.sid, None)
+        socketio.emit('authentication_error', {'error': 'invalid token'},
+                      room=request.sid)
+        return
+    user_id, expiration = loaded
+    bind_user(request.sid, user_id, expiration)
+    socketio.emit('authenticated', {'expiration': expiration},
+                  room=request.sid)
+
+
+@socketio.on('disconnect')
+def on_disconnect():
+    """Forget the user bound to the session."""
+    bound_users.pop(request.sid, None)
+
+
 @socketio.on('sid')
-def on_get_sid(token):
+def on_get_sid(token=None):
     """Define the sid callback used by socket.io."""
-    verify_token(token)
-    if g.current_user:
+    if current_user_id(token) is not None:
         socketio.emit('sid', {'sid': request.sid}, room=request.sid)
 
 
 @socketio.on('ping_minion')
-def on_ping_minion(data, token):
+def on_ping_minion(data, token=None):
     """Define the ping_minion callback used by socket.io."""
-    verify_token(token)
-    if g.current_user:
-        ping_minion.apply_async(args=(g.current_user.id, data,
-                                      request.sid))
+    user_id = current_user_id(token)
+    if user_id is not None:
+        ping_batcher.add(user_id, data['minion'], request.sid)
+
+
+@socketio.on('resume')
+def on_resume(jids, token=None):
+    """Emit again the missed results of socket.io jobs, given by jid."""
+    user_id = current_user_id(token)
+    if user_id is None:
+        return
+    if isinstance(jids, basestring):
+        jids = [jids]
+    if not isinstance(jids, (list, tuple)):
+        return
+    jids = [jid for jid in jids if isinstance(jid, basestring)]
+    for data in job_replay.resume(user_id, jids, request.sid):
+        socketio.emit('job_result', data, room=request.sid)
+
+
+@socketio.on('subscribe')
+def on_subscribe(targets, token=None):
+    """Subscribe to the updates of minions, given by names or patterns."""
+    if current_user_id(token) is None:
+        return
+    targets = _subscription_targets(targets)
+    for target in targets:
+        join_room(SUBSCRIPTION_PREFIX + target)
+    _emit_subscriptions()
+
+    # Send what we already know, not to wait for the next update
+    snapshot = {}
+    for target in targets:
+        snapshot.update(filter_results(latest_results, target))
+    if snapshot:
+        socketio.emit('auto_ping', snapshot, room=request.sid)
+
+
+@socketio.on('unsubscribe')
+def on_unsubscribe(targets, token=None):
+    """Unsubscribe from minions, given as in subscribe."""
+    if current_user_id(token) is None:
+        return
+    for target in _subscription_targets(targets):
+        leave_room(SUBSCRIPTION_PREFIX + target)
+    _emit_subscriptions()
+
+
+def _emit_subscriptions():
+    """Send its subscriptions to the client."""
+    targets = sorted(room[len(SUBSCRIPTION_PREFIX):] for room in rooms()
+                     if isinstance(room, basestring) and
+                     room.startswith(SUBSCRIPTION_PREFIX))
+    socketio.emit('subscriptions', {'targets': targets}, room=request.sid)
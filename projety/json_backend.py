@@ -0,0 +1,170 @@
+"""
+Pluggable json backend.
+
+API responses, Celery messages and socket.io packets are all encoded using
+the same backend, chosen with the ``JSON_BACKEND`` setting. The fast
+libraries (orjson, ujson, rapidjson) are used when installed, the standard
+library json module is the fallback.
+"""
+from __future__ import absolute_import  # Because of json
+
+import json
+import logging
+import os
+
+from flask import current_app, request
+from flask.json import JSONEncoder
+from kombu.serialization import register
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Order used when JSON_BACKEND is 'auto'
+BACKENDS = ('orjson', 'ujson', 'rapidjson', 'json')
+
+# Name of our serializer for Celery
+CELERY_SERIALIZER = 'projety_json'
+
+
+class JsonBackend(object):
+    """
+    Wrap a json library behind a dumps/loads interface.
+
+    Extra keyword arguments (such as ``separators`` given by socket.io) are
+    ignored, output is always compact unless ``indent`` is given. Objects the
+    fast libraries can't encode are handed to the standard library, using
+    the Flask encoder.
+    """
+
+    def __init__(self, name):
+        """Import the library, raise ImportError if not installed."""
+        if name not in BACKENDS:
+            raise ValueError('Invalid json backend {0}'.format(name))
+        self.name = name
+        self._dumps, self._loads = getattr(self, '_load_' + name)()
+
+    def _load_orjson(self):
+        import orjson
+
+        def dumps(obj, indent):
+            option = orjson.OPT_NON_STR_KEYS
+            if indent:
+                option |= orjson.OPT_INDENT_2
+            return orjson.dumps(obj, option=option).decode('utf-8')
+        return dumps, orjson.loads
+
+    def _load_ujson(self):
+        import ujson
+
+        def dumps(obj, indent):
+            return ujson.dumps(obj, indent=indent or 0, ensure_ascii=False)
+        return dumps, ujson.loads
+
+    def _load_rapidjson(self):
+        import rapidjson
+
+        def dumps(obj, indent):
+            return rapidjson.dumps(obj, indent=indent, ensure_ascii=False)
+        return dumps, rapidjson.loads
+
+    def _load_json(self):
+        def dumps(obj, indent):
+            return _stdlib_dumps(obj, indent)
+        return dumps, json.loads
+
+    def dumps(self, obj, indent=None, **kwargs):
+        """Serialize obj to a json string."""
+        try:
+            return self._dumps(obj, indent)
+        except (TypeError, ValueError, OverflowError):
+            return _stdlib_dumps(obj, indent)
+
+    def loads(self, s, **kwargs):
+        """Deserialize a json string."""
+        if isinstance(s, bytearray):
+            s = bytes(s)
+        return self._loads(s)
+
+    def __repr__(self):
+        """Represent a backend."""
+        return '<JsonBackend {0}>'.format(self.name)
+
+
+def _stdlib_dumps(obj, indent=None):
+    """Encode using the standard library and the Flask encoder."""
+    if indent:
+        separators = (',', ': ')
+    else:
+        separators = (',', ':')
+    return json.dumps(obj, cls=JSONEncoder, indent=indent,
+                      separators=separators)
+
+
+def get_backend(name='auto'):
+    """Return a JsonBackend, falling back to the standard library."""
+    if name == 'auto':
+        names = BACKENDS
+    else:
+        names = (name, 'json')
+    for name in names:
+        try:
+            return JsonBackend(name)
+        except ImportError:
+            logger.warning('json backend {0} not installed'.format(name))
+
+
+# Default backend, until init_app is called with the app configuration.
+# Celery workers decode messages before any app is created, so the
+# serializer registered below always goes through this module variable.
+backend = get_backend(os.environ.get('JSON_BACKEND', 'auto'))
+
+
+def init_app(app):
+    """Install the backend configured for the app."""
+    global backend
+    backend = get_backend(app.config['JSON_BACKEND'])
+    app.extensions['json_backend'] = backend
+    logger.info('Using {0}'.format(backend))
+    return backend
+
+
+def dumps(obj, indent=None, **kwargs):
+    """Serialize using the current backend."""
+    return backend.dumps(obj, indent=indent)
+
+
+def loads(s, **kwargs):
+    """Deserialize using the current backend."""
+    return backend.loads(s)
+
+
+register(CELERY_SERIALIZER, dumps, loads,
+         content_type='application/x-projety-json',
+         content_encoding='utf-8')
+
+
+def jsonify(*args, **kwargs):
+    """
+    Replace flask.jsonify, using our backend.
+
+    Pretty print is only done when JSONIFY_PRETTYPRINT_REGULAR is set, as
+    Flask does.
+    """
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args '
+                        'and kwargs')
+    elif len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+
+    indent = None
+    if current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] and \
+            not request.is_xhr:
+        indent = 2
+    with metrics.timer('json_encode_duration_seconds'):
+        body = dumps(data, indent=indent) + '\n'
+    return current_app.response_class(
+        body,
+        mimetype=current_app.config['JSONIFY_MIMETYPE'])
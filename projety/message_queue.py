@@ -0,0 +1,119 @@
+"""
+Serializers of the socket.io message queue.
+
+Every emit of a worker or a Celery task is published on Redis for all the
+servers. python-socketio pickles these messages, ``SOCKETIO_MESSAGE_QUEUE``
+can use msgpack instead (smaller, faster, and binary data is kept as is) or
+our json backend. Servers decode the three formats, so they can be switched
+one at a time.
+"""
+from __future__ import absolute_import
+
+import logging
+import pickle
+
+import socketio
+
+from . import json_backend
+
+logger = logging.getLogger(__name__)
+
+SERIALIZERS = ('pickle', 'msgpack', 'json')
+
+# Channel used by Flask-SocketIO
+CHANNEL = 'flask-socketio'
+
+
+def _load_msgpack():
+    import msgpack
+
+    def dumps(data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(message):
+        return msgpack.unpackb(message, raw=False)
+    return dumps, loads
+
+
+def _load_pickle():
+    def dumps(data):
+        return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+    return dumps, pickle.loads
+
+
+def _load_json():
+    def dumps(data):
+        return json_backend.dumps(data).encode('utf-8')
+    return dumps, json_backend.loads
+
+
+def get_serializer(name='pickle'):
+    """Return ``(name, dumps, loads)``, falling back to pickle."""
+    if name not in SERIALIZERS:
+        raise ValueError('Invalid message queue serializer {0}'.format(name))
+    try:
+        dumps, loads = globals()['_load_' + name]()
+    except ImportError:
+        logger.warning('message queue serializer {0} not installed'.format(
+            name))
+        name = 'pickle'
+        dumps, loads = _load_pickle()
+    return name, dumps, loads
+
+
+class SerializedRedisManager(socketio.RedisManager):
+    """
+    Redis client manager publishing with a chosen serializer.
+
+    Messages are decoded with the serializer, then with the other ones, so
+    the servers still understand the workers not upgraded yet.
+
+    :param serializer: One of SERIALIZERS.
+    """
+
+    name = 'redis'
+
+    def __init__(self, url='redis://localhost:6379/0', channel=CHANNEL,
+                 write_only=False, serializer='pickle'):
+        """Init."""
+        super(SerializedRedisManager, self).__init__(
+            url, channel=channel, write_only=write_only)
+        self.serializer, self.dumps, self.loads = get_serializer(serializer)
+        self.decoders = [self.loads]
+        for name in SERIALIZERS:
+            if name != self.serializer:
+                loaded = get_serializer(name)
+                if loaded[0] == name:
+                    self.decoders.append(loaded[2])
+
+    def _publish(self, data):
+        return self.redis.publish(self.channel, self.dumps(data))
+
+    def decode(self, message):
+        """Return the message as a dict, None if it can't be decoded."""
+        for loads in self.decoders:
+            try:
+                data = loads(message)
+            except Exception:
+                continue
+            if isinstance(data, dict):
+                return data
+        return None
+
+    def _listen(self):
+        for message in super(SerializedRedisManager, self)._listen():
+            data = self.decode(message)
+            if data is None:
+                logger.warning('Dropping undecodable socket.io message')
+                continue
+            yield data
+
+
+def socketio_options(app, write_only=False):
+    """Return the message queue arguments of SocketIO.init_app."""
+    url = app.config['SOCKETIO_MESSAGE_QUEUE']
+    if not url or not url.startswith('redis://'):
+        return {'message_queue': url}
+    return {'client_manager': SerializedRedisManager(
+        url, channel=CHANNEL, write_only=write_only,
+        serializer=app.config['SOCKETIO_MESSAGE_QUEUE_SERIALIZER'])}
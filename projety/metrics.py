@@ -0,0 +1,380 @@
+"""
+Metrics of the API, in the Prometheus text format.
+
+Every process (web workers, Celery workers) records its own counters and
+histograms. With ``METRICS_STORE = 'redis'`` each one publishes a snapshot
+to Redis every ``METRICS_PUBLISH_INTERVAL`` seconds, and ``/api/metrics``
+returns the series of all of them with a ``worker`` label, so the scrape
+doesn't depend on the worker that answers. Sum them in the queries, after
+``rate()``: the series of a process end when its snapshot expires, a total
+summed here would instead go down and look like a counter reset.
+
+Recorded:
+
+- ``http_request_duration_seconds`` and ``http_requests_total``, by route
+- ``auth_duration_seconds`` by scheme, ``db_query_duration_seconds`` and
+  ``json_encode_duration_seconds``, parts of the request time
+- ``salt_job_duration_seconds`` and ``salt_job_timeouts_total``, by function
+- ``cache_requests_total``, hits and misses of the salt caches
+- ``celery_queue_wait_seconds``, from the publication to the start of tasks
+- the ``wsproxy_*`` metrics of the remote control proxy
+"""
+from __future__ import absolute_import
+
+import contextlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from celery.signals import before_task_publish, task_prerun
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .wsproxy.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Header of the Celery messages giving their publication time
+SENT_AT_HEADER = 'projety_sent_at'
+
+HELP = {
+    'http_request_duration_seconds': 'Duration of the API requests.',
+    'http_requests_total': 'API requests answered.',
+    'auth_duration_seconds': 'Duration of the authentication.',
+    'db_query_duration_seconds': 'Duration of the SQL queries.',
+    'json_encode_duration_seconds': 'Duration of the json encoding.',
+    'salt_job_duration_seconds': 'Duration of the salt jobs.',
+    'salt_job_timeouts_total': 'Salt jobs without an answer of the minion.',
+    'cache_requests_total': 'Reads of the salt caches.',
+    'celery_queue_wait_seconds': 'Time the tasks waited in the queue.',
+}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Metrics(object):
+    """Flask extension keeping the metrics of the process."""
+
+    def __init__(self, app=None):
+        """Init."""
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = {}
+        self.store = None
+        self.interval = 10
+        self.published_at = 0
+        self.failing = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, store=None):
+        """Time the requests, and create the configured store."""
+        config = app.config
+        if store is None and config['METRICS_STORE'] == 'redis':
+            store = RedisMetricsStore.from_url(
+                config['METRICS_STORE_URL'],
+                ttl=3 * config['METRICS_PUBLISH_INTERVAL'])
+        self.store = store
+        self.interval = config['METRICS_PUBLISH_INTERVAL']
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        # Signals and events are global, connecting twice is a no-op
+        before_task_publish.connect(on_task_publish)
+        task_prerun.connect(on_task_prerun)
+        if not event.contains(Engine, 'before_cursor_execute',
+                              on_before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute',
+                         on_before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         on_after_cursor_execute)
+        app.extensions['metrics'] = self
+
+    @property
+    def worker(self):
+        """Return the name of the process, read after gunicorn forks."""
+        return '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+    def inc(self, name, value=1, **labels):
+        """Add to a counter."""
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.maybe_publish()
+
+    def observe(self, name, value, **labels):
+        """Add a value to a histogram."""
+        key = _key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(
+                    LATENCY_BUCKETS)
+            histogram.observe(value)
+        self.maybe_publish()
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observe the duration of a block."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def add_collector(self, name, collector):
+        """Set a callable returning samples read at snapshot time."""
+        self.collectors[name] = collector
+
+    def _before_request(self):
+        g.metrics_start = time.time()
+
+    def _after_request(self, response):
+        start = getattr(g, 'metrics_start', None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else 'unknown'
+            self.observe('http_request_duration_seconds',
+                         time.time() - start, route=route,
+                         method=request.method)
+            self.inc('http_requests_total', route=route,
+                     method=request.method, status=response.status_code)
+        return response
+
+    def snapshot(self):
+        """Return the metrics of the process, as json."""
+        with self.lock:
+            counters = [[name, dict(labels), value]
+                        for (name, labels), value in self.counters.items()]
+            histograms = [[name, dict(labels), histogram.to_dict()]
+                          for (name, labels), histogram
+                          in self.histograms.items()]
+        snapshot = {'help': dict(HELP), 'counters': counters, 'gauges': [],
+                    'histograms': histograms}
+        for collector in self.collectors.values():
+            try:
+                samples = collector()
+            except Exception:
+                logger.exception('Metrics collector failed')
+                continue
+            snapshot['help'].update(samples.get('help', {}))
+            for kind in ('counters', 'gauges', 'histograms'):
+                snapshot[kind].extend(samples.get(kind, []))
+        return snapshot
+
+    def maybe_publish(self, force=False):
+        """Publish the snapshot to the store, at most once per interval."""
+        if self.store is None:
+            return
+        now = time.time()
+        if not force and now - self.published_at < self.interval:
+            return
+        self.published_at = now
+        try:
+            self.store.publish(self.worker, self.snapshot())
+        except Exception:
+            # Logged once, not at every interval while the store is down
+            if not self.failing:
+                logger.exception('Cannot publish the metrics')
+            self.failing = True
+            return
+        if self.failing:
+            logger.info('Publishing the metrics again')
+            self.failing = False
+
+    def collect(self):
+        """Return the snapshots of all the processes."""
+        if self.store is None:
+            return [self.snapshot()]
+        self.maybe_publish(force=True)
+        try:
+            return self.store.snapshots()
+        except Exception:
+            logger.exception('Cannot read the metrics, using ours only')
+            return [dict(self.snapshot(), worker=self.worker)]
+
+    def exposition(self):
+        """Return the metrics of all the processes in the text format."""
+        return exposition(merge(self.collect()))
+
+
+class RedisMetricsStore(object):
+    """
+    Keep the snapshot of every process in Redis.
+
+    Each process sets ``<prefix><worker>`` to its snapshot as json, with a
+    ``ttl`` so the snapshots of dead processes disappear, and adds itself to
+    the ``<prefix>workers`` set. Readers drop the workers whose snapshot
+    expired from the set.
+
+    :param redis: A ``redis.StrictRedis`` client (or a compatible object).
+    """
+
+    def __init__(self, redis, prefix='projety:metrics:', ttl=30):
+        """Init."""
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+
+    @classmethod
+    def from_url(cls, url, socket_timeout=0.5, **kwargs):
+        """
+        Create a store connected to a Redis url.
+
+        Publishing happens during requests, ``socket_timeout`` bounds their
+        wait when Redis is down.
+        """
+        import redis
+        return cls(redis.StrictRedis.from_url(
+            url, socket_timeout=socket_timeout,
+            socket_connect_timeout=socket_timeout), **kwargs)
+
+    @property
+    def _workers_key(self):
+        return self.prefix + 'workers'
+
+    def publish(self, worker, snapshot):
+        """Store the snapshot of a process."""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(self.prefix + worker, json.dumps(dict(snapshot,
+                                                       worker=worker)),
+                 ex=self.ttl)
+        pipe.sadd(self._workers_key, worker)
+        pipe.execute()
+
+    def snapshots(self):
+        """Return the snapshots of all the processes."""
+        workers = [w.decode('utf-8') if isinstance(w, bytes) else w
+                   for w in self.redis.smembers(self._workers_key)]
+        if not workers:
+            return []
+        snapshots = []
+        gone = []
+        for worker, raw in zip(workers, self.redis.mget(
+                [self.prefix + worker for worker in workers])):
+            if raw is None:
+                gone.append(worker)
+                continue
+            if isinstance(raw, bytes):
+                raw = raw.decode('utf-8')
+            snapshots.append(json.loads(raw))
+        if gone:
+            self.redis.srem(self._workers_key, *gone)
+        return snapshots
+
+
+def merge(snapshots):
+    """
+    Gather the snapshots of many processes in one.
+
+    Snapshots of a store have a ``worker``, added as a label of their
+    series. Series with the same labels are summed.
+    """
+    merged = {'help': {}, 'counters': {}, 'gauges': {}, 'histograms': {}}
+    for snapshot in snapshots:
+        merged['help'].update(snapshot.get('help', {}))
+        extra = {}
+        if snapshot.get('worker'):
+            extra['worker'] = snapshot['worker']
+        for kind in ('counters', 'gauges'):
+            for name, labels, value in snapshot.get(kind, []):
+                key = _key(name, dict(labels, **extra))
+                merged[kind][key] = merged[kind].get(key, 0) + value
+        for name, labels, histogram in snapshot.get('histograms', []):
+            key = _key(name, dict(labels, **extra))
+            total = merged['histograms'].get(key)
+            if total is None:
+                merged['histograms'][key] = {
+                    'buckets': [list(b) for b in histogram['buckets']],
+                    'sum': histogram['sum'],
+                    'count': histogram['count']}
+                continue
+            counts = dict((bound, count)
+                          for bound, count in histogram['buckets'])
+            for bucket in total['buckets']:
+                bucket[1] += counts.get(bucket[0], 0)
+            total['sum'] += histogram['sum']
+            total['count'] += histogram['count']
+    return merged
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in pairs) + '}'
+
+
+def exposition(merged):
+    """Format merged snapshots in the Prometheus text format."""
+    lines = []
+    families = {}
+    for kind, type_ in (('counters', 'counter'), ('gauges', 'gauge'),
+                        ('histograms', 'histogram')):
+        for key in merged[kind]:
+            families.setdefault(key[0], (kind, type_))
+
+    for name in sorted(families):
+        kind, type_ = families[name]
+        lines.append('# HELP {0} {1}'.format(
+            name, merged['help'].get(name, name.replace('_', ' ') + '.')))
+        lines.append('# TYPE {0} {1}'.format(name, type_))
+        for (family, labels), value in sorted(merged[kind].items()):
+            if family != name:
+                continue
+            if kind != 'histograms':
+                lines.append('{0}{1} {2}'.format(name, _labels(labels),
+                                                 value))
+                continue
+            for bound, count in value['buckets']:
+                lines.append('{0}_bucket{1} {2}'.format(
+                    name, _labels(labels, [('le', bound)]), count))
+            lines.append('{0}_sum{1} {2}'.format(name, _labels(labels),
+                                                 value['sum']))
+            lines.append('{0}_count{1} {2}'.format(name, _labels(labels),
+                                                   value['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def on_before_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+    """Start timing a query, on a SQLAlchemy event."""
+    context._metrics_start = time.time()
+
+
+def on_after_cursor_execute(conn, cursor, statement, parameters, context,
+                            executemany):
+    """Observe the duration of a query, on a SQLAlchemy event."""
+    start = getattr(context, '_metrics_start', None)
+    if start is not None:
+        metrics.observe('db_query_duration_seconds', time.time() - start)
+
+
+def on_task_publish(headers=None, **kwargs):
+    """Stamp the Celery messages with their publication time."""
+    if headers is not None:
+        headers[SENT_AT_HEADER] = time.time()
+
+
+def on_task_prerun(task=None, **kwargs):
+    """Observe the time a Celery task waited in the queue."""
+    headers = getattr(task.request, 'headers', None) or {}
+    sent_at = headers.get(SENT_AT_HEADER)
+    if sent_at is not None:
+        metrics.observe('celery_queue_wait_seconds',
+                        max(0, time.time() - sent_at), task=task.name)
+
+
+# Metrics of this process, installed on the apps by create_app
+metrics = Metrics()
@@ -7,8 +7,9 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import (TimedJSONWebSignatureSerializer
                           as Serializer, BadSignature, SignatureExpired)
 
-from . import db
-from .utils import timestamp, url_for
+from . import db, offloader
+from .utils import timestamp
+from .serializers import current_links
 
 
 class Acl(db.Model):
@@ -22,18 +23,20 @@ class Acl(db.Model):
     functions = db.Column(db.String(256), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
 
-    def to_dict(self):
+    def to_dict(self, links=None):
         """Export user to a dictionary."""
+        if links is None:
+            links = current_links()
         return {
             'id': self.id,
             'minions': self.minions,
             'functions': self.functions,
             'user_id': self.user_id,
             '_links': {
-                'self': url_for('api.get_acl',
-                                user_id=self.user_id,
-                                acl_id=self.id),
-                'user': url_for('api.get_user', id=self.user_id),
+                'self': links('api.get_acl',
+                              user_id=self.user_id,
+                              acl_id=self.id),
+                'user': links('api.get_user', id=self.user_id),
             }
         }
 
@@ -46,17 +49,19 @@ class Role(db.Model):
     name = db.Column(db.String(256), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
 
-    def to_dict(self):
+    def to_dict(self, links=None):
         """Export user to a dictionary."""
+        if links is None:
+            links = current_links()
         return {
             'id': self.id,
             'name': self.name,
             'user_id': self.user_id,
             '_links': {
-                'self': url_for('api.get_role',
-                                user_id=self.user_id,
-                                role_id=self.id),
-                'user': url_for('api.get_user', id=self.user_id),
+                'self': links('api.get_role',
+                              user_id=self.user_id,
+                              role_id=self.id),
+                'user': links('api.get_user', id=self.user_id),
             }
         }
 
@@ -85,15 +90,30 @@ class User(db.Model):
 
     def verify_password(self, password):
         """For basic_auth check."""
-        return check_password_hash(self.password_hash, password)
+        # PBKDF2 would block the event loop, run it in the thread pool
+        return offloader.run(check_password_hash, self.password_hash,
+                             password)
 
     def generate_auth_token(self, expiration=600):
         """Generate a token on the fly."""
         s = Serializer(current_app.config['SECRET_KEY'], expires_in=expiration)
         expiration_date = int(time.time()) + expiration
-        token = s.dumps({'id': self.id, 'expiration': expiration_date})
+        token = offloader.run(s.dumps, {'id': self.id,
+                                        'expiration': expiration_date})
         return token
 
+    @staticmethod
+    def load_auth_token(token):
+        """Return ``(user id, expiration timestamp)``, None if invalid."""
+        s = Serializer(current_app.config['SECRET_KEY'])
+        try:
+            data, header = s.loads(token, return_header=True)
+        except SignatureExpired:
+            return None  # valid token, but expired
+        except BadSignature:
+            return None  # invalid token
+        return data['id'], header['exp']
+
     @staticmethod
     def verify_auth_token(token):
         """
@@ -102,14 +122,10 @@ class User(db.Model):
         In case where the token raise SignatureExpired, null the token
         property for the user.
         """
-        s = Serializer(current_app.config['SECRET_KEY'])
-        try:
-            data = s.loads(token)
-        except SignatureExpired:
-            return None  # valid token, but expired
-        except BadSignature:
-            return None  # invalid token
-        user = User.query.get(data['id'])
+        loaded = User.load_auth_token(token)
+        if loaded is None:
+            return None
+        user = User.query.get(loaded[0])
         return user
 
     @staticmethod
@@ -150,8 +166,10 @@ class User(db.Model):
             data.append({minion: functions})
         return data
 
-    def to_dict(self):
+    def to_dict(self, links=None):
         """Export user to a dictionary."""
+        if links is None:
+            links = current_links()
         return {
             'id': self.id,
             'created_at': self.created_at,
@@ -159,8 +177,8 @@ class User(db.Model):
             'nickname': self.nickname,
             'last_seen_at': self.last_seen_at,
             '_links': {
-                'self': url_for('api.get_user', id=self.id),
-                'acls': url_for('api.get_acls', user_id=self.id),
-                'tokens': url_for('api.new_token')
+                'self': links('api.get_user', id=self.id),
+                'acls': links('api.get_acls', user_id=self.id),
+                'tokens': links('api.new_token')
             }
         }
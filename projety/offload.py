@@ -0,0 +1,63 @@
+"""
+Run CPU heavy work outside of the event loop.
+
+With eventlet or gevent all the sockets of a worker are served by one
+thread, a password hash (PBKDF2) computed in a handler blocks every other
+client meanwhile. The Offloader runs such functions in the native thread
+pool of the async library, the caller only waits for its result. A
+semaphore limits how many run at once, so a login storm can't take the
+whole pool. With threading, functions are run in the calling thread, still
+limited by the semaphore.
+"""
+from __future__ import absolute_import
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def _call(func, *args, **kwargs):
+    return func(*args, **kwargs)
+
+
+class Offloader(object):
+    """Flask extension running functions in a bounded native thread pool."""
+
+    def __init__(self, app=None, async_mode=None):
+        """Init."""
+        self.async_mode = 'threading'
+        self.semaphore = None
+        self._execute = _call
+        if app is not None:
+            self.init_app(app, async_mode)
+
+    def init_app(self, app, async_mode=None):
+        """Use the thread pool of the async mode, eventlet or gevent."""
+        self.async_mode = async_mode or 'threading'
+        max_concurrency = app.config['LOGIN_MAX_CONCURRENCY']
+        if self.async_mode == 'eventlet':
+            from eventlet import tpool
+            from eventlet.semaphore import Semaphore
+            self._execute = tpool.execute
+        elif self.async_mode == 'gevent':
+            import gevent
+            from gevent.lock import Semaphore
+
+            def execute(func, *args, **kwargs):
+                pool = gevent.get_hub().threadpool
+                return pool.apply(func, args, kwargs)
+            self._execute = execute
+        else:
+            Semaphore = threading.Semaphore
+            self._execute = _call
+        self.semaphore = Semaphore(max_concurrency) \
+            if max_concurrency else None
+        app.extensions['offloader'] = self
+
+    def run(self, func, *args, **kwargs):
+        """Return the result of a function, run in the thread pool."""
+        if self.semaphore is None:
+            return self._execute(func, *args, **kwargs)
+        with self.semaphore:
+            return self._execute(func, *args, **kwargs)
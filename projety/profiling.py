@@ -0,0 +1,260 @@
+"""
+Profiling of single requests, on demand of an admin.
+
+A request of an admin with the ``X-Profile: 1`` header runs under cProfile,
+and its SQL queries are counted and timed. The report is kept and its id
+returned in the ``X-Profile-Id`` header, to be read at
+``/api/v1.0/profiles/<id>``. The view authenticates the user only after
+the profiler started, so the bearer token is checked first: requests of
+other users, or authenticated with a password, are not profiled.
+
+cProfile sees the whole thread: with eventlet, the greenlets running during
+the request are in the report too. The thread has a single
+``sys.setprofile`` hook, so two profiled requests running at the same time
+on it replace each other's profiler.
+"""
+from __future__ import absolute_import
+
+import collections
+import cProfile
+import logging
+import pstats
+import threading
+import time
+import uuid
+
+from flask import g, request
+from six import StringIO
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from . import json_backend
+from .permissions import AdminPermission
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'X-Profile'
+ID_HEADER = 'X-Profile-Id'
+
+# Lines of the cProfile report, and queries kept in a profile
+STATS_LINES = 40
+MAX_QUERIES = 100
+
+
+class MemoryProfileStore(object):
+    """Keep the last profiles in the memory of the current process."""
+
+    def __init__(self, size=50, ttl=3600):
+        """Init."""
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.profiles = collections.OrderedDict()
+
+    def add(self, profile):
+        """Keep a profile, dropping the oldest."""
+        with self.lock:
+            self.profiles[profile['id']] = (time.time() + self.ttl, profile)
+            while len(self.profiles) > self.size:
+                self.profiles.popitem(last=False)
+
+    def get(self, profile_id):
+        """Return a profile, or None."""
+        with self.lock:
+            deadline, profile = self.profiles.get(profile_id, (0, None))
+        if deadline > time.time():
+            return profile
+        return None
+
+    def recent(self):
+        """Return the kept profiles, newest first."""
+        now = time.time()
+        with self.lock:
+            return [profile for deadline, profile
+                    in reversed(list(self.profiles.values()))
+                    if deadline > now]
+
+
+class RedisProfileStore(object):
+    """
+    Keep the last profiles in Redis, to read them from any worker.
+
+    Keys used, under ``prefix``:
+
+    - ``<id>``: the profile as json
+    - ``recent``: list of the ids, newest first
+
+    :param redis: A ``redis.StrictRedis`` client (or a compatible object).
+    """
+
+    def __init__(self, redis, prefix='projety:profiles:', size=50,
+                 ttl=3600):
+        """Init."""
+        self.redis = redis
+        self.prefix = prefix
+        self.size = size
+        self.ttl = ttl
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        """Create a store connected to a Redis url."""
+        import redis
+        return cls(redis.StrictRedis.from_url(url), **kwargs)
+
+    def add(self, profile):
+        """Keep a profile, dropping the oldest."""
+        recent = self.prefix + 'recent'
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.set(self.prefix + profile['id'], json_backend.dumps(profile),
+                 ex=self.ttl)
+        pipe.lpush(recent, profile['id'])
+        pipe.ltrim(recent, 0, self.size - 1)
+        pipe.expire(recent, self.ttl)
+        pipe.execute()
+
+    def get(self, profile_id):
+        """Return a profile, or None."""
+        raw = self.redis.get(self.prefix + profile_id)
+        if raw is None:
+            return None
+        return json_backend.loads(raw)
+
+    def recent(self):
+        """Return the kept profiles, newest first."""
+        ids = self.redis.lrange(self.prefix + 'recent', 0, -1)
+        if not ids:
+            return []
+        keys = [self.prefix + (i.decode('utf-8') if isinstance(i, bytes)
+                               else i) for i in ids]
+        return [json_backend.loads(raw) for raw in self.redis.mget(keys)
+                if raw is not None]
+
+
+class RequestProfiler(object):
+    """Flask extension profiling the requests asking for it."""
+
+    def __init__(self, app=None):
+        """Init."""
+        self.store = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, store=None):
+        """Install the request hooks, and create the configured store."""
+        config = app.config
+        if store is None:
+            kwargs = {'size': config['PROFILE_STORE_SIZE'],
+                      'ttl': config['PROFILE_TTL']}
+            if config['PROFILE_STORE'] == 'redis':
+                store = RedisProfileStore.from_url(
+                    config['PROFILE_STORE_URL'], **kwargs)
+            else:
+                store = MemoryProfileStore(**kwargs)
+        self.store = store
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        if not event.contains(Engine, 'before_cursor_execute',
+                              on_before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute',
+                         on_before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         on_after_cursor_execute)
+        app.extensions['profiler'] = self
+
+    def _before_request(self):
+        if request.headers.get(HEADER) != '1' or not _is_admin():
+            return
+        g.profile = {'start': time.time(), 'queries': [], 'sql_count': 0,
+                     'sql_time': 0.0, 'profiler': cProfile.Profile()}
+        g.profile['profiler'].enable()
+
+    def _after_request(self, response):
+        state = g.pop('profile', None)
+        if state is None:
+            return response
+        state['profiler'].disable()
+        # The view may have authenticated another user than the token
+        if not AdminPermission().can():
+            return response
+
+        profile = self.report(state, response)
+        try:
+            self.store.add(profile)
+        except Exception:
+            logger.exception('Cannot keep the profile of %s', request.path)
+            return response
+        response.headers[ID_HEADER] = profile['id']
+        return response
+
+    def _teardown_request(self, exc=None):
+        # Requests ending with an exception don't reach after_request
+        state = getattr(g, 'profile', None)
+        if state is not None:
+            state['profiler'].disable()
+
+    def report(self, state, response):
+        """Return the profile of the current request."""
+        stream = StringIO()
+        stats = pstats.Stats(state['profiler'], stream=stream)
+        stats.sort_stats('cumulative').print_stats(STATS_LINES)
+        return {'id': uuid.uuid4().hex,
+                'date': time.time(),
+                'method': request.method,
+                'path': request.full_path.rstrip('?'),
+                'endpoint': request.endpoint,
+                'status': response.status_code,
+                'duration': time.time() - state['start'],
+                'sql_count': state['sql_count'],
+                'sql_time': state['sql_time'],
+                'queries': state['queries'],
+                'stats': stream.getvalue()}
+
+    def get(self, profile_id):
+        """Return a kept profile, or None."""
+        return self.store.get(profile_id)
+
+    def recent(self):
+        """Return the kept profiles, newest first."""
+        return self.store.recent()
+
+
+def _is_admin():
+    """Return whether the bearer token of the request is an admin's."""
+    from .models import User
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme != 'Bearer' or not token:
+        return False
+    user = User.verify_auth_token(token.strip())
+    return user is not None and any(role.name == 'admin'
+                                    for role in user.roles)
+
+
+def _current_profile():
+    try:
+        return getattr(g, 'profile', None)
+    except RuntimeError:
+        # Queries outside of an app context
+        return None
+
+
+def on_before_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+    """Start timing a query of a profiled request."""
+    if _current_profile() is not None:
+        context._profile_start = time.time()
+
+
+def on_after_cursor_execute(conn, cursor, statement, parameters, context,
+                            executemany):
+    """Count and time a query of a profiled request."""
+    state = _current_profile()
+    start = getattr(context, '_profile_start', None)
+    if state is None or start is None:
+        return
+    duration = time.time() - start
+    state['sql_count'] += 1
+    state['sql_time'] += duration
+    if len(state['queries']) < MAX_QUERIES:
+        state['queries'].append({'statement': statement,
+                                 'duration': duration})
@@ -0,0 +1,179 @@
+"""
+Replay of the socket.io job results missed by reconnecting clients.
+
+A ``job_result`` is emitted to the sid that started the job, if the browser
+reconnected meanwhile it has a new sid and the result is lost. The last
+results of each user are kept, and a client sends ``resume`` with the jids
+it still waits for: the results already there are emitted again, and the
+jobs still running will emit their result to the new sid.
+
+A result can be delivered twice if the job ends during the resume, clients
+ignore the jids they already have.
+"""
+from __future__ import absolute_import
+
+import collections
+import logging
+import threading
+import time
+
+from . import json_backend
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryReplayStore(object):
+    """
+    Keep the results in the memory of the current process.
+
+    Only works when the Celery tasks and the socket.io server run in the
+    same process, as in tests.
+    """
+
+    def __init__(self, size=50, ttl=3600):
+        """Init."""
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.results = {}
+        self.redirects = {}
+
+    def add(self, user_id, data):
+        """Keep a result, dropping the oldest of the user."""
+        with self.lock:
+            results = self.results.get(user_id)
+            if results is None:
+                results = self.results[user_id] = collections.deque(
+                    maxlen=self.size)
+            results.append((time.time() + self.ttl, dict(data)))
+
+    def find(self, user_id, jids):
+        """Return the results of some jids, oldest first."""
+        now = time.time()
+        with self.lock:
+            return [dict(data)
+                    for deadline, data in self.results.get(user_id, ())
+                    if deadline > now and data.get('jid') in jids]
+
+    def redirect(self, user_id, jid, sid):
+        """Send the result of a running job to another sid."""
+        with self.lock:
+            self.redirects[(user_id, jid)] = (time.time() + self.ttl, sid)
+
+    def target(self, user_id, jid):
+        """Return the sid a job result was redirected to, or None."""
+        with self.lock:
+            deadline, sid = self.redirects.pop((user_id, jid), (0, None))
+        if deadline > time.time():
+            return sid
+        return None
+
+
+class RedisReplayStore(object):
+    """
+    Keep the results in Redis, to share them between all the workers.
+
+    Keys used, under ``prefix``:
+
+    - ``results:<user id>``: list of the results as json, newest first
+    - ``resume:<user id>:<jid>``: the sid a running job was redirected to
+
+    Every key expires ``ttl`` seconds after its last update.
+
+    :param redis: A ``redis.StrictRedis`` client (or a compatible object).
+    """
+
+    def __init__(self, redis, prefix='projety:replay:', size=50, ttl=3600):
+        """Init."""
+        self.redis = redis
+        self.prefix = prefix
+        self.size = size
+        self.ttl = ttl
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        """Create a store connected to a Redis url."""
+        import redis
+        return cls(redis.StrictRedis.from_url(url), **kwargs)
+
+    def _results_key(self, user_id):
+        return '{0}results:{1}'.format(self.prefix, user_id)
+
+    def _resume_key(self, user_id, jid):
+        return '{0}resume:{1}:{2}'.format(self.prefix, user_id, jid)
+
+    def add(self, user_id, data):
+        """Keep a result, dropping the oldest of the user."""
+        key = self._results_key(user_id)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.lpush(key, json_backend.dumps(data))
+        pipe.ltrim(key, 0, self.size - 1)
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def find(self, user_id, jids):
+        """Return the results of some jids, oldest first."""
+        results = []
+        for raw in reversed(self.redis.lrange(self._results_key(user_id),
+                                              0, -1)):
+            data = json_backend.loads(raw)
+            if data.get('jid') in jids:
+                results.append(data)
+        return results
+
+    def redirect(self, user_id, jid, sid):
+        """Send the result of a running job to another sid."""
+        self.redis.set(self._resume_key(user_id, jid), sid, ex=self.ttl)
+
+    def target(self, user_id, jid):
+        """Return the sid a job result was redirected to, or None."""
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.get(self._resume_key(user_id, jid))
+        pipe.delete(self._resume_key(user_id, jid))
+        sid = pipe.execute()[0]
+        if isinstance(sid, bytes):
+            sid = sid.decode('utf-8')
+        return sid
+
+
+class JobReplay(object):
+    """Flask extension keeping the job results of every user."""
+
+    def __init__(self, app=None):
+        """Init."""
+        self.store = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, store=None):
+        """Create the store configured with JOB_REPLAY_STORE."""
+        config = app.config
+        if store is None:
+            kwargs = {'size': config['JOB_REPLAY_SIZE'],
+                      'ttl': config['JOB_REPLAY_TTL']}
+            if config['JOB_REPLAY_STORE'] == 'redis':
+                store = RedisReplayStore.from_url(
+                    config['JOB_REPLAY_STORE_URL'], **kwargs)
+            else:
+                store = MemoryReplayStore(**kwargs)
+        self.store = store
+        app.extensions['job_replay'] = self
+
+    def record(self, user_id, sid, data):
+        """Keep a result, return the sid it must be emitted to."""
+        if user_id is None or self.store is None:
+            return sid
+        try:
+            self.store.add(user_id, data)
+            return self.store.target(user_id, data['jid']) or sid
+        except Exception:
+            # Losing the replay must not lose the result itself
+            logger.exception('Cannot keep the result of job %s',
+                             data.get('jid'))
+            return sid
+
+    def resume(self, user_id, jids, sid):
+        """Return the results of the jids, redirect the others to a sid."""
+        for jid in jids:
+            self.store.redirect(user_id, jid, sid)
+        return self.store.find(user_id, jids)
@@ -2,19 +2,14 @@
 from __future__ import absolute_import  # Because module name == salt
 
 import logging
-
-import salt.config
-import salt.wheel
-import salt.client
-import salt.runner
-import salt.utils.minions
+import os
+import time
 
 from flask import request, g
 from .exceptions import (ValidationError, SaltMinionError, SaltError,
                          SaltACLError)
-
-# Global salt variable
-opts = salt.config.master_config('/etc/salt/master')
+from .metrics import metrics
+from .salt_backends import get_backend
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +17,41 @@ logger = logging.getLogger(__name__)
 minions = {}
 functions = {}
 
+# Execution backend, until init_app is called with the app configuration
+backend = get_backend(os.environ.get('SALT_BACKEND', 'salt'))
+_backends = {}
+
+
+def init_app(app):
+    """Install the backend configured for the app."""
+    global backend
+    config = app.config
+    if config['SALT_BACKEND'] == 'simulated':
+        settings = (('minions', config['SALT_SIMULATED_MINIONS']),
+                    ('latency', config['SALT_SIMULATED_LATENCY']),
+                    ('distribution',
+                     config['SALT_SIMULATED_DISTRIBUTION']),
+                    ('failure_rate', config['SALT_SIMULATED_FAILURE_RATE']),
+                    ('functions', config['SALT_SIMULATED_FUNCTIONS']),
+                    ('seed', config['SALT_SIMULATED_SEED']))
+    else:
+        settings = (('master_config', config['SALT_MASTER_CONFIG']),)
+
+    # Apps of the same process share a backend, the simulated jobs of the
+    # API are then seen by the Celery tasks run eagerly
+    key = (config['SALT_BACKEND'],) + tuple(
+        (name, tuple(value) if isinstance(value, list) else value)
+        for name, value in settings)
+    if key not in _backends:
+        _backends[key] = get_backend(config['SALT_BACKEND'], **dict(settings))
+    if backend is not _backends[key]:
+        backend = _backends[key]
+        minions.clear()
+        functions.clear()
+    app.extensions['salt_backend'] = backend
+    logger.info('Using {0}'.format(backend))
+    return backend
+
 
 def ping_one(minion):
     """Return a simple test.ping."""
@@ -32,6 +62,13 @@ def ping_one(minion):
     return {minion: result}
 
 
+def ping_many(minions):
+    """Return the test.ping of a list of minions, using a single job."""
+    job = Job(only_one=False, bypass_check=True)
+    result = job.run(','.join(minions), 'test.ping', expr_form='list')
+    return dict((minion, result.get(minion) or False) for minion in minions)
+
+
 def ping():
     """Return the simple test.ping but can be on a list."""
     data = request.json
@@ -73,10 +110,11 @@ def get_minions(type='minions', use_cache=True):
     """
     global minions
     if use_cache and type in minions:
+        metrics.inc('cache_requests_total', cache='minions', result='hit')
         return minions[type]
 
-    wheel = salt.wheel.WheelClient(opts)
-    keys = wheel.cmd('key.list_all')
+    metrics.inc('cache_requests_total', cache='minions', result='miss')
+    keys = backend.list_keys()
     if type not in keys:
         raise SaltError('no key {0} in key.list_all'.format(type))
     minions[type] = keys[type]
@@ -94,8 +132,10 @@ def get_minion_functions(minion):
     """
     global functions
     if minion in functions:
+        metrics.inc('cache_requests_total', cache='functions', result='hit')
         return functions[minion]
 
+    metrics.inc('cache_requests_total', cache='functions', result='miss')
     # no functions, build cache
     job = Job()
     result = job.run(minion, 'sys.list_functions')
@@ -114,18 +154,11 @@ def is_task_allowed(tgt, fun, arg, tgt_type):
         logger.warning('This is weird, we should have a user here.')
         raise SaltACLError(tgt, fun, arg)
 
-    checker = salt.utils.minions.CkMinions(opts)
     auth_list = g.current_user.get_salt_acl()
     logger.debug('auth_list for {0}'.format(g.current_user.nickname))
     logger.debug(auth_list)
     logger.debug('fun {0} tgt {1}'.format(fun, tgt))
-    data = {
-        'auth_list': auth_list,
-        'funs': str(fun),
-        'args': arg,
-        'tgt': str(tgt),
-        'tgt_type': tgt_type}
-    return checker.auth_check(**data)
+    return backend.auth_check(auth_list, str(fun), arg, str(tgt), tgt_type)
 
     # if task not in ['test.ping', 'sys.doc', 'sys.list_functions',
     #                 'remote_control.create_ssh_connection',
@@ -171,16 +204,16 @@ class Job(object):
 
         # We might want to run async request
         function = None
-        client = salt.client.get_local_client()
         if self.async:
-            function = client.cmd_async
+            function = backend.cmd_async
         else:
-            function = client.cmd
+            function = backend.cmd
 
         info = 'launching {0} on {1}, '.format(fun, tgt) + \
                'using args {0}, '.format(str(arg)) + \
                'targeting using {0}'.format(expr_form)
         logger.info(info)
+        start = time.time()
         result = function(tgt, fun,
                           arg=arg,
                           timeout=timeout,
@@ -189,6 +222,8 @@ class Job(object):
                           jid=jid,
                           kwarg=kwarg,
                           **kwargs)
+        metrics.observe('salt_job_duration_seconds', time.time() - start,
+                        function=fun)
 
         logger.debug('result is {0}'.format(result))
         if self.async:
@@ -197,7 +232,14 @@ class Job(object):
         # If only one, perform additional check
         if self.only_one:
             if tgt not in result:
+                metrics.inc('salt_job_timeouts_total', function=fun)
                 raise SaltMinionError(tgt)
             else:
                 return result[tgt]
+        if expr_form == 'list':
+            missing = set(tgt.split(',') if isinstance(tgt, basestring)
+                          else tgt).difference(result)
+            if missing:
+                metrics.inc('salt_job_timeouts_total', len(missing),
+                            function=fun)
         return result
@@ -0,0 +1,273 @@
+"""
+Execution backends behind :mod:`projety.salt`.
+
+``SALT_BACKEND`` chooses how jobs run:
+
+- ``salt``: the local salt master, salt is only imported when first used.
+- ``simulated``: an in-process fake master, with thousands of minions, a
+  catalog of functions and random latencies and failures. It needs no salt
+  installation, for tests and load tests on a laptop. Its jobs only live in
+  the current process, run Celery eagerly with it.
+"""
+from __future__ import absolute_import  # Because of salt
+
+import datetime
+import fnmatch
+import logging
+import random
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('salt', 'simulated')
+
+
+class SaltBackend(object):
+    """
+    Run the jobs on the local salt master.
+
+    :param master_config: Path of the salt master configuration.
+    """
+
+    def __init__(self, master_config='/etc/salt/master'):
+        """Init."""
+        self.master_config = master_config
+        self._opts = None
+
+    @property
+    def opts(self):
+        """Return the master configuration, loaded on first use."""
+        if self._opts is None:
+            import salt.config
+            self._opts = salt.config.master_config(self.master_config)
+        return self._opts
+
+    def _client(self):
+        import salt.client
+        return salt.client.get_local_client(self.master_config)
+
+    def cmd(self, tgt, fun, arg=(), **kwargs):
+        """Run a job and return its results by minion."""
+        return self._client().cmd(tgt, fun, arg=arg, **kwargs)
+
+    def cmd_async(self, tgt, fun, arg=(), **kwargs):
+        """Publish a job and return its jid."""
+        return self._client().cmd_async(tgt, fun, arg=arg, **kwargs)
+
+    def lookup_jid(self, jid):
+        """Return the results of a finished job."""
+        import salt.runner
+        runner = salt.runner.RunnerClient(self.opts)
+        return runner.cmd('jobs.lookup_jid', [jid])
+
+    def list_keys(self):
+        """Return the minion keys by state, as key.list_all."""
+        import salt.wheel
+        wheel = salt.wheel.WheelClient(self.opts)
+        return wheel.cmd('key.list_all')
+
+    def auth_check(self, auth_list, fun, arg, tgt, tgt_type):
+        """Return True if the salt ACL allows a function on a target."""
+        import salt.utils.minions
+        checker = salt.utils.minions.CkMinions(self.opts)
+        return checker.auth_check(auth_list=auth_list, funs=fun, args=arg,
+                                  tgt=tgt, tgt_type=tgt_type)
+
+    def __repr__(self):
+        """Represent a backend."""
+        return '<SaltBackend {0}>'.format(self.master_config)
+
+
+def _ip_addrs(backend, minion, arg, kwarg):
+    index = backend.indexes[minion]
+    return ['10.{0}.{1}.{2}'.format(index // 65536 % 256, index // 256 % 256,
+                                    index % 256)]
+
+
+def _grains_items(backend, minion, arg, kwarg):
+    return {'id': minion, 'os': 'Debian', 'os_family': 'Debian',
+            'osrelease': '8.7', 'kernel': 'Linux', 'num_cpus': 4,
+            'mem_total': 7985, 'ipv4': _ip_addrs(backend, minion, arg, kwarg)}
+
+
+# Results of the simulated functions, called with (backend, minion, arg,
+# kwarg)
+CATALOG = {
+    'test.ping': lambda b, m, a, k: True,
+    'test.echo': lambda b, m, a, k: a[0] if a else '',
+    'test.version': lambda b, m, a, k: '2016.11.5',
+    'sys.list_functions': lambda b, m, a, k: sorted(b.functions),
+    'sys.doc': lambda b, m, a, k: dict(
+        (fun, 'Simulated {0}.'.format(fun)) for fun in (a or b.functions)),
+    'grains.items': _grains_items,
+    'network.ip_addrs': _ip_addrs,
+    'remote_control.create_ssh_connection':
+        lambda b, m, a, k: {'pid': b.random.randint(1000, 65535)},
+    'remote_control.close_ssh_connection': lambda b, m, a, k: True,
+}
+
+
+class SimulatedBackend(object):
+    """
+    Fake salt master answering for generated minions.
+
+    Every minion of a job answers after its own latency, drawn from the
+    distribution: ``constant`` (always ``latency``), ``uniform`` (0 to twice
+    ``latency``) or ``exponential`` (mean ``latency``). The job lasts until
+    its slowest minion answers, or its timeout. Minions over the timeout,
+    and a ``failure_rate`` of the others, don't answer.
+
+    :param minions: Number of minions, named ``<prefix>0000`` and so on.
+    :param functions: Names of the functions of the minions, CATALOG by
+                      default. Names not in CATALOG return True.
+    :param seed: Seed of the random generator, for repeatable runs.
+    :param keep_jobs: Seconds the results of a finished job are kept, as
+                      salt's job cache. They are dropped once read by
+                      ``lookup_jid``.
+    """
+
+    def __init__(self, minions=1000, prefix='minion', latency=0.05,
+                 distribution='exponential', failure_rate=0.0,
+                 functions=None, timeout=5, seed=None, keep_jobs=60):
+        """Init."""
+        if distribution not in ('constant', 'uniform', 'exponential'):
+            raise ValueError('Invalid latency distribution {0}'.format(
+                distribution))
+        width = max(4, len(str(minions - 1)))
+        self.minions = ['{0}{1:0{2}d}'.format(prefix, i, width)
+                        for i in range(minions)]
+        self.indexes = dict((minion, i) for i, minion in
+                            enumerate(self.minions))
+        self.latency = latency
+        self.distribution = distribution
+        self.failure_rate = failure_rate
+        self.functions = set(functions or CATALOG)
+        self.functions.add('sys.list_functions')
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.keep_jobs = keep_jobs
+        self.lock = threading.Lock()
+        self.jobs = {}
+
+    def match(self, tgt, tgt_type='glob'):
+        """Return the minions of a target, glob or list."""
+        if tgt_type == 'list':
+            if not isinstance(tgt, (list, tuple)):
+                tgt = tgt.split(',')
+            return [minion for minion in tgt if minion in self.indexes]
+        if tgt in self.indexes:
+            return [tgt]
+        return fnmatch.filter(self.minions, tgt)
+
+    def _latency(self):
+        if self.distribution == 'constant':
+            return self.latency
+        if self.distribution == 'uniform':
+            return self.random.uniform(0, 2 * self.latency)
+        return self.random.expovariate(1.0 / self.latency)
+
+    def _run(self, tgt, fun, arg, timeout, expr_form, kwarg):
+        """Return the duration and the results of a job."""
+        if timeout is None:
+            timeout = self.timeout
+        results = {}
+        duration = 0
+        with self.lock:
+            for minion in self.match(tgt, expr_form):
+                latency = self._latency()
+                if latency > timeout or \
+                        self.random.random() < self.failure_rate:
+                    duration = timeout
+                    continue
+                duration = max(duration, latency)
+                if fun not in self.functions:
+                    results[minion] = "'{0}' is not available.".format(fun)
+                elif fun in CATALOG:
+                    results[minion] = CATALOG[fun](self, minion, arg,
+                                                   kwarg or {})
+                else:
+                    results[minion] = True
+        return duration, results
+
+    def cmd(self, tgt, fun, arg=(), timeout=None, expr_form='glob',
+            kwarg=None, **kwargs):
+        """Run a job and return its results by minion."""
+        if fun == 'saltutil.find_job':
+            return self._find_job(tgt, arg[0])
+        duration, results = self._run(tgt, fun, arg, timeout, expr_form,
+                                      kwarg)
+        time.sleep(duration)
+        return results
+
+    def cmd_async(self, tgt, fun, arg=(), timeout=None, expr_form='glob',
+                  kwarg=None, **kwargs):
+        """Start a job and return its jid."""
+        duration, results = self._run(tgt, fun, arg, timeout, expr_form,
+                                      kwarg)
+        with self.lock:
+            self._prune()
+            jid = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
+            while jid in self.jobs:
+                jid = str(int(jid) + 1)
+            self.jobs[jid] = (time.time() + duration, results)
+        return jid
+
+    def _prune(self):
+        """Drop the jobs finished more than keep_jobs ago, never read."""
+        expired = time.time() - self.keep_jobs
+        for jid in [jid for jid, (deadline, results) in self.jobs.items()
+                    if deadline < expired]:
+            del self.jobs[jid]
+
+    def _find_job(self, tgt, jid):
+        """Return the job as saltutil.find_job, empty once finished."""
+        deadline, results = self.jobs.get(jid, (0, {}))
+        running = deadline > time.time()
+        return dict((minion, {'jid': jid} if running else {})
+                    for minion in self.match(tgt))
+
+    def lookup_jid(self, jid):
+        """Return the results of a job, waiting for it to finish."""
+        deadline, results = self.jobs.get(jid, (0, {}))
+        time.sleep(max(0, deadline - time.time()))
+        with self.lock:
+            self.jobs.pop(jid, None)
+        return results
+
+    def list_keys(self):
+        """Return the minion keys by state, as key.list_all."""
+        return {'minions': list(self.minions), 'minions_pre': [],
+                'minions_rejected': [], 'minions_denied': []}
+
+    def auth_check(self, auth_list, fun, arg, tgt, tgt_type):
+        """Return True if the ACL allows a function, as salt checks it."""
+        targets = set(self.match(tgt, tgt_type))
+        for ind in auth_list:
+            if isinstance(ind, basestring):
+                if re.match(ind, fun):
+                    return True
+            elif isinstance(ind, dict) and len(ind) == 1:
+                valid, funs = next(iter(ind.items()))
+                if targets.difference(self.match(valid)):
+                    continue
+                if isinstance(funs, basestring):
+                    funs = [funs]
+                for cond in funs:
+                    if isinstance(cond, basestring) and re.match(cond, fun):
+                        return True
+        return False
+
+    def __repr__(self):
+        """Represent a backend."""
+        return '<SimulatedBackend {0} minions>'.format(len(self.minions))
+
+
+def get_backend(name='salt', **kwargs):
+    """Return a backend by name, with its settings as keyword arguments."""
+    if name not in BACKENDS:
+        raise ValueError('Invalid salt backend {0}'.format(name))
+    if name == 'simulated':
+        return SimulatedBackend(**kwargs)
+    return SaltBackend(**kwargs)
@@ -0,0 +1,93 @@
+"""
+Serialize models to dictionaries.
+
+The links of each model are built from url templates computed once at app
+startup, so serializing thousands of rows does not go through Werkzeug url
+building (and outside a request, through a ``test_request_context``) for
+every single link.
+"""
+import logging
+
+from flask import current_app, _request_ctx_stack
+from werkzeug.routing import parse_rule
+from werkzeug.urls import url_quote
+
+from .utils import url_for
+
+logger = logging.getLogger(__name__)
+
+
+def build_url_templates(url_map):
+    """
+    Return a dict endpoint -> (template, arguments) for an url map.
+
+    Static parts are quoted the way Werkzeug does it, dynamic parts are
+    replaced by ``{name}`` placeholders. Only the first rule of an endpoint
+    is used, as ``url_for`` would do.
+    """
+    templates = {}
+    for rule in url_map.iter_rules():
+        if rule.endpoint in templates:
+            continue
+        parts = []
+        for converter, arguments, variable in parse_rule(rule.rule):
+            if converter is None:
+                static = url_quote(variable.encode(url_map.charset),
+                                   safe='/:|+')
+                parts.append(static.replace('{', '{{').replace('}', '}}'))
+            else:
+                parts.append(u'{' + variable + u'}')
+        templates[rule.endpoint] = (u''.join(parts), frozenset(rule.arguments))
+    return templates
+
+
+def init_app(app):
+    """Compute the url templates of an app, once all routes are registered."""
+    app.extensions['url_templates'] = build_url_templates(app.url_map)
+
+
+class Links(object):
+    """Format links using precomputed templates."""
+
+    def __init__(self, templates, script_root=u''):
+        """Init."""
+        self.templates = templates
+        self.script_root = script_root
+
+    def __call__(self, endpoint, **values):
+        """Return the url of an endpoint, like url_for would."""
+        try:
+            template, arguments = self.templates[endpoint]
+        except KeyError:
+            return url_for(endpoint, **values)
+        if arguments != frozenset(values):
+            # Query string or missing arguments, let Werkzeug handle it
+            return url_for(endpoint, **values)
+        quoted = {}
+        for key, value in values.iteritems():
+            if not isinstance(value, unicode):
+                value = unicode(value)
+            quoted[key] = url_quote(value.encode('utf-8'), safe='/:')
+        return self.script_root + template.format(**quoted)
+
+
+def current_links():
+    """Return a Links object for the current app and request."""
+    templates = current_app.extensions.get('url_templates', {})
+    reqctx = _request_ctx_stack.top
+    if reqctx is not None:
+        script_root = reqctx.request.script_root
+    else:
+        script_root = current_app.config.get('APPLICATION_ROOT') or u''
+    return Links(templates, script_root.rstrip('/'))
+
+
+def link_for(endpoint, **values):
+    """Build a relative link using the url templates."""
+    return current_links()(endpoint, **values)
+
+
+def serialize(items):
+    """Export a list of models to a list of dictionaries."""
+    links = current_links()
+    return [item.to_dict(links) for item in items]
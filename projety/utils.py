@@ -1,6 +1,7 @@
 """Some helpers functions non related to any models."""
 
-import subprocess
+import base64
+import hashlib
 import socket
 import logging
 import time
@@ -40,10 +41,16 @@ def get_open_port():
 
 
 def get_ssh_host_key_fingerprint(key=None):
-    """Return the fingerprint of the host ssh key."""
+    """
+    Return the fingerprint of the host ssh key.
+
+    This is the sha256 fingerprint, ``SHA256:<base64>`` as ``ssh-keygen -l``
+    shows it, computed without spawning ssh-keygen.
+    """
     if not key:
         key = '/etc/ssh/ssh_host_rsa_key.pub'
 
-    f = subprocess.check_output('ssh-keygen -lf {0} '.format(key) +
-                                '| cut -d" " -f2', shell=True)
-    return f.rstrip()
+    with open(key) as f:
+        blob = base64.b64decode(f.read().split()[1])
+    digest = base64.b64encode(hashlib.sha256(blob).digest()).decode('ascii')
+    return 'SHA256:' + digest.rstrip('=')
@@ -0,0 +1,130 @@
+"""Buffers used to relay data between the websocket and the proxy."""
+from __future__ import absolute_import
+
+import collections
+import errno
+import socket
+
+
+class RelayBuffer(object):
+    """
+    Queue of chunks waiting to be sent on a socket.
+
+    Chunks are kept in a deque, so taking the head is O(1), and partial
+    sends keep a memoryview on the remaining data instead of copying it.
+
+    When ``high_watermark`` is set, the buffer is paused once it holds that
+    many bytes, and resumed when drained down to ``low_watermark``. The
+    session stops reading from the other side while the buffer is paused.
+    """
+
+    def __init__(self, high_watermark=None, low_watermark=None):
+        """Init."""
+        self.chunks = collections.deque()
+        self.size = 0
+        self.high_watermark = high_watermark
+        if low_watermark is None and high_watermark is not None:
+            low_watermark = high_watermark // 2
+        self.low_watermark = low_watermark
+        self.paused = False
+
+        # Metrics
+        self.peak_size = 0
+        self.pause_count = 0
+
+    def __len__(self):
+        """Return the number of bytes pending."""
+        return self.size
+
+    def __nonzero__(self):
+        """Return whether there is something to send."""
+        return bool(self.chunks)
+
+    __bool__ = __nonzero__
+
+    def append(self, data):
+        """Queue a chunk."""
+        if data:
+            self.chunks.append(data)
+            self.size += len(data)
+            if self.size > self.peak_size:
+                self.peak_size = self.size
+            self._update_paused()
+
+    def popleft(self):
+        """Return the oldest chunk."""
+        data = self.chunks.popleft()
+        self.size -= len(data)
+        self._update_paused()
+        return data
+
+    def send_to(self, sock):
+        """
+        Send the oldest chunk on a socket, return the bytes sent.
+
+        On a full non-blocking socket nothing is sent, the data stays
+        queued.
+        """
+        data = self.chunks[0]
+        if not isinstance(data, memoryview):
+            data = memoryview(data)
+        try:
+            sent = sock.send(data)
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            return 0
+        if sent < len(data):
+            # Keep the remaining data without copying it
+            self.chunks[0] = data[sent:]
+        else:
+            self.chunks.popleft()
+        self.size -= sent
+        self._update_paused()
+        return sent
+
+    def pop_into(self, view):
+        """
+        Move the oldest data to a writable buffer, return the bytes moved.
+
+        The buffer is filled as much as possible, a chunk that doesn't fit
+        is split and its remaining data stays at the head of the queue.
+        """
+        limit = len(view)
+        size = 0
+        while self.chunks and size < limit:
+            data = self.chunks[0]
+            length = min(len(data), limit - size)
+            if length < len(data):
+                if not isinstance(data, memoryview):
+                    data = memoryview(data)
+                view[size:size + length] = data[:length]
+                self.chunks[0] = data[length:]
+            else:
+                view[size:size + length] = data
+                self.chunks.popleft()
+            size += length
+        self.size -= size
+        self._update_paused()
+        return size
+
+    def _update_paused(self):
+        """Apply the watermarks."""
+        if self.high_watermark is None:
+            return
+        if self.paused:
+            if self.size <= self.low_watermark:
+                self.paused = False
+        elif self.size >= self.high_watermark:
+            self.paused = True
+            self.pause_count += 1
+
+    def stats(self):
+        """Return the metrics of the buffer."""
+        return {'size': self.size,
+                'chunks': len(self.chunks),
+                'peak_size': self.peak_size,
+                'paused': self.paused,
+                'pause_count': self.pause_count,
+                'high_watermark': self.high_watermark,
+                'low_watermark': self.low_watermark}
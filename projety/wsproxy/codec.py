@@ -0,0 +1,55 @@
+"""Encoding of the relayed data for the base64 subprotocol."""
+from __future__ import absolute_import
+
+import binascii
+
+PROTOCOL_BINARY = 'binary'
+PROTOCOL_BASE64 = 'base64'
+
+
+class CodecError(Exception):
+    """A message from the client is not valid base64."""
+
+    pass
+
+
+class Base64Codec(object):
+    """
+    Encode the data of the target and decode the messages of the client.
+
+    Old noVNC clients only speak the base64 subprotocol. Instead of encoding
+    each packet of the target, we gather all the queued data in a buffer
+    allocated once per session and encode it in one call, so a framebuffer
+    update split in many reads becomes a single text message.
+
+    :param batch_size: Size of the buffer, the most data sent in a message.
+    """
+
+    def __init__(self, batch_size=262144):
+        """Init."""
+        self.batch_buffer = bytearray(batch_size)
+        self.batch_view = memoryview(self.batch_buffer)
+
+    def encode(self, queue):
+        """
+        Encode the oldest data of a RelayBuffer.
+
+        Return ``(size, message)``, the bytes taken from the queue and the
+        base64 text, as unicode to be sent in a text frame.
+        """
+        size = queue.pop_into(self.batch_view)
+        return size, self.encode_data(self.batch_view[:size])
+
+    def encode_data(self, data):
+        """Return the base64 text of some data."""
+        # b2a_base64 has no line length limit, we only drop its newline
+        return binascii.b2a_base64(data)[:-1].decode('ascii')
+
+    def decode(self, message):
+        """Decode a message of the client, raise CodecError if invalid."""
+        if isinstance(message, unicode):
+            message = message.encode('ascii', 'replace')
+        try:
+            return binascii.a2b_base64(message)
+        except binascii.Error as e:
+            raise CodecError(str(e))
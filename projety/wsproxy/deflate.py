@@ -0,0 +1,180 @@
+"""The permessage-deflate websocket extension (RFC 7692)."""
+from __future__ import absolute_import
+
+import logging
+import zlib
+
+logger = logging.getLogger(__name__)
+
+EXTENSION = 'permessage-deflate'
+
+# Appended by a sync flush, removed from the messages sent
+TAIL = b'\x00\x00\xff\xff'
+
+
+class DeflateError(Exception):
+    """A compressed message can't be read."""
+
+    pass
+
+
+def parse_extensions(header):
+    """
+    Parse a Sec-WebSocket-Extensions header.
+
+    Return a list of ``(name, params)``, params being a dict of strings, or
+    of None for parameters without a value.
+    """
+    offers = []
+    for offer in header.split(','):
+        parts = [p.strip() for p in offer.split(';')]
+        if not parts[0]:
+            continue
+        params = {}
+        for part in parts[1:]:
+            if not part:
+                continue
+            if '=' in part:
+                key, value = part.split('=', 1)
+                params[key.strip()] = value.strip().strip('"')
+            else:
+                params[part] = None
+        offers.append((parts[0], params))
+    return offers
+
+
+class PerMessageDeflate(object):
+    """
+    Settings of the extension, used to answer the client offers.
+
+    :param level: Compression level, 1 is the fastest, 9 the smallest.
+    :param context_takeover: Keep the compression context between messages,
+                             better ratio but more memory per session.
+    :param max_window_bits: Size of the window of our compressor, 9 to 15.
+    :param min_size: Messages smaller than this are sent uncompressed.
+    :param max_message_size: Limit of a decompressed message from the
+                             client.
+    """
+
+    def __init__(self, level=6, context_takeover=True, max_window_bits=15,
+                 min_size=64, max_message_size=16 * 1024 * 1024):
+        """Init."""
+        if not 9 <= max_window_bits <= 15:
+            raise ValueError('max_window_bits must be between 9 and 15')
+        self.level = level
+        self.context_takeover = context_takeover
+        self.max_window_bits = max_window_bits
+        self.min_size = min_size
+        self.max_message_size = max_message_size
+
+    def _window_bits(self, value, default):
+        """Return the window bits of a parameter, None if invalid."""
+        if value is None:
+            return default
+        if not value.isdigit() or not 8 <= int(value) <= 15:
+            return None
+        return int(value)
+
+    def accept(self, header):
+        """
+        Answer a Sec-WebSocket-Extensions header.
+
+        Return ``(response, session)``, the response header value and a
+        DeflateSession, or ``(None, None)`` when no offer is acceptable.
+        """
+        for name, params in parse_extensions(header):
+            if name != EXTENSION:
+                continue
+            known = ('server_no_context_takeover',
+                     'client_no_context_takeover',
+                     'server_max_window_bits', 'client_max_window_bits')
+            if any(key not in known for key in params):
+                continue
+
+            server_bits = self._window_bits(
+                params.get('server_max_window_bits'), self.max_window_bits)
+            # zlib can't compress with a window of 256 bytes
+            if server_bits is None or server_bits < 9:
+                continue
+            server_bits = min(server_bits, self.max_window_bits)
+            if 'client_max_window_bits' in params and \
+                    params['client_max_window_bits'] is not None and \
+                    self._window_bits(params['client_max_window_bits'],
+                                      15) is None:
+                continue
+
+            server_takeover = self.context_takeover and \
+                'server_no_context_takeover' not in params
+            client_takeover = 'client_no_context_takeover' not in params
+
+            # We always decompress with the largest window, so we never
+            # need to limit the client window
+            response = [EXTENSION]
+            if not server_takeover:
+                response.append('server_no_context_takeover')
+            if not client_takeover:
+                response.append('client_no_context_takeover')
+            if server_bits != 15 or 'server_max_window_bits' in params:
+                response.append(
+                    'server_max_window_bits={0}'.format(server_bits))
+
+            session = DeflateSession(self.level, server_bits,
+                                     server_takeover, client_takeover,
+                                     self.min_size, self.max_message_size)
+            return '; '.join(response), session
+        return None, None
+
+
+class DeflateSession(object):
+    """Compress and decompress the messages of one websocket."""
+
+    def __init__(self, level, server_bits, server_takeover,
+                 client_takeover, min_size, max_message_size):
+        """Init."""
+        self.level = level
+        self.server_bits = server_bits
+        self.server_takeover = server_takeover
+        self.client_takeover = client_takeover
+        self.min_size = min_size
+        self.max_message_size = max_message_size
+        self.compressor = None
+        self.decompressor = None
+
+        # Metrics
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def compress(self, data):
+        """Return ``(compressed, data)``, data compressed or not."""
+        if len(data) < self.min_size:
+            return False, data
+        if self.compressor is None or not self.server_takeover:
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                               -self.server_bits)
+        out = self.compressor.compress(data) + \
+            self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if out.endswith(TAIL):
+            out = out[:-len(TAIL)]
+        self.bytes_in += len(data)
+        self.bytes_out += len(out)
+        return True, out
+
+    def decompress(self, data):
+        """Decompress a message, raise DeflateError if invalid."""
+        if self.decompressor is None or not self.client_takeover:
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        try:
+            out = self.decompressor.decompress(data + TAIL,
+                                               self.max_message_size)
+        except zlib.error as e:
+            raise DeflateError(str(e))
+        if self.decompressor.unconsumed_tail:
+            raise DeflateError('Message too big')
+        return out
+
+    def stats(self):
+        """Return the compression metrics."""
+        return {'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'level': self.level,
+                'context_takeover': self.server_takeover}
@@ -0,0 +1,378 @@
+"""
+Share one tunnel connection between the sessions of a token.
+
+By default each websocket opens its own connection to the tunnel, so every
+viewer of a console costs a stream from the minion. Sessions asking for
+``mode=control`` or ``mode=view`` in their query string share one upstream
+connection instead: what the target sends is kept once in a ring buffer and
+each session reads it at its own cursor. Only the controller's input reaches
+the target, viewers are read-only.
+
+VNC is stateful, a client must see the stream from its very first byte (the
+handshake, then the framebuffer updates it builds on). A session therefore
+replays the ring from the start of the connection. The first client answers
+the handshake of the target, the answers of the next ones are dropped (see
+:mod:`.rfb`), and they receive the pixel format and the encodings
+negotiated by the first one. Once the ring has dropped its oldest data, a
+session joining gets a new connection of its own instead, which the next
+sessions join. Replaying only the handshake and the last full framebuffer
+is not possible without decoding the stream: encodings like ZRLE and Tight
+keep zlib streams whose state builds on all the previous updates.
+
+There is one controller at a time, another one can take over once it
+left. Without a controller the viewers ask for the framebuffer updates
+themselves, so a viewer alone on a new connection still sees the screen.
+"""
+from __future__ import absolute_import
+
+import collections
+import logging
+import threading
+
+from .buffer import RelayBuffer
+from .multiplexer import EVENT_READ, EVENT_WRITE
+from .rfb import (ClientStream, LEADER_VIEW_MESSAGES, RFBError,
+                  VIEW_MESSAGES)
+from .socket import connect_tunnel, recv_tunnel
+
+logger = logging.getLogger(__name__)
+
+MODE_CONTROL = 'control'
+MODE_VIEW = 'view'
+MODES = (MODE_CONTROL, MODE_VIEW)
+
+
+class JoinError(Exception):
+    """A session can't join a shared connection, the message says why."""
+
+    pass
+
+
+class LateJoinError(JoinError):
+    """The start of the stream was dropped, a new connection is needed."""
+
+    pass
+
+
+class SharedRing(object):
+    """
+    Last bytes sent by a target, addressed by their offset in the stream.
+
+    Chunks are kept as received, readers share them without copies. Once
+    more than ``capacity`` bytes are kept, the oldest chunks are dropped and
+    ``start`` moves forward.
+    """
+
+    def __init__(self, capacity):
+        """Init."""
+        self.capacity = capacity
+        self.chunks = collections.deque()
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        """Return the number of bytes kept."""
+        return self.end - self.start
+
+    def append(self, data):
+        """Add data at the end, dropping the oldest chunks if needed."""
+        self.chunks.append(data)
+        self.end += len(data)
+        while len(self) > self.capacity and len(self.chunks) > 1:
+            self.start += len(self.chunks.popleft())
+
+    def read(self, cursor, limit):
+        """Return at most ``limit`` bytes from the ``cursor`` offset."""
+        if cursor < self.start:
+            raise IndexError('Data at {0} was dropped'.format(cursor))
+        # Readers are usually close to the end, find the chunk from there
+        offset = self.end
+        index = len(self.chunks)
+        while offset > cursor:
+            index -= 1
+            offset -= len(self.chunks[index])
+
+        parts = []
+        size = 0
+        skip = cursor - offset
+        for i in range(index, len(self.chunks)):
+            chunk = self.chunks[i]
+            if skip or len(chunk) > limit - size:
+                chunk = chunk[skip:skip + limit - size]
+                skip = 0
+            parts.append(chunk)
+            size += len(chunk)
+            if size >= limit:
+                break
+        if len(parts) == 1:
+            return parts[0]
+        return b''.join(parts)
+
+
+class SharedUpstream(object):
+    """
+    One connection to a tunnel, relayed to many sessions.
+
+    It is handled by the multiplexer like a session with no websocket.
+    Reading from the target pauses while the controller lags more than half
+    the ring, viewers lagging behind the ring are closed.
+
+    ``leader`` is the session whose client answered the handshake, kept in
+    ``handshake`` for the others to replay, or False if it couldn't be
+    followed: then no controller can take over.
+    """
+
+    def __init__(self, server, upstreams, key, ring_size):
+        """Init."""
+        self.server = server
+        self.upstreams = upstreams
+        self.key = key
+        self.sid = 'upstream-{0}'.format(key)
+        self.ring = SharedRing(ring_size)
+        self.lock = threading.Lock()
+        self.sessions = set()
+        self.controller = None
+        self.leader = None
+        self.handshake = None
+        self.closed = False
+        self.paused = False
+
+        self.ws_socket = None
+        self.proxy_socket = None
+        self.tqueue = RelayBuffer(*server.target_watermarks)
+        self.recv_buffer = bytearray(65536)
+        self.recv_view = memoryview(self.recv_buffer)
+
+    def connect(self, port):
+        """Open the connection to the tunnel."""
+        self.proxy_socket = connect_tunnel(port)
+
+    def join(self, session, mode):
+        """
+        Attach a session, raise JoinError if it can't join.
+
+        LateJoinError means the session needs a new connection.
+        """
+        with self.lock:
+            if self.closed:
+                raise JoinError('The shared connection is closed')
+            if self.ring.start > 0:
+                raise LateJoinError('The start of the shared connection '
+                                    'was dropped')
+            if mode == MODE_CONTROL:
+                if self.controller is not None:
+                    logger.warning('%s already has a controller', self.sid)
+                    raise JoinError('The shared connection already has a '
+                                    'controller')
+                if self.handshake is False:
+                    raise JoinError('The shared connection can not be '
+                                    'taken over')
+                self.controller = session
+                session.tqueue = self.tqueue
+            if self.leader is None:
+                self.leader = session
+                session.rfb = ClientStream()
+            else:
+                session.rfb = ClientStream(lambda: self.handshake or None)
+            session.upstream = self
+            session.read_only = mode != MODE_CONTROL
+            session.cursor = self.ring.start
+            self.sessions.add(session)
+        return True
+
+    def leave(self, session):
+        """Detach a session, the connection is closed with the last one."""
+        with self.lock:
+            self.sessions.discard(session)
+            if self.controller is session:
+                # Another controller can take over
+                self.controller = None
+            if self.leader is session and self.handshake is None:
+                # Left in the middle of the handshake
+                self.handshake = False
+            if self.sessions or self.closed:
+                return
+            self.closed = True
+        self.upstreams.forget(self)
+        self.server.multiplexer.remove(self)
+
+    def relay_input(self, session, data):
+        """Queue for the target what it may receive of a session input."""
+        with self.lock:
+            stream = session.rfb
+            if stream is None:
+                return
+            if stream.replay is not None and self.handshake is False:
+                # Nothing to replay, only the leader talks to the target
+                return
+            if session is self.controller:
+                allowed = None
+            elif session is self.leader:
+                allowed = LEADER_VIEW_MESSAGES
+            else:
+                allowed = VIEW_MESSAGES
+            handshaken = stream.handshaken
+            server = self.ring.read(0, 16) if self.ring.start == 0 else b''
+            try:
+                data = stream.feed(data, server, allowed)
+            except RFBError as e:
+                data = self._input_error(session, e)
+            if (session is self.leader and stream.handshaken and
+                    self.handshake is None):
+                self.handshake = bytes(stream.handshake)
+            if (self.controller not in (None, session) and
+                    (handshaken or session is not self.leader)):
+                # The controller drives the connection alone, once the
+                # leader answered the handshake
+                return
+            if data:
+                self.tqueue.append(data)
+
+    def _input_error(self, session, error):
+        """Handle a client stream we can't follow, return data to relay."""
+        stream = session.rfb
+        if session is self.leader and not stream.handshaken:
+            # Unknown handshake, only its client can talk to the target
+            logger.warning('%s: %s, no controller can take over',
+                           self.sid, error)
+            self.handshake = False
+        elif session is self.controller:
+            logger.warning('Closing session %s: %s', session.sid, error)
+            session.closed = True
+            return b''
+        else:
+            logger.warning('Dropping the input of %s: %s', session.sid,
+                           error)
+            session.rfb = None
+            return b''
+        data = bytes(stream.buffer)
+        stream.replay = None
+        stream.handshaken = True
+        del stream.buffer[:]
+        return data
+
+    def lag(self, session):
+        """Return the bytes a session still has to send."""
+        return self.ring.end - session.cursor
+
+    def wanted_events(self):
+        """Return the events to watch, we only have the proxy side."""
+        controller = self.controller
+        high = self.ring.capacity // 2
+        if controller is None:
+            self.paused = False
+        elif self.paused:
+            self.paused = self.lag(controller) > high // 2
+        else:
+            self.paused = self.lag(controller) >= high
+
+        proxy_events = 0
+        if not self.paused:
+            proxy_events |= EVENT_READ
+        if self.tqueue:
+            proxy_events |= EVENT_WRITE
+        return 0, proxy_events
+
+    def handle_event(self, side, events):
+        """Relay data to and from the target, return the sessions to update."""
+        if events & EVENT_WRITE:
+            self.tqueue.send_to(self.proxy_socket)
+        if events & EVENT_READ:
+            size = recv_tunnel(self.proxy_socket, self.recv_buffer)
+            if size is None:
+                return list(self.sessions)
+            if size == 0:
+                logger.warning('Target closed shared connection %s', self.sid)
+                self.closed = True
+                return list(self.sessions)
+            with self.lock:
+                self.ring.append(self.recv_view[:size].tobytes())
+            for session in list(self.sessions):
+                if session.cursor < self.ring.start:
+                    logger.warning('Closing session %s, too slow to follow '
+                                   '%s', session.sid, self.sid)
+                    session.closed = True
+        return list(self.sessions)
+
+    def stats(self):
+        """Return the metrics of the shared connection."""
+        return {'sid': self.sid,
+                'sessions': len(self.sessions),
+                'controller': getattr(self.controller, 'sid', None),
+                'ring_start': self.ring.start,
+                'ring_end': self.ring.end,
+                'paused': self.paused}
+
+    def finish(self):
+        """Close the connection and the sessions once unregistered."""
+        with self.lock:
+            self.closed = True
+            sessions = list(self.sessions)
+        if self.proxy_socket is not None:
+            self.proxy_socket.close()
+            self.proxy_socket = None
+        self.upstreams.forget(self)
+        for session in sessions:
+            session.closed = True
+            self.server.multiplexer.remove(session)
+
+
+class Upstreams(object):
+    """
+    Shared connections of a server, by token.
+
+    :param server: The WsProxy.
+    :param ring_size: Bytes kept for each connection.
+    """
+
+    def __init__(self, server, ring_size=8 * 1024 * 1024):
+        """Init."""
+        self.server = server
+        self.ring_size = ring_size
+        self.lock = threading.Lock()
+        self.upstreams = {}
+        # Connections replaced by a new one, until their last session left
+        self.replaced = set()
+
+    def join(self, session, key, port, mode):
+        """
+        Attach a session to the connection of a token, open if needed.
+
+        Raise JoinError if the session can't join it. If the start of its
+        stream was dropped, the session gets a new connection which replaces
+        the old one for the next sessions.
+        """
+        upstream = self._get(key, port)
+        try:
+            return upstream.join(session, mode)
+        except LateJoinError:
+            logger.info('%s: the start of the stream was dropped, opening a '
+                        'new shared connection', upstream.sid)
+        return self._get(key, port, upstream).join(session, mode)
+
+    def _get(self, key, port, replace=None):
+        """Return the connection of a token, open it if needed."""
+        with self.lock:
+            upstream = self.upstreams.get(key)
+            if upstream is not None and upstream is replace:
+                self.replaced.add(upstream)
+            if upstream is None or upstream.closed or upstream is replace:
+                upstream = SharedUpstream(self.server, self, key,
+                                          self.ring_size)
+                upstream.connect(port)
+                self.upstreams[key] = upstream
+                self.server.multiplexer.add(upstream)
+        return upstream
+
+    def forget(self, upstream):
+        """Remove a closed connection."""
+        with self.lock:
+            self.replaced.discard(upstream)
+            if self.upstreams.get(upstream.key) is upstream:
+                del self.upstreams[upstream.key]
+
+    def stats(self):
+        """Return the metrics of every shared connection."""
+        with self.lock:
+            upstreams = list(self.upstreams.values()) + list(self.replaced)
+        return [u.stats() for u in upstreams]
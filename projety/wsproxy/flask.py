@@ -3,6 +3,9 @@ import logging
 
 from .proxy import WsProxy
 from .middleware import WsProxyMiddleware
+from .deflate import PerMessageDeflate
+from .resources import RedisPortAllocator
+from .stores import RedisTokenStore
 
 logger = logging.getLogger(__name__)
 
@@ -45,7 +48,50 @@ class FlaskWsProxy(object):
         if resource.startswith('/'):
             resource = resource[1:]
 
-        self.server = WsProxy(logger=logger)
+        if app is not None:
+            config = app.config
+            kwargs.setdefault('client_watermarks', (
+                config['WSPROXY_CLIENT_HIGH_WATERMARK'],
+                config['WSPROXY_CLIENT_LOW_WATERMARK']))
+            kwargs.setdefault('target_watermarks', (
+                config['WSPROXY_TARGET_HIGH_WATERMARK'],
+                config['WSPROXY_TARGET_LOW_WATERMARK']))
+            kwargs.setdefault('coalesce_size',
+                              config['WSPROXY_COALESCE_SIZE'])
+            kwargs.setdefault('coalesce_delay',
+                              config['WSPROXY_COALESCE_DELAY'])
+            if 'deflate' not in kwargs and config['WSPROXY_DEFLATE']:
+                kwargs['deflate'] = PerMessageDeflate(
+                    level=config['WSPROXY_DEFLATE_LEVEL'],
+                    context_takeover=config[
+                        'WSPROXY_DEFLATE_CONTEXT_TAKEOVER'],
+                    max_window_bits=config['WSPROXY_DEFLATE_MAX_WINDOW_BITS'],
+                    min_size=config['WSPROXY_DEFLATE_MIN_SIZE'])
+            kwargs.setdefault('expiry_resync',
+                              config['WSPROXY_EXPIRY_RESYNC'])
+            kwargs.setdefault('host_key', config['WSPROXY_HOST_KEY'])
+            kwargs.setdefault('port_range', config['WSPROXY_PORT_RANGE'])
+            kwargs.setdefault('prewarm_minions',
+                              config['WSPROXY_PREWARM_MINIONS'])
+            kwargs.setdefault('prewarm_top', config['WSPROXY_PREWARM_TOP'])
+            kwargs.setdefault('prewarm_size', config['WSPROXY_PREWARM_SIZE'])
+            kwargs.setdefault('prewarm_max_age',
+                              config['WSPROXY_PREWARM_MAX_AGE'])
+            kwargs.setdefault('max_sessions',
+                              config['WSPROXY_MAX_SESSIONS'] or None)
+            kwargs.setdefault('shared_ring_size',
+                              config['WSPROXY_SHARED_RING_SIZE'])
+            if 'token_store' not in kwargs and \
+                    config['WSPROXY_TOKEN_STORE'] == 'redis':
+                kwargs['token_store'] = RedisTokenStore.from_url(
+                    config['WSPROXY_TOKEN_STORE_URL'])
+            if 'port_allocator' not in kwargs and \
+                    config['WSPROXY_TOKEN_STORE'] == 'redis':
+                kwargs['port_allocator'] = RedisPortAllocator.from_url(
+                    config['WSPROXY_TOKEN_STORE_URL'],
+                    *kwargs['port_range'])
+
+        self.server = WsProxy(logger=logger, **kwargs)
         if app is not None:
             # here we attach the WsProxy middlware to the FlaskWsProxy
             # object so it can be referenced later if debug middleware needs
@@ -66,3 +112,23 @@ class FlaskWsProxy(object):
     def delete_token(self, token):
         """Delete a token."""
         return self.server.delete_token(token)
+
+    def pending_expiries(self):
+        """Return the tokens scheduled to expire, the next first."""
+        return self.server.pending_expiries()
+
+    def stats(self):
+        """Return the metrics of every session, with its state."""
+        return self.server.stats()
+
+    def kill_session(self, sid):
+        """End a session, return False if unknown."""
+        return self.server.kill_session(sid)
+
+    def collect_metrics(self):
+        """Return the metrics of the proxy, open sessions included."""
+        return self.server.collect_metrics()
+
+    def metrics_exposition(self):
+        """Return the metrics in the Prometheus text format."""
+        return self.server.metrics_exposition()
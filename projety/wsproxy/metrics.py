@@ -0,0 +1,175 @@
+"""Throughput and latency metrics of the proxy sessions."""
+from __future__ import absolute_import
+
+import bisect
+import threading
+
+# Upper bounds in seconds of the duration histograms
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                    5.0, 10.0, 30.0)
+
+# Counters of a session, in both directions
+COUNTERS = ('bytes_from_client', 'bytes_to_client',
+            'bytes_from_target', 'bytes_to_target',
+            'packets_from_client', 'packets_to_client',
+            'packets_from_target', 'packets_to_target')
+
+
+class Histogram(object):
+    """Count observations in cumulative buckets, as Prometheus does."""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        """Init."""
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Add a value."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Return ``(bound, count)`` pairs, the last bound is ``+Inf``."""
+        total = 0
+        rv = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            rv.append((bound, total))
+        return rv
+
+    def to_dict(self):
+        """Return a dict for json."""
+        return {'count': self.count,
+                'sum': self.sum,
+                'buckets': [[str(b), c] for b, c in self.cumulative()]}
+
+
+class ProxyMetrics(object):
+    """
+    Metrics of all the sessions of a proxy.
+
+    Counters of closed sessions are added to the totals, open sessions are
+    read when the metrics are collected. Durations are histograms:
+
+    - ``handshake``: from the request to the websocket handshake
+    - ``tunnel_connect``: connection to the local end of the tunnel
+    - ``tunnel_setup``: token creation, opening the tunnel if needed
+    """
+
+    def __init__(self):
+        """Init."""
+        self.lock = threading.Lock()
+        self.sessions_total = 0
+        self.sessions_closed = 0
+        self.totals = dict((name, 0) for name in COUNTERS)
+        self.durations = {'handshake': Histogram(),
+                          'tunnel_connect': Histogram(),
+                          'tunnel_setup': Histogram()}
+
+    def session_opened(self):
+        """Count a new session."""
+        with self.lock:
+            self.sessions_total += 1
+
+    def session_closed(self, counters):
+        """Add the counters of a closed session to the totals."""
+        with self.lock:
+            self.sessions_closed += 1
+            for name in COUNTERS:
+                self.totals[name] += counters[name]
+
+    def observe(self, name, duration):
+        """Record a duration, in seconds."""
+        with self.lock:
+            self.durations[name].observe(duration)
+
+    def collect(self, sessions):
+        """Return all the metrics, given the open sessions stats."""
+        with self.lock:
+            totals = dict(self.totals)
+            durations = dict((name, h.to_dict())
+                             for name, h in self.durations.items())
+            sessions_total = self.sessions_total
+            sessions_closed = self.sessions_closed
+        for session in sessions:
+            for name in COUNTERS:
+                totals[name] += session['counters'][name]
+        return {
+            'sessions_active': len(sessions),
+            'sessions_total': sessions_total,
+            'sessions_closed': sessions_closed,
+            'client_buffer_bytes': sum(s['client_buffer']['size']
+                                       for s in sessions),
+            'target_buffer_bytes': sum(s['target_buffer']['size']
+                                       for s in sessions),
+            'counters': totals,
+            'durations': durations}
+
+
+def exposition(metrics, prefix='wsproxy'):
+    """Format collected metrics in the Prometheus text format."""
+    lines = []
+
+    def sample(name, kind, value, text):
+        name = '{0}_{1}'.format(prefix, name)
+        lines.append('# HELP {0} {1}'.format(name, text))
+        lines.append('# TYPE {0} {1}'.format(name, kind))
+        lines.append('{0} {1}'.format(name, value))
+
+    sample('sessions_active', 'gauge', metrics['sessions_active'],
+           'Open proxy sessions.')
+    sample('sessions_total', 'counter', metrics['sessions_total'],
+           'Proxy sessions opened.')
+    sample('client_buffer_bytes', 'gauge', metrics['client_buffer_bytes'],
+           'Bytes queued for the browsers.')
+    sample('target_buffer_bytes', 'gauge', metrics['target_buffer_bytes'],
+           'Bytes queued for the tunnels.')
+    for name in COUNTERS:
+        sample(name + '_total', 'counter', metrics['counters'][name],
+               'Relayed {0}.'.format(name.replace('_', ' ')))
+
+    for name in sorted(metrics['durations']):
+        histogram = metrics['durations'][name]
+        full = '{0}_{1}_seconds'.format(prefix, name)
+        lines.append('# HELP {0} Duration of the {1}.'.format(
+            full, name.replace('_', ' ')))
+        lines.append('# TYPE {0} histogram'.format(full))
+        for bound, count in histogram['buckets']:
+            lines.append('{0}_bucket{{le="{1}"}} {2}'.format(
+                full, bound, count))
+        lines.append('{0}_sum {1}'.format(full, histogram['sum']))
+        lines.append('{0}_count {1}'.format(full, histogram['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def samples(metrics, prefix='wsproxy'):
+    """Return collected metrics as the samples of projety.metrics."""
+    help_ = {}
+    gauges = []
+    counters = []
+    histograms = []
+
+    def sample(kind, name, value, text):
+        name = '{0}_{1}'.format(prefix, name)
+        help_[name] = text
+        kind.append([name, {}, value])
+
+    sample(gauges, 'sessions_active', metrics['sessions_active'],
+           'Open proxy sessions.')
+    sample(counters, 'sessions_total', metrics['sessions_total'],
+           'Proxy sessions opened.')
+    sample(gauges, 'client_buffer_bytes', metrics['client_buffer_bytes'],
+           'Bytes queued for the browsers.')
+    sample(gauges, 'target_buffer_bytes', metrics['target_buffer_bytes'],
+           'Bytes queued for the tunnels.')
+    for name in COUNTERS:
+        sample(counters, name + '_total', metrics['counters'][name],
+               'Relayed {0}.'.format(name.replace('_', ' ')))
+    for name, histogram in metrics['durations'].items():
+        sample(histograms, name + '_seconds', histogram,
+               'Duration of the {0}.'.format(name.replace('_', ' ')))
+    return {'help': help_, 'gauges': gauges, 'counters': counters,
+            'histograms': histograms}
@@ -0,0 +1,190 @@
+"""Relay every proxy session from a single event loop."""
+from __future__ import absolute_import
+
+import errno
+import heapq
+import logging
+import socket as _socket
+import threading
+import time
+
+try:
+    import selectors
+except ImportError:  # pragma: no cover
+    import selectors2 as selectors
+
+logger = logging.getLogger(__name__)
+
+EVENT_READ = selectors.EVENT_READ
+EVENT_WRITE = selectors.EVENT_WRITE
+
+
+class Multiplexer(object):
+    """
+    Shared event loop for all the proxy sessions of a server.
+
+    Each session registers its websocket and proxy sockets in one selector.
+    A socket is only watched for writes while there is data pending for it,
+    and the loop blocks until a socket is ready or the next timer.
+
+    With the threading async mode the selector is the best one available
+    (epoll on Linux). With eventlet or gevent, poll and epoll are not
+    patched, so we use the green select, which waits on the hub (itself
+    using epoll) without blocking other greenlets.
+
+    Sessions must provide ``ws_socket``, ``proxy_socket``, ``closed``,
+    ``wanted_events()``, ``handle_event(side, events)`` and ``finish()``.
+    A socket can be None when a session only has one side, and
+    ``handle_event`` can return other sessions whose events changed, as a
+    shared connection and its viewers do. A session holding data for a
+    while sets ``flush_at``, the time to ask its events again.
+    """
+
+    def __init__(self, server):
+        """Init."""
+        self.server = server
+        if server.async_mode == 'threading':
+            self.selector = selectors.DefaultSelector()
+        else:
+            self.selector = selectors.SelectSelector()
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.pending = []
+        self.thread = None
+
+        # Heap of (time, id, session) for the flush_at of the sessions
+        self.timers = []
+        self.deadlines = {}
+
+        # Used to wake up the loop when sessions are added or removed
+        self._wakeup_r, self._wakeup_w = _socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.selector.register(self._wakeup_r, EVENT_READ, None)
+
+    def add(self, session):
+        """Register a session, the loop is started on first use."""
+        with self.lock:
+            self.pending.append((session, True))
+            if self.thread is None:
+                self.thread = self.server.start_background_task(self.run)
+        self._wakeup()
+
+    def remove(self, session):
+        """Ask the loop to end a session."""
+        with self.lock:
+            self.pending.append((session, False))
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b'\0')
+        except _socket.error as e:
+            # Buffer is full, the loop will wake up anyway
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except _socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _process_pending(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for session, add in pending:
+            if add:
+                self.sessions[session] = (0, 0)
+                self._update(session)
+            else:
+                self._finish(session)
+
+    def _set_events(self, sock, events, data):
+        """Register, modify or unregister a socket."""
+        if sock is None:
+            return
+        if events:
+            try:
+                self.selector.modify(sock, events, data)
+            except KeyError:
+                self.selector.register(sock, events, data)
+        else:
+            try:
+                self.selector.unregister(sock)
+            except KeyError:
+                pass
+
+    def _update(self, session):
+        """Watch the sockets of a session according to its buffers."""
+        if session not in self.sessions:
+            return
+        if session.closed:
+            self._finish(session)
+            return
+        wanted = session.wanted_events()
+        # A past flush_at is already taken into account by wanted_events
+        flush_at = getattr(session, 'flush_at', None)
+        if flush_at is not None and flush_at > time.time() and \
+                self.deadlines.get(session) != flush_at:
+            self.deadlines[session] = flush_at
+            heapq.heappush(self.timers, (flush_at, id(session), session))
+        if wanted == self.sessions[session]:
+            return
+        self.sessions[session] = wanted
+        ws_events, proxy_events = wanted
+        self._set_events(session.ws_socket, ws_events, (session, 'ws'))
+        self._set_events(session.proxy_socket, proxy_events,
+                         (session, 'proxy'))
+
+    def _finish(self, session):
+        """Unregister a session before its sockets get closed."""
+        if self.sessions.pop(session, None) is None:
+            return
+        self.deadlines.pop(session, None)
+        for sock in (session.ws_socket, session.proxy_socket):
+            self._set_events(sock, 0, None)
+        try:
+            session.finish()
+        except Exception:
+            logger.exception('Error while closing session %s', session.sid)
+
+    def _timeout(self):
+        """Return the seconds until the next timer, None without timers."""
+        if not self.timers:
+            return None
+        return max(0, self.timers[0][0] - time.time())
+
+    def _process_timers(self):
+        """Update the sessions whose flush_at is reached."""
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            deadline, key, session = heapq.heappop(self.timers)
+            if self.deadlines.get(session) == deadline:
+                del self.deadlines[session]
+                self._update(session)
+
+    def run(self):
+        """Dispatch socket events to the sessions forever."""
+        logger.info('wsproxy multiplexer started')
+        while True:
+            for key, events in self.selector.select(self._timeout()):
+                if key.data is None:
+                    self._drain_wakeup()
+                    continue
+                session, side = key.data
+                if session not in self.sessions:
+                    continue
+                others = None
+                try:
+                    others = session.handle_event(side, events)
+                except Exception:
+                    logger.exception('Error in session %s', session.sid)
+                    session.closed = True
+                self._update(session)
+                for other in others or ():
+                    self._update(other)
+            self._process_pending()
+            self._process_timers()
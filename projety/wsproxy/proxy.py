@@ -1,12 +1,19 @@
 """Handle proxying of request."""
 import importlib
 import logging
+import time
 import uuid
 
 from six.moves import urllib
 
+from .fanout import MODES, JoinError, Upstreams
+from .metrics import ProxyMetrics, exposition
+from .multiplexer import Multiplexer
 from .socket import ProxySocket
+from .resources import TunnelResources
+from .sessions import SessionLimitError, SessionRegistry, STATE_OPEN
 from .tokens import TokenManager
+from .tunnels import TunnelPool
 
 logger = logging.getLogger(__name__)
 
@@ -34,20 +41,73 @@ class WsProxy(object):
                                  default.
     :param cors_credentials: Whether credentials (cookies, authentication) are
                              allowed in requests to this server.
+    :param client_watermarks: ``(high, low)`` sizes in bytes of the buffer
+                              of data going to the browser. Reading from
+                              the target stops above ``high`` and resumes
+                              below ``low``. ``(None, None)`` disables it.
+    :param target_watermarks: Same for data going to the target.
+    :param coalesce_size: Chunks of the target waiting for the browser are
+                          merged in frames of up to this many bytes.
+    :param coalesce_delay: Seconds a frame smaller than ``coalesce_size``
+                           waits for more data, ``0`` to send it as soon as
+                           the websocket is writable.
+    :param token_store: Where tokens are kept, see :mod:`.stores`. Defaults
+                        to the memory of the current process.
+    :param deflate: A PerMessageDeflate to accept the permessage-deflate
+                    extension, only with the eventlet async mode. ``None``
+                    disables compression.
+    :param expiry_resync: Seconds between two reloads of the token store by
+                          the expiry scheduler, ``None`` to never reload.
+    :param host_key: Path of the public ssh host key sent to the minions.
+    :param port_range: ``(start, end)`` of the local ports used by tunnels.
+    :param port_allocator: Reserves these ports, see :mod:`.resources`.
+                           Defaults to the memory of the current process.
+    :param prewarm_minions: Minions to always keep ready tunnels for.
+    :param prewarm_top: Also keep ready tunnels for this number of the most
+                        requested minions.
+    :param prewarm_size: Number of ready tunnels per minion.
+    :param prewarm_max_age: Seconds after which a ready tunnel is replaced.
+    :param max_sessions: Maximum number of concurrent sessions, new ones are
+                         refused with a 503. ``None`` for no limit.
+    :param shared_ring_size: Bytes of target data kept for the sessions
+                             sharing a connection, see :mod:`.fanout`.
     :param kwargs: Reserved for future extensions, any additional parameters
                    given as keyword arguments will be silently ignored.
     """
 
     def __init__(self, async_mode=None,
                  cookie='websockify', cors_allowed_origins=None,
-                 cors_credentials=True, **kwargs):
+                 cors_credentials=True,
+                 client_watermarks=(4194304, 1048576),
+                 target_watermarks=(1048576, 262144),
+                 coalesce_size=65536, coalesce_delay=0.0005, token_store=None,
+                 deflate=None, expiry_resync=60,
+                 host_key='/etc/ssh/ssh_host_rsa_key.pub',
+                 port_range=(40000, 40999), port_allocator=None,
+                 prewarm_minions=None,
+                 prewarm_top=0, prewarm_size=1, prewarm_max_age=3600,
+                 max_sessions=None, shared_ring_size=8388608, **kwargs):
         """Init."""
         self.cookie = cookie
         self.cors_allowed_origins = cors_allowed_origins
         self.cors_credentials = cors_credentials
-        self.sockets = {}
+        self.client_watermarks = client_watermarks
+        self.target_watermarks = target_watermarks
+        self.coalesce_size = coalesce_size
+        self.coalesce_delay = coalesce_delay
+        self.deflate = deflate
+        self.sessions = SessionRegistry(self, max_sessions)
+        self.upstreams = Upstreams(self, shared_ring_size)
         self.environ = {}
-        self.token_manager = TokenManager()
+        self.tunnel_resources = TunnelResources(host_key, port_range,
+                                                port_allocator)
+        self.tunnel_pool = TunnelPool(self, self.tunnel_resources,
+                                      minions=prewarm_minions,
+                                      top=prewarm_top, size=prewarm_size,
+                                      max_age=prewarm_max_age)
+        self.token_manager = TokenManager(token_store, self.tunnel_pool,
+                                          self.tunnel_resources,
+                                          expiry_resync)
 
         # Default mode for async
         if async_mode is None:
@@ -68,11 +128,18 @@ class WsProxy(object):
         if self.async_mode is None:
             raise ValueError('Invalid async_mode specified')
 
+        # Shared event loop relaying all the sessions
+        self.multiplexer = Multiplexer(self)
+        self.metrics = ProxyMetrics()
+
         logger.info('Server initialized for %s.', self.async_mode)
 
     def create_token(self, minion, expiration=3600):
         """Create a token to use in no_vnc."""
-        return self.token_manager.create_token(minion, expiration)
+        start = time.time()
+        token = self.token_manager.create_token(minion, expiration)
+        self.metrics.observe('tunnel_setup', time.time() - start)
+        return token
 
     def get_token(self, minion):
         """Return a valid token if it exist for a minion."""
@@ -82,6 +149,30 @@ class WsProxy(object):
         """Delete a token to use in no_vnc."""
         return self.token_manager.delete_token(token)
 
+    def pending_expiries(self):
+        """Return the tokens scheduled to expire, the next first."""
+        return self.token_manager.scheduler.pending()
+
+    def stats(self):
+        """Return the metrics of every session, with its state."""
+        return [s.stats() for s in self.sessions.values()]
+
+    def kill_session(self, sid):
+        """End a session, return False if unknown."""
+        return self.sessions.kill(sid)
+
+    def collect_metrics(self):
+        """Return the metrics of the proxy, open sessions included."""
+        metrics = self.metrics.collect([s for s in self.stats()
+                                        if s['state'] == STATE_OPEN])
+        metrics['registry'] = self.sessions.stats()
+        metrics['upstreams'] = self.upstreams.stats()
+        return metrics
+
+    def metrics_exposition(self):
+        """Return the metrics in the Prometheus text format."""
+        return exposition(self.collect_metrics())
+
     def _test_websocket(self, environ):
         """Test environ for websocket upgrade."""
         http_upgrade = ''
@@ -119,25 +210,44 @@ class WsProxy(object):
             r = self._bad_request('Not a websocket request')
             return self._respond(environ, start_response, r)
 
+        start = time.time()
+
         # Create sid for new connection
         sid = self._generate_id()
 
         # Generate new socket
         s = ProxySocket(self, sid)
-        self.sockets[sid] = s
-
-        # Auth stuff
-        if not self.validate_connection(environ, sid):
-            r = self._bad_request('Unable to validate connection')
-            return self._respond(environ, start_response, r)
-
-        # Handle handshake
-        if not s.do_websocket_handshake(environ, start_response):
-            r = self._bad_request('Unable to perform handshake')
+        try:
+            self.sessions.add(s)
+        except SessionLimitError as e:
+            logger.warning('Refusing wsproxy session: {0}'.format(e))
+            r = self._unavailable(str(e))
             return self._respond(environ, start_response, r)
 
-        # Now handle web_socket_client
-        return s.do_proxy(environ, start_response)
+        try:
+            # Auth stuff
+            try:
+                valid = self.validate_connection(environ, sid)
+            except JoinError as e:
+                logger.warning('Refusing wsproxy session: {0}'.format(e))
+                r = self._conflict(str(e))
+                return self._respond(environ, start_response, r)
+            if not valid:
+                r = self._bad_request('Unable to validate connection')
+                return self._respond(environ, start_response, r)
+
+            # Handle handshake
+            if not s.do_websocket_handshake(environ, start_response):
+                r = self._bad_request('Unable to perform handshake')
+                return self._respond(environ, start_response, r)
+            s.handshake_duration = time.time() - start
+            self.metrics.observe('handshake', s.handshake_duration)
+
+            # Now handle web_socket_client, until the session ends
+            return s.do_proxy(environ, start_response)
+        finally:
+            s.close()
+            self.sessions.remove(s)
 
     def start_background_task(self, target, *args, **kwargs):
         """Start a background task using the appropriate async model.
@@ -178,9 +288,17 @@ class WsProxy(object):
             return False
 
         # Push port into socket
-        socket = self.sockets[sid]
+        socket = self.sessions.get(sid)
         if not socket:
             return False
+
+        # Viewers and controller of a shared connection
+        if 'mode' in query:
+            mode = query['mode'][0]
+            if mode not in MODES:
+                return False
+            return socket.setup_shared_proxy(token, data.port, mode)
+
         socket.setup_proxy(data.port)
 
         return True
@@ -191,6 +309,18 @@ class WsProxy(object):
                 'headers': [('Content-Type', 'text/plain')],
                 'response': b'{0}'.format(message)}
 
+    def _conflict(self, message):
+        """Generate a conflict HTTP error response."""
+        return {'status': '409 CONFLICT',
+                'headers': [('Content-Type', 'text/plain')],
+                'response': b'{0}'.format(message)}
+
+    def _unavailable(self, message):
+        """Generate a service unavailable HTTP error response."""
+        return {'status': '503 SERVICE UNAVAILABLE',
+                'headers': [('Content-Type', 'text/plain')],
+                'response': b'{0}'.format(message)}
+
     def _respond(self, environ, start_response, r):
         """Send a request back."""
         cors_headers = self._cors_headers(environ)
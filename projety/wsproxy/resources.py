@@ -0,0 +1,201 @@
+"""Resources shared by the tunnels: host key fingerprint and ports."""
+from __future__ import absolute_import
+
+import collections
+import errno
+import logging
+import os
+import random
+import socket
+import threading
+
+from ..exceptions import SaltError
+from ..utils import get_ssh_host_key_fingerprint
+
+logger = logging.getLogger(__name__)
+
+
+class HostKey(object):
+    """
+    Fingerprint of the ssh host key of the master, sent to the minions.
+
+    The fingerprint is computed once, and again only when the file changes
+    (its mtime or size).
+    """
+
+    def __init__(self, path='/etc/ssh/ssh_host_rsa_key.pub'):
+        """Init."""
+        self.path = path
+        self.lock = threading.Lock()
+        self._stat = None
+        self._fingerprint = None
+
+    def fingerprint(self):
+        """Return the fingerprint, cached."""
+        st = os.stat(self.path)
+        stat = (st.st_mtime, st.st_size)
+        with self.lock:
+            if stat != self._stat:
+                logger.info('reading host key {0}'.format(self.path))
+                self._fingerprint = get_ssh_host_key_fingerprint(self.path)
+                self._stat = stat
+            return self._fingerprint
+
+
+class PortAllocator(object):
+    """
+    Reserve ports of the master for tunnels, from a range.
+
+    A port is handed out once until released, so concurrent requests never
+    get the same port. Ports already bound by someone else are skipped and
+    put back at the end of the free list.
+
+    Reservations only live in the current process: this allocator goes
+    with the memory token store, when a single process opens and closes
+    all the tunnels. Use :class:`RedisPortAllocator` with more workers.
+
+    :param start: First port of the range.
+    :param end: Last port of the range, included.
+    """
+
+    def __init__(self, start=40000, end=40999):
+        """Init."""
+        if start > end:
+            raise ValueError('Invalid port range {0}-{1}'.format(start, end))
+        self.start = start
+        self.end = end
+        self.lock = threading.Lock()
+        ports = list(range(start, end + 1))
+        # Workers try their ports in a different order
+        random.shuffle(ports)
+        self.free = collections.deque(ports)
+        self.reserved = set()
+
+    def __contains__(self, port):
+        """Return whether a port is in the range."""
+        return self.start <= port <= self.end
+
+    def _is_bindable(self, port):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.bind(('127.0.0.1', port))
+            return True
+        except socket.error as e:
+            if e.args[0] != errno.EADDRINUSE:
+                raise
+            return False
+        finally:
+            s.close()
+
+    def allocate(self):
+        """Reserve a free port, raise SaltError if there is none."""
+        with self.lock:
+            for i in range(len(self.free)):
+                port = self.free.popleft()
+                if self._is_bindable(port):
+                    self.reserved.add(port)
+                    return port
+                self.free.append(port)
+        raise SaltError('No free port to open a tunnel',
+                        error='no free port', status_code=503)
+
+    def release(self, port):
+        """Give a port back, ignoring ports we did not hand out."""
+        with self.lock:
+            if port in self.reserved:
+                self.reserved.discard(port)
+                self.free.append(port)
+
+    def stats(self):
+        """Return the number of free and reserved ports."""
+        with self.lock:
+            return {'free': len(self.free), 'reserved': len(self.reserved)}
+
+
+class RedisPortAllocator(PortAllocator):
+    """
+    Reserve ports in Redis, shared by all the workers.
+
+    A port is reserved by setting ``<prefix><port>`` with NX, so two
+    workers never hand out the same port, and any worker can release it:
+    the tunnel may be closed by another worker than the one which opened
+    it.
+
+    The keys get a ``ttl``, so the ports of a crashed worker come back. It
+    only has to cover the opening of the tunnel, the port is then bound by
+    it and skipped by the bind check even once the key expired.
+
+    :param redis: A ``redis.StrictRedis`` client (or a compatible object).
+    :param prefix: Prefix of the keys.
+    :param ttl: Seconds a reservation is kept.
+    """
+
+    def __init__(self, redis, start=40000, end=40999,
+                 prefix='projety:wsproxy:port:', ttl=86400):
+        """Init."""
+        super(RedisPortAllocator, self).__init__(start, end)
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+
+    @classmethod
+    def from_url(cls, url, *args, **kwargs):
+        """Create an allocator connected to a Redis url."""
+        import redis
+        return cls(redis.StrictRedis.from_url(url), *args, **kwargs)
+
+    def _key(self, port):
+        return '{0}{1}'.format(self.prefix, port)
+
+    def allocate(self):
+        """Reserve a free port, raise SaltError if there is none."""
+        with self.lock:
+            for i in range(len(self.free)):
+                port = self.free[0]
+                self.free.rotate(-1)
+                key = self._key(port)
+                if not self.redis.set(key, 1, ex=self.ttl, nx=True):
+                    continue
+                if self._is_bindable(port):
+                    return port
+                self.redis.delete(key)
+        raise SaltError('No free port to open a tunnel',
+                        error='no free port', status_code=503)
+
+    def release(self, port):
+        """Give a port back, ignoring ports out of the range."""
+        if port in self:
+            self.redis.delete(self._key(port))
+
+    def stats(self):
+        """Return the number of free and reserved ports, of all workers."""
+        keys = [self._key(port) for port in range(self.start, self.end + 1)]
+        reserved = len([v for v in self.redis.mget(keys) if v is not None])
+        return {'free': len(keys) - reserved, 'reserved': reserved}
+
+
+class TunnelResources(object):
+    """
+    Everything a tunnel needs on the master side.
+
+    :param host_key: Path of the public ssh host key.
+    :param port_range: ``(start, end)`` of the ports used by tunnels.
+    :param ports: The allocator of these ports, a :class:`PortAllocator`
+                  of the range by default.
+    """
+
+    def __init__(self, host_key='/etc/ssh/ssh_host_rsa_key.pub',
+                 port_range=(40000, 40999), ports=None):
+        """Init."""
+        self.host_key = HostKey(host_key)
+        if ports is None:
+            ports = PortAllocator(*port_range)
+        self.ports = ports
+
+    def fingerprint(self):
+        """Return the fingerprint of the host key."""
+        return self.host_key.fingerprint()
+
+    def stats(self):
+        """Return the port usage."""
+        return self.ports.stats()
@@ -0,0 +1,164 @@
+"""
+Just enough of the client side of RFB (VNC) to share a connection.
+
+A client first answers the handshake of the target (protocol version,
+security, ClientInit), then sends messages starting with their type. On a
+shared connection the target answers one handshake only: the clients
+joining later replay it from the ring, their answers are checked against
+the first ones and dropped. Viewers may only ask for framebuffer updates.
+"""
+from __future__ import absolute_import
+
+import struct
+
+SECURITY_NONE = 1
+SECURITY_VNC = 2
+
+SET_PIXEL_FORMAT = 0
+SET_ENCODINGS = 2
+FRAMEBUFFER_UPDATE_REQUEST = 3
+KEY_EVENT = 4
+POINTER_EVENT = 5
+CLIENT_CUT_TEXT = 6
+
+# Messages a viewer may send, the first client also sets the pixel format
+# and the encodings of the connection
+VIEW_MESSAGES = frozenset([FRAMEBUFFER_UPDATE_REQUEST])
+LEADER_VIEW_MESSAGES = frozenset([SET_PIXEL_FORMAT, SET_ENCODINGS,
+                                  FRAMEBUFFER_UPDATE_REQUEST])
+
+
+class RFBError(Exception):
+    """The client stream can't be followed."""
+
+    pass
+
+
+def handshake_size(client, server):
+    """
+    Return the size of the client handshake, None while it is not complete.
+
+    :param client: The first bytes sent by the client.
+    :param server: The first bytes sent by the target, version 3.3 lets it
+                   choose the security type.
+    """
+    if len(client) < 12:
+        return None
+    version = bytes(client[:12])
+    if not version.startswith(b'RFB 003.') or not version.endswith(b'\n'):
+        raise RFBError('Invalid protocol version {0!r}'.format(version))
+    size = 12
+    if int(version[8:11]) >= 7:
+        if len(client) < size + 1:
+            return None
+        security = bytearray(client[size:size + 1])[0]
+        size += 1
+    else:
+        if len(server) < 16:
+            return None
+        security = struct.unpack('>I', bytes(server[12:16]))[0]
+    if security == SECURITY_VNC:
+        size += 16
+    elif security != SECURITY_NONE:
+        raise RFBError('Unsupported security type {0}'.format(security))
+    # ClientInit
+    size += 1
+    if len(client) < size:
+        return None
+    return size
+
+
+def message_size(data):
+    """Return the size of the first client message, None if incomplete."""
+    kind = data[0]
+    if kind == SET_PIXEL_FORMAT:
+        return 20
+    if kind == FRAMEBUFFER_UPDATE_REQUEST:
+        return 10
+    if kind == KEY_EVENT:
+        return 8
+    if kind == POINTER_EVENT:
+        return 6
+    if kind == SET_ENCODINGS:
+        if len(data) < 4:
+            return None
+        return 4 + 4 * struct.unpack('>H', bytes(data[2:4]))[0]
+    if kind == CLIENT_CUT_TEXT:
+        if len(data) < 8:
+            return None
+        return 8 + struct.unpack('>I', bytes(data[4:8]))[0]
+    raise RFBError('Unknown client message {0}'.format(kind))
+
+
+class ClientStream(object):
+    """
+    Input of one client of a shared connection.
+
+    The first client of a connection answers the handshake: its bytes are
+    sent as they come, the client waits for the target between them, and
+    kept in ``handshake``. The next ones get ``replay``, a callable
+    returning the handshake of the first client (None while it isn't
+    complete), and their own is dropped.
+    """
+
+    def __init__(self, replay=None):
+        """Init."""
+        self.replay = replay
+        self.handshake = bytearray()
+        self.handshaken = False
+        self.buffer = bytearray()
+
+    def _skip_handshake(self):
+        """Drop the replayed handshake, return True once it is over."""
+        expected = self.replay()
+        if expected is None:
+            return False
+        size = min(len(self.buffer), len(expected) - len(self.handshake))
+        data = self.buffer[:size]
+        if data != expected[len(self.handshake):len(self.handshake) + size]:
+            raise RFBError('The handshake differs from the first client')
+        self.handshake += data
+        del self.buffer[:size]
+        return len(self.handshake) == len(expected)
+
+    def _answer_handshake(self, server):
+        """Return the handshake bytes to send, set handshaken at its end."""
+        size = handshake_size(self.handshake + self.buffer, server)
+        if size is None:
+            data = bytes(self.buffer)
+        else:
+            data = bytes(self.buffer[:size - len(self.handshake)])
+            self.handshaken = True
+        self.handshake += data
+        del self.buffer[:len(data)]
+        return data
+
+    def feed(self, data, server=b'', allowed=None):
+        """
+        Return what the target may receive of data sent by the client.
+
+        :param server: The first bytes sent by the target.
+        :param allowed: Types of the messages sent, None for all of them as
+                        they come.
+        """
+        self.buffer += data
+        out = b''
+        if not self.handshaken:
+            if self.replay is None:
+                out = self._answer_handshake(server)
+            elif self._skip_handshake():
+                self.handshaken = True
+            if not self.handshaken:
+                return out
+        if allowed is None:
+            out += bytes(self.buffer)
+            del self.buffer[:]
+            return out
+        while self.buffer:
+            size = message_size(self.buffer)
+            if size is None or len(self.buffer) < size:
+                break
+            if self.buffer[0] in allowed:
+                out += bytes(self.buffer[:size])
+            del self.buffer[:size]
+        return out
@@ -0,0 +1,143 @@
+"""Close remote control tokens when they expire."""
+from __future__ import absolute_import
+
+import heapq
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryScheduler(object):
+    """
+    Wake up when the next token expires, and expire it.
+
+    Deadlines are kept in a min-heap. Refreshing a token pushes its new
+    deadline, the old entry is skipped when popped (lazy deletion), so
+    refresh and delete are O(log n) and O(1) and the loop never scans all
+    the tokens.
+
+    Due tokens are checked against the store again before being expired,
+    as another worker may have refreshed them. With a shared store, the
+    heap is also rebuilt from the store every ``resync`` seconds, to pick
+    up tokens of workers that went away.
+
+    :param manager: The TokenManager, its ``expire(uids)`` method is called
+                    with the due tokens.
+    :param resync: Seconds between two reloads of the store, or ``None``.
+    """
+
+    def __init__(self, manager, resync=None):
+        """Init."""
+        self.manager = manager
+        self.resync = resync
+        self.heap = []
+        self.deadlines = {}
+        self.condition = threading.Condition()
+        self.thread = None
+        self.last_sync = None
+
+    def schedule(self, uid, deadline):
+        """Add or move the deadline of a token."""
+        with self.condition:
+            if self.deadlines.get(uid) == deadline:
+                return
+            self.deadlines[uid] = deadline
+            heapq.heappush(self.heap, (deadline, uid))
+            # Wake up the loop only if it has to wake up earlier
+            if self.heap[0][1] == uid:
+                self.condition.notify()
+
+    def cancel(self, uid):
+        """Forget a token, its heap entry is dropped when popped."""
+        with self.condition:
+            self.deadlines.pop(uid, None)
+
+    def next_deadline(self):
+        """Return the next deadline, or None."""
+        with self.condition:
+            self._drop_stale()
+            if not self.heap:
+                return None
+            return self.heap[0][0]
+
+    def pending(self):
+        """Return the scheduled tokens, the next to expire first."""
+        with self.condition:
+            return [{'id': uid, 'deadline': deadline}
+                    for uid, deadline in sorted(self.deadlines.items(),
+                                                key=lambda i: i[1])]
+
+    def _drop_stale(self):
+        """Pop entries of cancelled or moved tokens."""
+        while self.heap:
+            deadline, uid = self.heap[0]
+            if self.deadlines.get(uid) == deadline:
+                return
+            heapq.heappop(self.heap)
+
+    def pop_due(self, now=None):
+        """Remove and return the tokens whose deadline is past."""
+        if now is None:
+            now = int(time.time())
+        due = []
+        with self.condition:
+            self._drop_stale()
+            while self.heap and self.heap[0][0] < now:
+                deadline, uid = heapq.heappop(self.heap)
+                del self.deadlines[uid]
+                due.append(uid)
+                self._drop_stale()
+        return due
+
+    def sync(self):
+        """Schedule every token of the store."""
+        self.last_sync = time.time()
+        for data in self.manager.store.all():
+            self.schedule(data['id'], data['last_seen'] + data['expiration'])
+
+    def run_once(self, now=None):
+        """Expire the due tokens, return their uuids."""
+        due = self.pop_due(now)
+        if due:
+            self.manager.expire(due)
+        return due
+
+    def _timeout(self):
+        """Return how long to sleep, None to wait for a new token."""
+        timeouts = []
+        if self.heap:
+            # Deadlines are compared with integer timestamps
+            timeouts.append(self.heap[0][0] + 1 - time.time())
+        if self.resync is not None:
+            timeouts.append(self.last_sync + self.resync - time.time())
+        if not timeouts:
+            return None
+        return max(0, min(timeouts))
+
+    def run(self):
+        """Expire tokens forever."""
+        logger.info('wsproxy expiry scheduler started')
+        while True:
+            try:
+                if self.last_sync is None or self.resync is not None and \
+                        time.time() >= self.last_sync + self.resync:
+                    self.sync()
+                self.run_once()
+            except Exception:
+                logger.exception('Error while expiring tokens')
+            with self.condition:
+                self._drop_stale()
+                timeout = self._timeout()
+                if timeout is None or timeout > 0:
+                    self.condition.wait(timeout)
+
+    def start(self):
+        """Start the loop in a thread, once."""
+        with self.condition:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+        self.thread.start()
@@ -0,0 +1,94 @@
+"""Registry of the proxy sessions of a server."""
+from __future__ import absolute_import
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Lifecycle of a session: new while the token and the handshake are checked,
+# open while relayed, closing once killed, closed when its sockets are
+STATE_NEW = 'new'
+STATE_OPEN = 'open'
+STATE_CLOSING = 'closing'
+STATE_CLOSED = 'closed'
+
+
+class SessionLimitError(Exception):
+    """The server already has its maximum number of sessions."""
+
+    pass
+
+
+class SessionRegistry(object):
+    """
+    Sessions of a server, by sid.
+
+    A session is registered as soon as its request arrives and removed once
+    closed, whatever the reason, so dead sessions and their buffers don't
+    stay in memory.
+
+    :param server: The WsProxy, its multiplexer ends killed sessions.
+    :param max_sessions: Maximum number of sessions, ``None`` for no limit.
+    """
+
+    def __init__(self, server, max_sessions=None):
+        """Init."""
+        self.server = server
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def __len__(self):
+        """Return the number of sessions."""
+        return len(self.sessions)
+
+    def __contains__(self, sid):
+        """Return whether a session is registered."""
+        return sid in self.sessions
+
+    def get(self, sid):
+        """Return a session, None if unknown."""
+        return self.sessions.get(sid)
+
+    def values(self):
+        """Return the sessions."""
+        with self.lock:
+            return list(self.sessions.values())
+
+    def add(self, session):
+        """Register a session, raise SessionLimitError when full."""
+        with self.lock:
+            if self.max_sessions and len(self.sessions) >= self.max_sessions:
+                raise SessionLimitError('Too many sessions')
+            self.sessions[session.sid] = session
+
+    def remove(self, session):
+        """Forget a session, return whether it was registered."""
+        with self.lock:
+            if self.sessions.get(session.sid) is not session:
+                return False
+            del self.sessions[session.sid]
+        session.state = STATE_CLOSED
+        return True
+
+    def kill(self, sid):
+        """Ask a session to end, return False if unknown."""
+        session = self.get(sid)
+        if session is None:
+            return False
+        logger.info('Killing wsproxy session %s', sid)
+        session.state = STATE_CLOSING
+        # The multiplexer finishes it on its next turn, or as soon as it is
+        # added if its handshake is not done yet
+        session.closed = True
+        self.server.multiplexer.remove(session)
+        return True
+
+    def stats(self):
+        """Return the number of sessions by state, and the limit."""
+        states = dict((state, 0) for state in (STATE_NEW, STATE_OPEN,
+                                               STATE_CLOSING))
+        for session in self.values():
+            states[session.state] = states.get(session.state, 0) + 1
+        return {'states': states, 'max_sessions': self.max_sessions}
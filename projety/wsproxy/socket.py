@@ -1,19 +1,61 @@
 """Socket that will proxy request to a local port."""
 from __future__ import absolute_import
 
-import logging
-import select
-import sys
 import errno
+import logging
+import time
 
 import socket as _socket
 
 from base64 import b64encode
 from hashlib import sha1
 
+from .buffer import RelayBuffer
+from .codec import (Base64Codec, CodecError, PROTOCOL_BASE64,
+                    PROTOCOL_BINARY)
+from .metrics import COUNTERS
+from .multiplexer import EVENT_READ, EVENT_WRITE
+from .sessions import STATE_NEW, STATE_OPEN
+from .websocket import WebSocket, handshake_response
+
 logger = logging.getLogger(__name__)
 
 
+def connect_tunnel(port):
+    """
+    Return a non-blocking socket connected to a local tunnel port.
+
+    The socket is relayed by the multiplexer loop shared by all the
+    sessions, it must never block it.
+    """
+    host = '127.0.0.1'
+    flags = 0
+
+    # Create socket magic
+    addrs = _socket.getaddrinfo(host, port, 0, _socket.SOCK_STREAM,
+                                _socket.IPPROTO_TCP, flags)
+
+    if not addrs:
+        raise Exception("Could not resolve host '%s'" % host)
+
+    addrs.sort(key=lambda x: x[0])
+    sock = _socket.socket(addrs[0][0], addrs[0][1])
+    sock.connect(addrs[0][4])
+    sock.setsockopt(_socket.SOL_SOCKET, _socket.SO_KEEPALIVE, 1)
+    sock.setblocking(False)
+    return sock
+
+
+def recv_tunnel(sock, buffer):
+    """Read a tunnel socket into a buffer, None if there is nothing yet."""
+    try:
+        return sock.recv_into(buffer)
+    except _socket.error as e:
+        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+        return None
+
+
 class ProxySocket(object):
     """An Websockify proxy socket."""
 
@@ -21,6 +63,7 @@ class ProxySocket(object):
 
     GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
     buffer_size = 65536
+    base64_batch_size = 262144
 
     class CClose(Exception):
         """An exception while the WebSocket client was connected."""
@@ -32,44 +75,87 @@ class ProxySocket(object):
         self.server = server
         self.sid = sid
 
-        # To have the state of our socket
+        # To have the state of our socket, see sessions for the lifecycle
+        self.state = STATE_NEW
         self.connected = False
         self.upgraded = False
         self.closed = False
 
-        # Not sure we need this
+        # Subprotocol chosen in the handshake, with base64 the data is
+        # encoded by the codec
+        self.protocol = None
         self.base64 = False
+        self.codec = None
+
+        # Set when permessage-deflate is accepted, we then do the websocket
+        # ourselves, see do_raw_websocket
+        self.deflate = None
+        self.raw_websocket = False
+        self.handshake_headers = None
+
+        # With a shared connection the target data is read from the ring of
+        # the upstream at our cursor, and our input is filtered by it (rfb)
+        self.mode = None
+        self.upstream = None
+        self.rfb = None
+        self.cursor = 0
+        self.read_only = False
 
         # Init to none
         self.proxy_port = None
         self.proxy_socket = None
+        self.ws = None
+        self.ws_socket = None
+        self.finished = None
+
+        # Data queued for the websocket (cqueue) and for the proxy (tqueue)
+        self.cqueue = RelayBuffer(*server.client_watermarks)
+        self.tqueue = RelayBuffer(*server.target_watermarks)
+
+        # Proxy reads go to a preallocated buffer
+        self.recv_buffer = bytearray(self.buffer_size)
+        self.recv_view = memoryview(self.recv_buffer)
+
+        # Small chunks for the websocket are merged in one frame, and held
+        # until flush_at while they are smaller than coalesce_size
+        self.coalesce_size = server.coalesce_size
+        self.coalesce_delay = server.coalesce_delay
+        self.coalesce_buffer = bytearray(self.coalesce_size)
+        self.coalesce_view = memoryview(self.coalesce_buffer)
+        self.flush_at = None
+
+        # Metrics
+        self.created_at = time.time()
+        self.counters = dict((name, 0) for name in COUNTERS)
+        self.handshake_duration = None
+        self.tunnel_connect_duration = None
 
     def setup_proxy(self, port):
         """Create the proxy socket."""
         self.proxy_port = port
 
         # Create proxy_socket and connect to it
-        host = '127.0.0.1'
-        port = self.proxy_port
-        flags = 0
-
-        # Create socket magic
-        addrs = _socket.getaddrinfo(host, port, 0, _socket.SOCK_STREAM,
-                                    _socket.IPPROTO_TCP, flags)
-
-        if not addrs:
-            raise Exception("Could not resolve host '%s'" % host)
-
-        addrs.sort(key=lambda x: x[0])
-        self.proxy_socket = _socket.socket(addrs[0][0], addrs[0][1])
-        self.proxy_socket.connect(addrs[0][4])
-
-        self.proxy_socket.setsockopt(_socket.SOL_SOCKET,
-                                     _socket.SO_KEEPALIVE, 1)
+        start = time.time()
+        self.proxy_socket = connect_tunnel(port)
+        self.tunnel_connect_duration = time.time() - start
+        self.server.metrics.observe('tunnel_connect',
+                                    self.tunnel_connect_duration)
         return True
 
+    def setup_shared_proxy(self, key, port, mode):
+        """Join the shared connection of a token, see fanout.JoinError."""
+        self.proxy_port = port
+        self.mode = mode
+        start = time.time()
+        joined = self.server.upstreams.join(self, key, port, mode)
+        self.tunnel_connect_duration = time.time() - start
+        return joined
+
     def do_proxy(self, environ, start_response):
         """Start a thread to proxy request to a specific port."""
+        if self.raw_websocket:
+            return self.do_raw_websocket(environ)
+
         # Select the right websocket class
         if self.server.async['websocket'] is None or \
                 self.server.async['websocket_class'] is None:
@@ -84,10 +170,9 @@ class ProxySocket(object):
 
     def do_websocket_handshake(self, environ, start_response):
         """Perform the websocket handshake."""
-        if 'HTTP_SEC_WEBSOCKET_PROTOCOL' in environ:
-            protocols = environ['HTTP_SEC_WEBSOCKET_PROTOCOL'].split(',')
-        else:
-            protocols = ['binary']
+        protocols = [p.strip() for p in
+                     environ.get('HTTP_SEC_WEBSOCKET_PROTOCOL', '').split(',')]
+        protocols = [p for p in protocols if p]
         version = environ['HTTP_SEC_WEBSOCKET_VERSION']
 
         if version:
@@ -103,13 +188,20 @@ class ProxySocket(object):
 
             key = environ['HTTP_SEC_WEBSOCKET_KEY']
 
-            # Choose binary if client supports it
-            if 'binary' in protocols:
+            # Choose binary if client supports it, without subprotocol we
+            # relay binary data and answer none
+            if not protocols or PROTOCOL_BINARY in protocols:
                 self.base64 = False
-            elif 'base64' in protocols:
+            elif PROTOCOL_BASE64 in protocols:
                 self.base64 = True
+                self.codec = Base64Codec(self.base64_batch_size)
             else:
-                raise Exception('TODO')
+                logger.warning('websocket: unsupported subprotocols '
+                               '{0}'.format(', '.join(protocols)))
+                return False
+            if protocols:
+                self.protocol = PROTOCOL_BASE64 if self.base64 \
+                    else PROTOCOL_BINARY
 
             # Generate the hash value for the accept header
             accept = b64encode(sha1(key + self.GUID).digest())
@@ -121,17 +213,30 @@ class ProxySocket(object):
                 ("Connection", "Upgrade"),
                 ("Sec-WebSocket-Accept", accept)]
 
-            if self.base64:
-                headers.append(("Sec-WebSocket-Protocol", "base64"))
-            else:
-                headers.append(("Sec-WebSocket-Protocol", "binary"))
+            if self.protocol:
+                headers.append(("Sec-WebSocket-Protocol", self.protocol))
+
+            raw_available = self._raw_socket_available(environ)
+            extensions = environ.get('HTTP_SEC_WEBSOCKET_EXTENSIONS')
+            if extensions and self.server.deflate is not None and \
+                    raw_available:
+                response, self.deflate = self.server.deflate.accept(
+                    extensions)
+                if response:
+                    headers.append(("Sec-WebSocket-Extensions", response))
+
+            # The websocket of eventlet doesn't echo the subprotocol, which
+            # browsers require to accept base64
+            self.raw_websocket = raw_available and \
+                (self.deflate is not None or self.base64)
 
             if self.server.cookie:
                 cookie = self.server.cookie + '=' + self.sid
                 headers.append(("Set-Cookie", cookie))
 
             cors_headers = self.server._cors_headers(environ)
-            start_response(status, headers + cors_headers)
+            self.handshake_headers = headers + cors_headers
+            start_response(status, self.handshake_headers)
 
             self.connected = True
             return True
@@ -139,11 +244,37 @@ class ProxySocket(object):
         else:
             return False
 
+    def _raw_socket_available(self, environ):
+        """Return whether we can answer the handshake on the socket."""
+        return self.server.async_mode == 'eventlet' and \
+            'eventlet.input' in environ
+
+    def do_raw_websocket(self, environ):
+        """Answer the handshake and relay using our own websocket."""
+        from eventlet.wsgi import ALREADY_HANDLED
+
+        sock = environ['eventlet.input'].get_socket()
+        sock.sendall(handshake_response(self.handshake_headers))
+        ws = WebSocket(sock, deflate=self.deflate)
+        try:
+            self._websocket_handler(ws)
+        finally:
+            ws.close()
+        return ALREADY_HANDLED
+
     def close(self, wait=True, abort=False):
-        """Close the socket connection."""
+        """Close the socket connection, can be called more than once."""
+        if self.upstream is not None:
+            self.upstream.leave(self)
+            self.upstream = None
         if self.proxy_socket:
-            self.proxy_socket.shutdown(_socket.SHUT_RDWR)
+            try:
+                self.proxy_socket.shutdown(_socket.SHUT_RDWR)
+            except _socket.error:
+                # Target already closed the connection
+                pass
             self.proxy_socket.close()
+            self.proxy_socket = None
         self.closed = True
 
     def make_websocket(self, environ, start_response):
@@ -158,79 +289,211 @@ class ProxySocket(object):
         return ws(environ, start_response)
 
     def _websocket_handler(self, ws):
-        """Create the handler for websocket transport."""
-        cqueue = []
-        c_pend = 0
-        tqueue = []
-        rlist = [ws.socket, self.proxy_socket]
-
-        while True:
-            wlist = []
-
-            if tqueue:
-                wlist.append(self.proxy_socket)
-
-            if cqueue or c_pend:
-                wlist.append(ws.socket)
+        """
+        Create the handler for websocket transport.
+
+        The relay itself is done by the server multiplexer, here we only
+        wait for the session to end.
+        """
+        # The websockets of the async modes block, we take over the frames
+        # on their socket
+        if not hasattr(ws, 'flush'):
+            ws = WebSocket(ws.socket)
+        self.ws = ws
+        self.ws_socket = ws.socket
+        if self.state == STATE_NEW:
+            self.state = STATE_OPEN
+        self.finished = getattr(self.server.async['queue'],
+                                self.server.async['queue_class'])()
+        # Counted once the multiplexer has it, it then always calls finish
+        # which counts the session closed
+        self.server.metrics.session_opened()
+        self.server.multiplexer.add(self)
+        self.finished.get()
+        return []
 
+    def wanted_events(self):
+        """
+        Return the events to watch on the websocket and proxy sockets.
+
+        We stop reading from one side while the buffer for the other side
+        is above its high watermark.
+        """
+        ws_events = 0
+        proxy_events = 0
+        if self.ws is not None and self.ws.pending_output():
+            ws_events |= EVENT_WRITE
+        if self.upstream is not None:
+            if self.read_only or not self.tqueue.paused:
+                ws_events |= EVENT_READ
+            if self.cursor < self.upstream.ring.end:
+                ws_events |= EVENT_WRITE
+            return ws_events, proxy_events
+        if not self.tqueue.paused:
+            ws_events |= EVENT_READ
+        if not self.cqueue.paused:
+            proxy_events |= EVENT_READ
+        if self.cqueue and (self.flush_at is None or
+                            len(self.cqueue) >= self.coalesce_size or
+                            time.time() >= self.flush_at):
+            ws_events |= EVENT_WRITE
+        if self.tqueue:
+            proxy_events |= EVENT_WRITE
+        return ws_events, proxy_events
+
+    def stats(self):
+        """Return the metrics of the session."""
+        return {'sid': self.sid,
+                'state': self.state,
+                'mode': self.mode,
+                'port': self.proxy_port,
+                'duration': time.time() - self.created_at,
+                'handshake_duration': self.handshake_duration,
+                'tunnel_connect_duration': self.tunnel_connect_duration,
+                'counters': dict(self.counters),
+                'protocol': self.protocol,
+                'deflate': self.deflate.stats() if self.deflate else None,
+                'client_buffer': self.cqueue.stats(),
+                'target_buffer': self.tqueue.stats()}
+
+    def handle_event(self, side, events):
+        """
+        Relay data for a socket ready for reading and/or writing.
+
+        Return the other sessions whose events may have changed.
+        """
+        if self.upstream is not None:
+            upstream = self.upstream
+            if events & EVENT_WRITE:
+                self._send_shared_to_ws()
+            if events & EVENT_READ:
+                self._recv_from_ws()
+            return [upstream]
+        if side == 'ws':
+            if events & EVENT_WRITE:
+                self._send_to_ws()
+            if events & EVENT_READ:
+                self._recv_from_ws()
+        else:
+            if events & EVENT_WRITE:
+                self._send_to_proxy()
+            if events & EVENT_READ:
+                self._recv_from_proxy()
+
+    def _send_to_ws(self):
+        """
+        Send one frame of vnc packets to the websocket, merging small ones.
+
+        A frame is only sent once the previous one is written, the rest
+        stays in cqueue so that its watermarks pause the target of a slow
+        browser.
+        """
+        self.flush_at = None
+        if not self.ws.flush() or not self.cqueue:
+            return
+        if self.base64:
+            return self._send_base64_to_ws()
+        if len(self.cqueue.chunks) == 1 or \
+                len(self.cqueue.chunks[0]) >= self.coalesce_size:
+            data = self.cqueue.popleft()
+        else:
+            size = self.cqueue.pop_into(self.coalesce_view)
+            data = self.coalesce_view[:size]
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        self.ws.send(data)
+        self.counters['bytes_to_client'] += len(data)
+        self.counters['packets_to_client'] += 1
+
+    def _send_base64_to_ws(self):
+        """Send one text message of at most base64_batch_size bytes."""
+        size, message = self.codec.encode(self.cqueue)
+        # Unicode messages are sent as text frames
+        self.ws.send(message)
+        self.counters['bytes_to_client'] += size
+        self.counters['packets_to_client'] += 1
+
+    def _send_shared_to_ws(self):
+        """Send the next frame of the shared connection, once written."""
+        if not self.ws.flush():
+            return
+        ring = self.upstream.ring
+        if self.cursor >= ring.end:
+            return
+        data = ring.read(self.cursor, self.base64_batch_size)
+        if self.base64:
+            self.ws.send(self.codec.encode_data(data))
+        else:
+            self.ws.send(data)
+        self.cursor += len(data)
+        self.counters['bytes_to_client'] += len(data)
+        self.counters['packets_to_client'] += 1
+
+    def _recv_from_ws(self):
+        """Receive websocket packets and queue them for vnc."""
+        while self.read_only or not self.tqueue.paused:
             try:
-                ins, outs, excepts = select.select(rlist, wlist, [], 1)
-            except (select.error, OSError):
-                exc = sys.exc_info()[1]
-                if hasattr(exc, 'errno'):
-                    err = exc.errno
-                else:
-                    err = exc[0]
-
-                if err != errno.EINTR:
-                    raise
-                else:
-                    continue
-
-            if excepts:
-                logger.warning("Socket exception")
-                break
-
-            if ws.socket in outs:
-                # Send vnc packet to the websocket
-                for pkt in cqueue:
-                    ws.send(pkt)
-                cqueue = []
-
-            if ws.socket in ins:
-                # Receive websocket packet
-                # Queue them for vnc
+                p = self.ws.wait()
+            except Exception:
+                logger.warning('websocket: wait exception')
+                self.closed = True
+                return
+            if p is None:
+                # No complete message yet, or connection closed by client
+                if self.ws.closed:
+                    self.closed = True
+                return
+            if self.base64:
                 try:
-                    p = ws.wait()
-                except:
-                    logger.warning('websocket: wait exception')
-                    break
-                if p is None:
-                    # connection closed by client
-                    break
-                tqueue.extend(p)
-
-            if self.proxy_socket in outs:
-                # Send queued websocket packet to vnc
-                dat = tqueue.pop(0)
-                sent = self.proxy_socket.send(dat)
-
-                if sent == len(dat):
-                    pass
-                else:
-                    # requeue the remaining data
-                    tqueue.insert(0, dat[sent:])
-
-            if self.proxy_socket in ins:
-                # Receive vnc packet
-                # Queue them for websocket
-                buf = self.proxy_socket.recv(self.buffer_size)
-                if len(buf) == 0:
-                    logger.warning('Target closed connection')
-                    break
-
-                cqueue.append(buf)
-
+                    p = self.codec.decode(p)
+                except CodecError as e:
+                    logger.warning('websocket: invalid base64 {0}'.format(e))
+                    self.closed = True
+                    return
+            elif isinstance(p, unicode):
+                p = p.encode('utf-8')
+            self.counters['bytes_from_client'] += len(p)
+            self.counters['packets_from_client'] += 1
+            if self.upstream is not None:
+                self.upstream.relay_input(self, p)
+                if self.closed:
+                    return
+            elif not self.read_only:
+                self.tqueue.append(p)
+
+    def _send_to_proxy(self):
+        """Send a queued websocket packet to vnc."""
+        sent = self.tqueue.send_to(self.proxy_socket)
+        if not sent:
+            return
+        self.counters['bytes_to_target'] += sent
+        self.counters['packets_to_target'] += 1
+
+        # Messages the websocket buffered while we were paused won't make
+        # its socket readable again
+        if not self.tqueue.paused and self.ws.pending():
+            self._recv_from_ws()
+
+    def _recv_from_proxy(self):
+        """Receive a vnc packet and queue it for the websocket."""
+        size = recv_tunnel(self.proxy_socket, self.recv_buffer)
+        if size is None:
+            return
+        if size == 0:
+            logger.warning('Target closed connection')
+            self.closed = True
+            return
+        self.counters['bytes_from_target'] += size
+        self.counters['packets_from_target'] += 1
+        # Only copy what we received, the buffer is reused
+        self.cqueue.append(self.recv_view[:size].tobytes())
+        if self.flush_at is None and self.coalesce_delay:
+            self.flush_at = time.time() + self.coalesce_delay
+
+    def finish(self):
+        """Close the session once the multiplexer is done with it."""
         self.close(wait=True, abort=True)
-
-        return []
+        self.server.sessions.remove(self)
+        self.server.metrics.session_closed(self.counters)
+        if self.finished is not None:
+            self.finished.put(True)
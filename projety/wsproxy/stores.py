@@ -0,0 +1,239 @@
+"""Storage of remote control tokens."""
+from __future__ import absolute_import
+
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryTokenStore(object):
+    """
+    Keep tokens in the memory of the current process.
+
+    This is the default, it only works when a single process serves both the
+    token creation and the websocket connections.
+
+    Tokens are stored as dictionaries (see ``Token.dump``) and indexed by
+    uuid and by minion. Each token has a deadline, ``last_seen`` plus its
+    ``expiration``.
+    """
+
+    def __init__(self):
+        """Init."""
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.minions = {}
+
+    def add(self, data):
+        """Store a token, return False if the minion already has one."""
+        with self.lock:
+            if data['minion'] in self.minions:
+                return False
+            self.minions[data['minion']] = data['id']
+            self.tokens[data['id']] = dict(data)
+            return True
+
+    def get(self, uid):
+        """Return a token or None."""
+        data = self.tokens.get(uid)
+        if data is not None:
+            data = dict(data)
+        return data
+
+    def get_minion(self, minion):
+        """Return the token of a minion or None."""
+        uid = self.minions.get(minion)
+        if uid is None:
+            return None
+        return self.get(uid)
+
+    def refresh(self, uid, last_seen):
+        """Update last_seen, return False if the token does not exist."""
+        with self.lock:
+            if uid not in self.tokens:
+                return False
+            self.tokens[uid]['last_seen'] = last_seen
+            return True
+
+    def delete(self, uid):
+        """
+        Remove a token and return it.
+
+        Only one caller gets the token back, it is the one in charge of
+        closing the tunnel.
+        """
+        with self.lock:
+            data = self.tokens.pop(uid, None)
+            if data is not None and \
+                    self.minions.get(data['minion']) == uid:
+                del self.minions[data['minion']]
+            return data
+
+    def expired(self, now=None):
+        """Return the uuids of tokens past their deadline."""
+        if now is None:
+            now = int(time.time())
+        with self.lock:
+            return [uid for uid, data in self.tokens.items()
+                    if data['last_seen'] + data['expiration'] < now]
+
+    def all(self):
+        """Return all the tokens."""
+        with self.lock:
+            return [dict(data) for data in self.tokens.values()]
+
+
+class RedisTokenStore(object):
+    """
+    Keep tokens in Redis, to share them between all the API workers.
+
+    Keys used, under ``prefix``:
+
+    - ``token:<uuid>``: the token as json
+    - ``minion:<minion>``: the uuid of the token of a minion
+    - ``expiry``: sorted set of uuids, scored by deadline
+
+    Keys get a TTL of the token expiration plus ``grace`` seconds, refreshed
+    with the token, so the cleaning task can still read an expired token to
+    close its tunnel, and nothing is left behind if no one does.
+
+    :param redis: A ``redis.StrictRedis`` client (or a compatible object).
+    :param prefix: Prefix of all the keys.
+    :param grace: Seconds the keys are kept after the token expiration.
+    """
+
+    def __init__(self, redis, prefix='projety:wsproxy:', grace=300):
+        """Init."""
+        self.redis = redis
+        self.prefix = prefix
+        self.grace = grace
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        """Create a store connected to a Redis url."""
+        import redis
+        return cls(redis.StrictRedis.from_url(url), **kwargs)
+
+    def _token_key(self, uid):
+        return '{0}token:{1}'.format(self.prefix, uid)
+
+    def _minion_key(self, minion):
+        return '{0}minion:{1}'.format(self.prefix, minion)
+
+    @property
+    def _expiry_key(self):
+        return '{0}expiry'.format(self.prefix)
+
+    def _ttl(self, data):
+        return int(data['expiration']) + self.grace
+
+    def _deadline(self, data):
+        return int(data['last_seen']) + int(data['expiration'])
+
+    def _decode(self, raw):
+        if raw is None:
+            return None
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8')
+        return json.loads(raw)
+
+    def add(self, data):
+        """Store a token, return False if the minion already has one."""
+        ttl = self._ttl(data)
+        minion_key = self._minion_key(data['minion'])
+
+        # The minion key decides which worker owns the token, it is written
+        # with the token in one transaction
+        def create(pipe):
+            if pipe.exists(minion_key):
+                return False
+            pipe.multi()
+            pipe.set(minion_key, data['id'], ex=ttl)
+            pipe.set(self._token_key(data['id']), json.dumps(data), ex=ttl)
+            pipe.zadd(self._expiry_key, **{data['id']: self._deadline(data)})
+            return True
+        return self.redis.transaction(create, minion_key,
+                                      value_from_callable=True)
+
+    def get(self, uid):
+        """Return a token or None."""
+        return self._decode(self.redis.get(self._token_key(uid)))
+
+    def get_minion(self, minion):
+        """Return the token of a minion or None."""
+        uid = self.redis.get(self._minion_key(minion))
+        if uid is None:
+            return None
+        if isinstance(uid, bytes):
+            uid = uid.decode('utf-8')
+        return self.get(uid)
+
+    def refresh(self, uid, last_seen):
+        """
+        Update last_seen, return False if the token does not exist.
+
+        The token key is watched: a concurrent refresh or delete makes the
+        transaction start again, so no update is lost and a deleted token
+        is not put back in the expiry set.
+        """
+        key = self._token_key(uid)
+
+        def update(pipe):
+            data = self._decode(pipe.get(key))
+            if data is None:
+                return False
+            data['last_seen'] = last_seen
+            ttl = self._ttl(data)
+            pipe.multi()
+            pipe.set(key, json.dumps(data), ex=ttl)
+            pipe.expire(self._minion_key(data['minion']), ttl)
+            pipe.zadd(self._expiry_key, **{uid: self._deadline(data)})
+            return True
+        return self.redis.transaction(update, key, value_from_callable=True)
+
+    def delete(self, uid):
+        """
+        Remove a token and return it.
+
+        Only the caller whose DEL removed the key gets the token back, it is
+        the one in charge of closing the tunnel.
+        """
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.get(self._token_key(uid))
+        pipe.delete(self._token_key(uid))
+        pipe.zrem(self._expiry_key, uid)
+        raw, deleted, removed = pipe.execute()
+        data = self._decode(raw)
+        if not deleted or data is None:
+            return None
+
+        minion_key = self._minion_key(data['minion'])
+        current = self.redis.get(minion_key)
+        if isinstance(current, bytes):
+            current = current.decode('utf-8')
+        if current == uid:
+            self.redis.delete(minion_key)
+        return data
+
+    def expired(self, now=None):
+        """Return the uuids of tokens past their deadline."""
+        if now is None:
+            now = int(time.time())
+        uids = self.redis.zrangebyscore(self._expiry_key, '-inf',
+                                        '({0}'.format(now))
+        return [uid.decode('utf-8') if isinstance(uid, bytes) else uid
+                for uid in uids]
+
+    def all(self):
+        """Return all the tokens."""
+        uids = self.redis.zrange(self._expiry_key, 0, -1)
+        if not uids:
+            return []
+        keys = [self._token_key(uid.decode('utf-8')
+                                if isinstance(uid, bytes) else uid)
+                for uid in uids]
+        tokens = (self._decode(raw) for raw in self.redis.mget(keys))
+        return [data for data in tokens if data is not None]
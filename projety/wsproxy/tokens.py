@@ -10,8 +10,10 @@ import signal
 import logging
 
 from ..exceptions import SaltError, ValidationError
-from ..utils import get_open_port, get_ssh_host_key_fingerprint
-from ..salt import Job
+from .stores import MemoryTokenStore
+from .resources import TunnelResources
+from .scheduler import ExpiryScheduler
+from .tunnels import Tunnel, close_tunnels
 
 logger = logging.getLogger(__name__)
 
@@ -19,34 +21,40 @@ logger = logging.getLogger(__name__)
 class Token(object):
     """Manage a token for a minion."""
 
-    def __init__(self, minion, expiration=3600):
-        """Init."""
+    def __init__(self, tunnel, expiration=3600):
+        """Init, using an opened tunnel."""
         # We want connection to close correctly
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
 
-        self.minion = minion
+        self.minion = tunnel.minion
         self.last_seen = int(time.time())
-        self.port = get_open_port()
         self.expiration = expiration
         self.uuid = uuid.uuid4().hex
-        self.pid = None
-
-        job = Job()
-        result = job.run(minion,
-                         'remote_control.create_ssh_connection',
-                         kwarg={
-                             'port': self.port,
-                             'hostkey': get_ssh_host_key_fingerprint()}
-                         )
-
-        if not result:
-            raise SaltError('Unable to create secure connection to' +
-                            '{0}'.format(minion))
-        if 'pid' not in result:
-            raise SaltError('Unable to get pid of tunnel on ' +
-                            '{0}'.format(minion))
-        self.pid = result['pid']
+        self.tunnel = tunnel
+        self.port = tunnel.port
+        self.pid = tunnel.pid
+
+    @classmethod
+    def load(cls, data, resources=None):
+        """Rebuild a token from its stored data, without a new tunnel."""
+        token = cls.__new__(cls)
+        token.uuid = data['id']
+        token.minion = data['minion']
+        token.last_seen = data['last_seen']
+        token.expiration = data['expiration']
+        token.port = data['port']
+        token.pid = data['pid']
+        token.tunnel = Tunnel(token.minion, token.port, token.pid,
+                              resources=resources)
+        return token
+
+    def dump(self):
+        """Return the data needed to store the token."""
+        data = self.serialize()
+        data['port'] = self.port
+        data['pid'] = self.pid
+        return data
 
     def exit_gracefully(self, signum, frame):
         """Close connection."""
@@ -66,23 +74,24 @@ class Token(object):
                 'last_seen': self.last_seen,
                 'expiration': self.expiration}
 
-    def __del__(self):
-        """On token deletion, close pid."""
-        logger.info('deleting token {0}'.format(self))
+    def close(self):
+        """Close the tunnel of the token."""
+        logger.info('closing token {0}'.format(self))
         self._close_connection()
 
     def _close_connection(self):
         """Terminate a connection."""
-        if self.pid:
-            job = Job(async=True)
-            job.run(self.minion,
-                    'remote_control.close_ssh_connection',
-                    [self.pid])
+        self.tunnel.close()
 
     def refresh(self):
         """Refresh last_seen property."""
         self.last_seen = int(time.time())
 
+    @property
+    def deadline(self):
+        """Return the timestamp after which the token is expired."""
+        return self.last_seen + self.expiration
+
     def is_expired(self):
         """Return whether a token is expired or not."""
         now = int(time.time())
@@ -96,75 +105,130 @@ class Token(object):
             return True
         except:
             return False
+        finally:
+            s.close()
 
 
 class TokenManager(object):
-    """Manage all the token created during the app lifetime."""
+    """
+    Manage all the token created during the app lifetime.
+
+    Tokens are kept in a store, in memory by default, or in Redis to share
+    them between workers (see :mod:`.stores`). Token objects returned are
+    rebuilt from the store, closing the tunnel is always explicit.
+
+    When a tunnel pool is given (see :mod:`.tunnels`), new tokens use one of
+    its tunnels if there is one ready for the minion. Other tunnels are
+    opened using ``resources`` (see :mod:`.resources`).
+
+    Tokens are expired by a scheduler (see :mod:`.scheduler`), started with
+    ``scheduler.start()``, reloading the store every ``resync`` seconds.
+    """
 
-    def __init__(self):
+    def __init__(self, store=None, pool=None, resources=None, resync=None):
         """Init our token manager."""
-        self.tokens = {}
-        self.uuids = {}
+        if store is None:
+            store = MemoryTokenStore()
+        if resources is None:
+            resources = TunnelResources()
+        self.store = store
+        self.pool = pool
+        self.resources = resources
+        self.scheduler = ExpiryScheduler(self, resync)
 
     def _create_token(self, minion, expiration):
         """Really create a token."""
-        token = Token(minion, expiration=expiration)
-        self.tokens[minion] = token
-        self.uuids[token.uuid] = token
+        tunnel = None
+        if self.pool is not None:
+            tunnel = self.pool.acquire(minion)
+        pooled = tunnel is not None
+        if not pooled:
+            tunnel = Tunnel.open(minion, self.resources)
+        token = Token(tunnel, expiration=expiration)
+        if not self.store.add(token.dump()):
+            # Another worker was faster, use its token
+            if pooled:
+                self.pool.release(tunnel)
+            else:
+                token.close()
+            data = self.store.get_minion(minion)
+            if data is None:
+                raise SaltError('Unable to store token for ' +
+                                '{0}'.format(minion))
+            return Token.load(data, self.resources)
+        self.scheduler.schedule(token.uuid, token.deadline)
         return token
 
     def create_token(self, minion, expiration=3600):
         """Create a new token for a minion."""
-        if minion in self.tokens:
-            token = self.tokens[minion]
+        token = self.get_minion_token(minion)
+        if token:
             if token.ping():
                 token.refresh()
+                self.store.refresh(token.uuid, token.last_seen)
+                self.scheduler.schedule(token.uuid, token.deadline)
                 return token
             else:
                 # Clean token
-                self._delete_token(token.minion, token.uuid)
-                return self._create_token(minion, expiration)
-        else:
-            return self._create_token(minion, expiration)
+                self._delete_token(token.uuid)
+        return self._create_token(minion, expiration)
 
     def get_token(self, token):
         """Try to fetch a token."""
-        if token not in self.uuids:
+        data = self.store.get(token)
+        if data is None:
             return False
-        return self.uuids[token]
+        return Token.load(data, self.resources)
 
     def get_minion_token(self, minion):
         """Try to fetch a token for a minion."""
-        if minion not in self.tokens:
+        data = self.store.get_minion(minion)
+        if data is None:
             return False
-        return self.tokens[minion]
+        return Token.load(data, self.resources)
 
     def delete_token(self, token):
         """Try to delete a token."""
-        token = self.get_token(token)
-        if not token:
+        if not self._delete_token(token):
             raise ValidationError('Token {0} not found'.format(token))
-        else:
-            uuid = token.uuid
-            minion = token.minion
-            return self._delete_token(minion, uuid)
 
-    def _delete_token(self, minion, uid):
-        """Clean all references to the token."""
-        del self.tokens[minion]
-        del self.uuids[uid]
+    def _delete_token(self, uid):
+        """Remove the token from the store and close its tunnel."""
+        self.scheduler.cancel(uid)
+        data = self.store.delete(uid)
+        if data is None:
+            return False
+        Token.load(data, self.resources).close()
+        return True
+
+    def expire(self, uids):
+        """
+        Delete the tokens still expired, return how many.
+
+        Tokens refreshed meanwhile (by another worker) are scheduled again.
+        Tunnels are closed together, see ``close_tunnels``.
+        """
+        tunnels = []
+        for uid in uids:
+            data = self.store.get(uid)
+            if data is None:
+                continue
+            token = Token.load(data, self.resources)
+            if not token.is_expired():
+                self.scheduler.schedule(uid, token.deadline)
+                continue
+            data = self.store.delete(uid)
+            if data is not None:
+                logger.info('expiring token {0}'.format(token))
+                tunnels.append(Token.load(data, self.resources).tunnel)
+        close_tunnels(tunnels)
+        return len(tunnels)
 
     def clean_old_tokens(self):
         """
         Will check which token needs to be deleted.
 
-        It will send a salt job to kill the minion pid
+        It will send a salt job to kill the minion pid. The scheduler does
+        this when tokens expire, this scans the whole store.
         """
-        to_delete = []
-        for minion, token in self.tokens.iteritems():
-            if token.is_expired():
-                # Not deleting directly, because of iteritems
-                to_delete.append((minion, token.uuid))
-
-        for minion, uid in to_delete:
-            self._delete_token(minion, uuid)
+        return self.expire(self.store.expired())
@@ -0,0 +1,271 @@
+"""Ssh tunnels from minions to the master, used by remote control."""
+from __future__ import absolute_import
+
+import atexit
+import collections
+import logging
+import socket
+import threading
+import time
+
+from ..exceptions import SaltError, SaltACLError
+from ..salt import Job, is_task_allowed
+
+logger = logging.getLogger(__name__)
+
+CREATE_FUNCTION = 'remote_control.create_ssh_connection'
+CLOSE_FUNCTION = 'remote_control.close_ssh_connection'
+
+
+class Tunnel(object):
+    """An ssh tunnel opened by a minion to a local port of the master."""
+
+    def __init__(self, minion, port, pid, created_at=None, resources=None):
+        """Init."""
+        self.minion = minion
+        self.port = port
+        self.pid = pid
+        if created_at is None:
+            created_at = int(time.time())
+        self.created_at = created_at
+        self.resources = resources
+
+    @classmethod
+    def open(cls, minion, resources, background=False):
+        """
+        Ask the minion to open a tunnel, raise SaltError on failure.
+
+        The port comes from ``resources`` (see :mod:`.resources`), it is
+        released when the tunnel is closed.
+
+        In ``background`` mode there is no current user, so neither the ACL
+        nor the minion functions are checked.
+        """
+        port = resources.ports.allocate()
+        kwarg = {'port': port, 'hostkey': resources.fingerprint()}
+        try:
+            if background:
+                job = Job(only_one=False, bypass_check=True)
+                result = job.run(minion, CREATE_FUNCTION, kwarg=kwarg)
+                result = result.get(minion) if result else None
+            else:
+                job = Job()
+                result = job.run(minion, CREATE_FUNCTION, kwarg=kwarg)
+
+            if not result:
+                raise SaltError('Unable to create secure connection to' +
+                                '{0}'.format(minion))
+            if 'pid' not in result:
+                raise SaltError('Unable to get pid of tunnel on ' +
+                                '{0}'.format(minion))
+        except Exception:
+            resources.ports.release(port)
+            raise
+        return cls(minion, port, result['pid'], resources=resources)
+
+    def __repr__(self):
+        """Represent a tunnel."""
+        return 'Tunnel for {0}, port {1}, pid {2}'.format(
+            self.minion,
+            self.port,
+            self.pid)
+
+    def close(self):
+        """Ask the minion to kill the tunnel, and release its port."""
+        try:
+            if self.pid:
+                job = Job(async=True, bypass_check=True)
+                job.run(self.minion, CLOSE_FUNCTION, [self.pid])
+        finally:
+            if self.resources is not None:
+                self.resources.ports.release(self.port)
+
+    def ping(self):
+        """Check if the tunnel is still listening."""
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.connect(('127.0.0.1', self.port))
+            return True
+        except socket.error:
+            return False
+        finally:
+            s.close()
+
+
+def close_tunnels(tunnels):
+    """
+    Close many tunnels, one salt job each, and release all their ports.
+
+    The close function only takes the pid of a tunnel and it differs on
+    every minion, so jobs can't be shared. A job failing doesn't keep the
+    other tunnels open.
+    """
+    try:
+        for tunnel in tunnels:
+            if not tunnel.pid:
+                continue
+            logger.info('closing {0}'.format(tunnel))
+            try:
+                job = Job(async=True, bypass_check=True)
+                job.run(tunnel.minion, CLOSE_FUNCTION, [tunnel.pid])
+            except SaltError:
+                logger.exception('Cannot close {0}'.format(tunnel))
+    finally:
+        for tunnel in tunnels:
+            if tunnel.resources is not None:
+                tunnel.resources.ports.release(tunnel.port)
+
+
+class TunnelPool(object):
+    """
+    Keep tunnels opened in advance for frequently accessed minions.
+
+    Tunnels are kept for the ``minions`` given, and for the ``top`` minions
+    the most asked for, ``size`` tunnels per minion. A token created for one
+    of these minions takes a tunnel from the pool instead of waiting for
+    the salt job, and the pool is replenished in the background.
+
+    Tunnels older than ``max_age`` seconds are closed and replaced by
+    ``maintain``, which is called periodically.
+
+    :param server: The WsProxy, used to start background tasks.
+    :param resources: The TunnelResources used to open tunnels.
+    :param minions: List of minions to always keep tunnels for.
+    :param top: Number of most requested minions to keep tunnels for.
+    :param size: Number of tunnels to keep per minion.
+    :param max_age: Seconds after which an idle tunnel is replaced.
+    """
+
+    def __init__(self, server, resources, minions=None, top=0, size=1,
+                 max_age=3600):
+        """Init."""
+        self.server = server
+        self.resources = resources
+        self.minions = list(minions or [])
+        self.top = top
+        self.size = size
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.tunnels = collections.defaultdict(collections.deque)
+        self.requests = collections.Counter()
+        self.filling = set()
+        atexit.register(self.close_all)
+
+    @property
+    def enabled(self):
+        """Return whether we keep any tunnel."""
+        return self.size > 0 and (self.minions or self.top > 0)
+
+    def targets(self):
+        """Return the minions we keep tunnels for."""
+        targets = list(self.minions)
+        if self.top > 0:
+            with self.lock:
+                common = self.requests.most_common(self.top)
+            for minion, count in common:
+                if minion not in targets:
+                    targets.append(minion)
+        return targets
+
+    def acquire(self, minion):
+        """
+        Return a ready tunnel for a minion, or None.
+
+        The current user must be allowed to open the tunnel, as when it is
+        created on demand.
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            self.requests[minion] += 1
+            tunnels = self.tunnels.get(minion)
+            if not tunnels:
+                tunnel = None
+            else:
+                tunnel = tunnels.popleft()
+
+        if minion in self.targets():
+            self.replenish(minion)
+        if tunnel is None:
+            return None
+
+        if not is_task_allowed(minion, CREATE_FUNCTION, (), 'glob'):
+            self.release(tunnel)
+            raise SaltACLError(minion, CREATE_FUNCTION, ())
+
+        if not tunnel.ping():
+            logger.info('pooled {0} is dead'.format(tunnel))
+            tunnel.close()
+            return None
+        return tunnel
+
+    def release(self, tunnel):
+        """Give back an unused tunnel."""
+        with self.lock:
+            self.tunnels[tunnel.minion].append(tunnel)
+
+    def replenish(self, minion):
+        """Open missing tunnels for a minion in the background."""
+        with self.lock:
+            if minion in self.filling:
+                return
+            if len(self.tunnels[minion]) >= self.size:
+                return
+            self.filling.add(minion)
+        self.server.start_background_task(self._fill, minion)
+
+    def _fill(self, minion):
+        try:
+            while len(self.tunnels[minion]) < self.size:
+                tunnel = Tunnel.open(minion, self.resources,
+                                     background=True)
+                logger.info('pooled {0}'.format(tunnel))
+                self.release(tunnel)
+        except Exception:
+            logger.exception('Unable to prewarm tunnel for ' +
+                             '{0}'.format(minion))
+        finally:
+            with self.lock:
+                self.filling.discard(minion)
+
+    def maintain(self):
+        """Close old tunnels and replenish the pool."""
+        if not self.enabled:
+            return
+        targets = self.targets()
+        deadline = int(time.time()) - self.max_age
+        to_close = []
+        with self.lock:
+            for minion, tunnels in self.tunnels.items():
+                keep = collections.deque()
+                for tunnel in tunnels:
+                    if minion in targets and tunnel.created_at > deadline:
+                        keep.append(tunnel)
+                    else:
+                        to_close.append(tunnel)
+                self.tunnels[minion] = keep
+
+        for tunnel in to_close:
+            logger.info('closing pooled {0}'.format(tunnel))
+            tunnel.close()
+
+        for minion in targets:
+            self.replenish(minion)
+
+    def close_all(self):
+        """Close every pooled tunnel."""
+        with self.lock:
+            tunnels = [tunnel for minion_tunnels in self.tunnels.values()
+                       for tunnel in minion_tunnels]
+            self.tunnels.clear()
+        for tunnel in tunnels:
+            try:
+                tunnel.close()
+            except Exception:
+                logger.exception('Unable to close {0}'.format(tunnel))
+
+    def stats(self):
+        """Return the number of ready tunnels per minion."""
+        with self.lock:
+            return dict((minion, len(tunnels))
+                        for minion, tunnels in self.tunnels.items())
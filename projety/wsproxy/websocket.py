@@ -0,0 +1,306 @@
+"""
+Minimal non-blocking RFC 6455 websocket, used by every proxy session.
+
+The websocket classes of the async modes neither negotiate extensions nor
+echo the subprotocol, so when an extension or the base64 subprotocol is
+accepted we answer the handshake ourselves on the raw socket. Their
+``wait()`` and ``send()`` also block, which would stall the multiplexer
+shared by all the sessions, so the messages are always framed here.
+"""
+from __future__ import absolute_import
+
+import binascii
+import errno
+import logging
+import socket
+import struct
+
+from .buffer import RelayBuffer
+from .deflate import DeflateError
+
+logger = logging.getLogger(__name__)
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+FIN = 0x80
+RSV1 = 0x40
+MASK = 0x80
+
+# Close codes
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_INVALID_DATA = 1007
+CLOSE_TOO_BIG = 1009
+
+# Bytes of frames already read kept at the start of the buffer before it is
+# compacted
+COMPACT_SIZE = 65536
+
+
+class ProtocolError(Exception):
+    """The client sent an invalid frame."""
+
+    def __init__(self, message, code=CLOSE_PROTOCOL_ERROR):
+        """Init."""
+        super(ProtocolError, self).__init__(message)
+        self.code = code
+
+
+def handshake_response(headers):
+    """Return the raw 101 response, headers are ``(name, value)`` pairs."""
+    lines = ['HTTP/1.1 101 Switching Protocols']
+    lines.extend('{0}: {1}'.format(name, value) for name, value in headers)
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+def unmask(data, mask):
+    """Xor data with a 4 bytes mask, using big integers to go fast."""
+    length = len(data)
+    if not length:
+        return b''
+    key = (mask * (length // 4 + 1))[:length]
+    value = int(binascii.hexlify(data), 16) ^ int(binascii.hexlify(key), 16)
+    return binascii.unhexlify('{0:0{1}x}'.format(value, length * 2))
+
+
+def encode_frame(opcode, payload, rsv1=False):
+    """Return an unmasked frame, as sent by servers."""
+    first = FIN | opcode
+    if rsv1:
+        first |= RSV1
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', first, length)
+    elif length < 65536:
+        header = struct.pack('!BBH', first, 126, length)
+    else:
+        header = struct.pack('!BBQ', first, 127, length)
+    return header + payload
+
+
+class WebSocket(object):
+    """
+    Non-blocking websocket on a raw socket, for the multiplexer.
+
+    ``wait()`` returns the next message, or None when no complete message
+    is buffered yet or once ``closed``. ``send()`` sends a text message for
+    unicode and a binary one otherwise: frames are queued in ``output`` and
+    written as far as the socket accepts, ``flush()`` writes the rest when
+    the socket is writable again. Nothing ever blocks, a slow or stalled
+    client only delays its own session.
+
+    :param sock: The socket, after the handshake.
+    :param deflate: A DeflateSession when permessage-deflate was accepted.
+    :param max_message_size: Limit of a message from the client.
+    """
+
+    def __init__(self, sock, deflate=None, max_message_size=16 * 1024 * 1024):
+        """Init."""
+        self.socket = sock
+        self.socket.setblocking(False)
+        self.deflate = deflate
+        self.max_message_size = max_message_size
+        # Data read from the socket, parsed from offset. Frames read are
+        # only dropped from time to time, see _compact
+        self.buffer = bytearray()
+        self.offset = 0
+        self.output = RelayBuffer()
+        self.closed = False
+
+        # Message being reassembled from fragments
+        self._fragments = []
+        self._fragments_size = 0
+        self._compressed = False
+
+    def _parse_header(self):
+        """Return ``(header size, first byte, payload size, mask)``."""
+        available = len(self.buffer) - self.offset
+        if available < 2:
+            return None
+        first, second = struct.unpack_from('!BB', self.buffer, self.offset)
+        length = second & 0x7f
+        pos = 2
+        if length == 126:
+            if available < 4:
+                return None
+            length = struct.unpack_from('!H', self.buffer,
+                                        self.offset + 2)[0]
+            pos = 4
+        elif length == 127:
+            if available < 10:
+                return None
+            length = struct.unpack_from('!Q', self.buffer,
+                                        self.offset + 2)[0]
+            pos = 10
+        if not second & MASK:
+            raise ProtocolError('Client frames must be masked')
+        if available < pos + 4:
+            return None
+        start = self.offset + pos
+        mask = bytes(self.buffer[start:start + 4])
+        return pos + 4, first, length, mask
+
+    def _next_frame(self):
+        """Return ``(first byte, payload)`` of a buffered frame, or None."""
+        header = self._parse_header()
+        if header is None:
+            return None
+        size, first, length, mask = header
+        if length > self.max_message_size:
+            raise ProtocolError('Frame too big', CLOSE_TOO_BIG)
+        if len(self.buffer) - self.offset < size + length:
+            return None
+        start = self.offset + size
+        payload = unmask(memoryview(self.buffer)[start:start + length]
+                         .tobytes(), mask)
+        self.offset = start + length
+        self._compact()
+        return first, payload
+
+    def _compact(self):
+        """Drop the frames already read, rarely to stay linear."""
+        if self.offset == len(self.buffer):
+            del self.buffer[:]
+            self.offset = 0
+        elif self.offset >= COMPACT_SIZE and \
+                self.offset * 2 >= len(self.buffer):
+            del self.buffer[:self.offset]
+            self.offset = 0
+
+    def _next_message(self):
+        """Return a buffered message, or None."""
+        while True:
+            frame = self._next_frame()
+            if frame is None:
+                return None
+            first, payload = frame
+            opcode = first & 0x0f
+            rsv1 = bool(first & RSV1)
+            if first & 0x30 or (rsv1 and self.deflate is None):
+                raise ProtocolError('Unexpected reserved bits')
+
+            if opcode >= OPCODE_CLOSE:
+                if not first & FIN or len(payload) > 125:
+                    raise ProtocolError('Invalid control frame')
+                if opcode == OPCODE_CLOSE:
+                    self._close(payload[:2] or None)
+                    return None
+                if opcode == OPCODE_PING:
+                    self._send_frame(OPCODE_PONG, payload)
+                continue
+
+            if opcode == OPCODE_CONTINUATION:
+                if not self._fragments:
+                    raise ProtocolError('Unexpected continuation frame')
+                if rsv1:
+                    raise ProtocolError('Unexpected reserved bits')
+            elif opcode in (OPCODE_TEXT, OPCODE_BINARY):
+                if self._fragments:
+                    raise ProtocolError('Expected continuation frame')
+                self._compressed = rsv1
+            else:
+                raise ProtocolError('Unknown opcode {0}'.format(opcode))
+
+            self._fragments.append(payload)
+            self._fragments_size += len(payload)
+            if self._fragments_size > self.max_message_size:
+                raise ProtocolError('Message too big', CLOSE_TOO_BIG)
+            if not first & FIN:
+                continue
+
+            message = b''.join(self._fragments)
+            self._fragments = []
+            self._fragments_size = 0
+            if self._compressed:
+                try:
+                    message = self.deflate.decompress(message)
+                except DeflateError as e:
+                    raise ProtocolError(str(e), CLOSE_INVALID_DATA)
+            return message
+
+    def pending(self):
+        """Return whether a complete frame is already buffered."""
+        try:
+            header = self._parse_header()
+        except ProtocolError:
+            return True
+        return header is not None and \
+            len(self.buffer) - self.offset >= header[0] + header[2]
+
+    def wait(self):
+        """Return the next message, None if not complete yet or closed."""
+        received = False
+        while not self.closed:
+            try:
+                message = self._next_message()
+            except ProtocolError as e:
+                logger.warning('websocket: {0}'.format(e))
+                self._close(struct.pack('!H', e.code))
+                return None
+            if message is not None or self.closed or received:
+                return message
+            # A single read per call, the multiplexer calls us again while
+            # the socket is readable
+            try:
+                data = self.socket.recv(65536)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.closed = True
+                return None
+            if not data:
+                self.closed = True
+                return None
+            self.buffer += data
+            received = True
+        return None
+
+    def pending_output(self):
+        """Return whether frames are waiting for the socket."""
+        return bool(self.output)
+
+    def flush(self):
+        """Write queued frames until the socket is full, True when done."""
+        try:
+            while self.output:
+                if not self.output.send_to(self.socket):
+                    return False
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.closed = True
+                self.output = RelayBuffer()
+            return not self.output
+        return True
+
+    def _send_frame(self, opcode, payload, rsv1=False):
+        self.output.append(encode_frame(opcode, payload, rsv1))
+        self.flush()
+
+    def send(self, message):
+        """Send a message, compressed if negotiated."""
+        opcode = OPCODE_BINARY
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+            opcode = OPCODE_TEXT
+        compressed = False
+        if self.deflate is not None:
+            compressed, message = self.deflate.compress(message)
+        self._send_frame(opcode, message, compressed)
+
+    def _close(self, payload=None):
+        """Answer or send a close frame."""
+        if self.closed:
+            return
+        self.closed = True
+        if payload is None:
+            payload = struct.pack('!H', CLOSE_NORMAL)
+        # Best effort, the socket is closed soon after
+        self._send_frame(OPCODE_CLOSE, payload)
+
+    def close(self):
+        """Close the websocket."""
+        self._close()
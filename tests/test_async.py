@@ -1,6 +1,11 @@
 """All the tests of our project."""
+import json
 import logging
 
+from kombu.serialization import dumps, loads
+
+from projety.api.async import request_environ, run_flask_request
+from projety.json_backend import CELERY_SERIALIZER
 from utils import TestAPI
 
 logger = logging.getLogger(__name__)
@@ -31,3 +36,26 @@ class TestAsync(TestAPI):
 
         # check that we have the minion in keys
         assert minion in r
+
+    def test_serialized_environ(self):
+        """Test that requests survive the json serialization of Celery."""
+        app = self.client.application
+        minion = self.valid_minion
+        headers = self.get_headers(token_auth=self.valid_token)
+        for data in (None, json.dumps({'target': [minion]})):
+            url = '/api/v1.0/tasks/ping'
+            if data is None:
+                url += '/' + minion
+            with app.test_request_context(url, method='POST', data=data,
+                                          headers=headers):
+                environ = request_environ()
+
+            # What a worker gets, unlike the eager tasks of the tests
+            content_type, encoding, body = dumps(
+                environ, serializer=CELERY_SERIALIZER)
+            environ = loads(body, content_type, encoding)
+            assert isinstance(environ['_wsgi.input'], unicode)
+
+            r, s, h = run_flask_request(environ)
+            assert s == 200
+            assert json.loads(r)[minion] is True
@@ -0,0 +1,27 @@
+"""All the tests of our project."""
+import logging
+
+from benchmarks.endpoints import percentile
+
+logger = logging.getLogger(__name__)
+
+
+class TestBenchmarks(object):
+    """Test for the helpers of the benchmarks."""
+
+    def test_percentile(self):
+        """Test the nearest-rank percentiles on known values."""
+        values = list(range(1, 11))
+        assert percentile(values, 50) == 5
+        assert percentile(values, 95) == 10
+        assert percentile(values, 99) == 10
+        assert percentile(values, 10) == 1
+        assert percentile(values, 0) == 1
+        assert percentile(values, 100) == 10
+
+        values = list(range(1, 101))
+        assert percentile(values, 50) == 50
+        assert percentile(values, 95) == 95
+        assert percentile(values, 99) == 99
+        assert percentile([7], 99) == 7
+        assert percentile([], 50) == 0.0
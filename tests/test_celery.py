@@ -1,4 +1,5 @@
 """All the tests of our project."""
+import base64
 import logging
 
 import mock
@@ -35,7 +36,8 @@ class TestAsyncPing(TestAPI):
             assert m.call_count == 1
             environ = m.call_args_list[0][1]['args'][0]
             logger.warning(environ)
-            assert environ['_wsgi.input'] == b'{"target": ["%s"]}' % minion
+            assert base64.b64decode(environ['_wsgi.input']) == \
+                b'{"target": ["%s"]}' % minion
 
         with mock.patch('projety.api.async.run_flask_request.apply_async',
                         return_value=mock.MagicMock(state='STARTED')) as m:
@@ -47,7 +49,8 @@ class TestAsyncPing(TestAPI):
             assert m.call_count == 1
             environ = m.call_args_list[0][1]['args'][0]
             logger.warning(environ)
-            assert environ['_wsgi.input'] == b'{"target": ["%s"]}' % minion
+            assert base64.b64decode(environ['_wsgi.input']) == \
+                b'{"target": ["%s"]}' % minion
 
         with mock.patch('projety.api.async.run_flask_request.apply_async',
                         return_value=mock.MagicMock(
@@ -63,4 +66,5 @@ class TestAsyncPing(TestAPI):
             assert h['a'] == 'b'
             assert m.call_count == 1
             environ = m.call_args_list[0][1]['args'][0]
-            assert environ['_wsgi.input'] == b'{"target": ["%s"]}' % minion
+            assert base64.b64decode(environ['_wsgi.input']) == \
+                b'{"target": ["%s"]}' % minion
@@ -0,0 +1,271 @@
+"""All the tests of our project."""
+import logging
+import socket
+import threading
+import time
+
+from mock import patch
+
+from projety.wsproxy import WsProxy
+from projety.wsproxy.fanout import JoinError, SharedRing
+from projety.wsproxy.rfb import (ClientStream, RFBError, VIEW_MESSAGES,
+                                 handshake_size)
+from projety.wsproxy.socket import ProxySocket
+
+from test_wsproxy import FakeWebSocket
+
+logger = logging.getLogger(__name__)
+
+# RFB 3.8 handshake with no security, the client answers
+SERVER_HANDSHAKE = (b'RFB 003.008\n', b'\x01\x01', b'\x00\x00\x00\x00')
+CLIENT_HANDSHAKE = (b'RFB 003.008\n', b'\x01', b'\x01')
+UPDATE_REQUEST = b'\x03\x01\x00\x00\x00\x00\x00\x10\x00\x10'
+KEY_EVENT = b'\x04\x01\x00\x00\x00\x00\x00a'
+
+
+class TestFanout(object):
+    """Test for the connections shared between sessions."""
+
+    def join(self, server, port, mode):
+        """
+        Return a shared session with its browser, or None if refused.
+
+        The JoinError of a refused session is kept in ``self.refused``.
+        """
+        ws_socket, browser = socket.socketpair()
+        session = ProxySocket(server, server._generate_id())
+        server.sessions.add(session)
+
+        # Join from a daemon thread, like the requests of the server, the
+        # multiplexer loop started from it won't block the exit
+        joined = []
+
+        def setup():
+            try:
+                joined.append(session.setup_shared_proxy('token', port,
+                                                         mode))
+            except JoinError as e:
+                self.refused = e
+                joined.append(False)
+        thread = threading.Thread(target=setup)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        if not joined[0]:
+            session.close()
+            server.sessions.remove(session)
+            return None
+        thread = threading.Thread(target=session._websocket_handler,
+                                  args=(FakeWebSocket(ws_socket),))
+        thread.daemon = True
+        thread.start()
+        return session, thread, browser
+
+    def recv_exactly(self, sock, size):
+        """Read size bytes from a socket."""
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            assert chunk
+            data += chunk
+        return data
+
+    def test_ring(self):
+        """Test reads at any offset and the drop of old chunks."""
+        ring = SharedRing(10)
+        for data in (b'0123', b'4567', b'89'):
+            ring.append(data)
+        assert ring.read(0, 4) == b'0123'
+        assert ring.read(2, 100) == b'23456789'
+        assert ring.read(5, 2) == b'56'
+        assert ring.read(10, 100) == b''
+
+        ring.append(b'abc')
+        assert ring.start == 4
+        assert len(ring) == 9
+        assert ring.read(4, 100) == b'456789abc'
+        try:
+            ring.read(2, 100)
+            assert False
+        except IndexError:
+            pass
+
+    def wait_input(self, session, size):
+        """Wait for the multiplexer to read size bytes of a session."""
+        for i in range(500):
+            if session.counters['bytes_from_client'] >= size:
+                return
+            time.sleep(0.01)
+        assert False
+
+    def test_handshake_size(self):
+        """Test the size of the client handshakes."""
+        assert handshake_size(b'RFB 003.008\n', b'') is None
+        assert handshake_size(b''.join(CLIENT_HANDSHAKE), b'') == 14
+        assert handshake_size(b'RFB 003.008\n\x02' + b'k' * 16 + b'\x01',
+                              b'') == 30
+        # Version 3.3, the server chooses the security
+        assert handshake_size(b'RFB 003.003\n\x01', b'') is None
+        assert handshake_size(b'RFB 003.003\n\x01',
+                              b'RFB 003.003\n\x00\x00\x00\x01') == 13
+        try:
+            handshake_size(b'GET / HTTP/1.1\r\n', b'')
+            assert False
+        except RFBError:
+            pass
+
+    def test_client_stream(self):
+        """Test the handshake replay and the filter of the messages."""
+        leader = ClientStream()
+        assert leader.feed(CLIENT_HANDSHAKE[0]) == CLIENT_HANDSHAKE[0]
+        assert leader.feed(CLIENT_HANDSHAKE[1]) == CLIENT_HANDSHAKE[1]
+        assert not leader.handshaken
+        data = leader.feed(CLIENT_HANDSHAKE[2] + KEY_EVENT[:3],
+                           allowed=VIEW_MESSAGES)
+        assert data == b'\x01'
+        assert leader.handshaken
+        assert leader.feed(KEY_EVENT[3:] + UPDATE_REQUEST,
+                           allowed=VIEW_MESSAGES) == UPDATE_REQUEST
+
+        viewer = ClientStream(lambda: bytes(leader.handshake))
+        data = b''.join(CLIENT_HANDSHAKE) + KEY_EVENT + UPDATE_REQUEST
+        assert viewer.feed(data[:5], allowed=VIEW_MESSAGES) == b''
+        assert viewer.feed(data[5:], allowed=VIEW_MESSAGES) == UPDATE_REQUEST
+
+        other = ClientStream(lambda: bytes(leader.handshake))
+        try:
+            other.feed(b'RFB 003.003\n')
+            assert False
+        except RFBError:
+            pass
+
+    def test_refused(self):
+        """Test that refused viewers get a 409 saying why."""
+        server = WsProxy(async_mode='threading')
+        environ = {'HTTP_UPGRADE': 'websocket', 'PATH_INFO': '/websockify',
+                   'QUERY_STRING': 'token=token&mode=view'}
+        responses = []
+
+        def start_response(status, headers):
+            responses.append(status)
+
+        with patch.object(server, 'validate_connection') as mock_validate:
+            mock_validate.side_effect = JoinError('Too late')
+            body = server.handle_request(environ, start_response)
+        assert responses == ['409 CONFLICT']
+        assert body == [b'Too late']
+        assert len(server.sessions) == 0
+
+    def test_shared(self):
+        """Test one controller and viewers on one tunnel connection."""
+        server = WsProxy(async_mode='threading', shared_ring_size=1000)
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        port = listener.getsockname()[1]
+
+        controller, controller_thread, controller_browser = self.join(
+            server, port, 'control')
+        target, address = listener.accept()
+        viewer, viewer_thread, viewer_browser = self.join(server, port,
+                                                          'view')
+        assert self.join(server, port, 'control') is None
+        assert len(server.upstreams.stats()) == 1
+
+        # Both get the stream, only the controller input is relayed
+        target.sendall(b'RFB 003.008\n')
+        for browser in (controller_browser, viewer_browser):
+            assert self.recv_exactly(browser, 12) == b'RFB 003.008\n'
+        viewer_browser.sendall(b'ignored')
+        controller_browser.sendall(b'input')
+        assert self.recv_exactly(target, 5) == b'input'
+
+        # Viewers joining late replay the stream from its start
+        late, late_thread, late_browser = self.join(server, port, 'view')
+        assert self.recv_exactly(late_browser, 12) == b'RFB 003.008\n'
+        late_browser.close()
+        late_thread.join(5)
+        assert not late_thread.is_alive()
+
+        # Once the start is dropped from the ring they get a new connection
+        for i in range(3):
+            target.sendall(b'x' * 600)
+            for browser in (controller_browser, viewer_browser):
+                assert self.recv_exactly(browser, 600) == b'x' * 600
+        late, late_thread, late_browser = self.join(server, port, 'view')
+        new_target, address = listener.accept()
+        assert len(server.upstreams.stats()) == 2
+        new_target.sendall(b'RFB 003.008\n')
+        assert self.recv_exactly(late_browser, 12) == b'RFB 003.008\n'
+        late_browser.sendall(b'RFB 003.008\n')
+        assert self.recv_exactly(new_target, 12) == b'RFB 003.008\n'
+
+        # The connections are closed with their last session
+        for browser, thread in ((viewer_browser, viewer_thread),
+                                (controller_browser, controller_thread),
+                                (late_browser, late_thread)):
+            browser.close()
+            thread.join(5)
+            assert not thread.is_alive()
+        assert target.recv(10) == b''
+        assert new_target.recv(10) == b''
+        assert server.upstreams.stats() == []
+        assert len(server.sessions) == 0
+
+    def test_takeover(self):
+        """Test a controller taking over once the first one left."""
+        server = WsProxy(async_mode='threading')
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        port = listener.getsockname()[1]
+
+        controller, controller_thread, controller_browser = self.join(
+            server, port, 'control')
+        target, address = listener.accept()
+        for server_data, client_data in zip(SERVER_HANDSHAKE,
+                                            CLIENT_HANDSHAKE):
+            target.sendall(server_data)
+            self.recv_exactly(controller_browser, len(server_data))
+            controller_browser.sendall(client_data)
+            assert self.recv_exactly(target, len(client_data)) == client_data
+
+        # The viewer handshake and requests are dropped
+        viewer, viewer_thread, viewer_browser = self.join(server, port,
+                                                          'view')
+        viewer_browser.sendall(b''.join(CLIENT_HANDSHAKE) + UPDATE_REQUEST)
+        self.wait_input(viewer, 24)
+        controller_browser.sendall(KEY_EVENT)
+        assert self.recv_exactly(target, 8) == KEY_EVENT
+
+        # Without a controller, the viewer asks for the updates
+        controller_browser.close()
+        controller_thread.join(5)
+        assert not controller_thread.is_alive()
+        assert server.upstreams.stats()[0]['controller'] is None
+        viewer_browser.sendall(KEY_EVENT + UPDATE_REQUEST)
+        assert self.recv_exactly(target, 10) == UPDATE_REQUEST
+
+        # A new controller replays the handshake, its own is dropped
+        controller, controller_thread, controller_browser = self.join(
+            server, port, 'control')
+        size = sum(len(data) for data in SERVER_HANDSHAKE)
+        assert self.recv_exactly(controller_browser, size) == b''.join(
+            SERVER_HANDSHAKE)
+        controller_browser.sendall(b''.join(CLIENT_HANDSHAKE) + KEY_EVENT)
+        assert self.recv_exactly(target, 8) == KEY_EVENT
+
+        # A wrong handshake closes it
+        controller_browser.close()
+        controller_thread.join(5)
+        controller, controller_thread, controller_browser = self.join(
+            server, port, 'control')
+        controller_browser.sendall(b'RFB 003.003\n')
+        controller_thread.join(5)
+        assert not controller_thread.is_alive()
+        assert controller.closed
+
+        viewer_browser.close()
+        viewer_thread.join(5)
+        assert target.recv(10) == b''
+        assert server.upstreams.stats() == []
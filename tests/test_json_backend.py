@@ -0,0 +1,53 @@
+"""All the tests of our project."""
+import json
+import logging
+
+import pytest
+
+from projety.json_backend import BACKENDS, JsonBackend, get_backend, jsonify
+from utils import TestAPI
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.mark.usefixtures('app_class')
+class TestJsonBackend(TestAPI):
+    """Test for json backends."""
+
+    payload = {'minion1': True, 'minion2': False,
+               'minion3': {'ipv4': ['10.0.0.1'], 'num_cpus': 4}}
+
+    def test_backends(self):
+        """Test that every installed backend encodes the same way."""
+        for name in BACKENDS:
+            try:
+                backend = JsonBackend(name)
+            except ImportError:
+                continue
+            encoded = backend.dumps(self.payload, separators=(',', ':'))
+            assert json.loads(encoded) == self.payload
+            assert backend.loads(encoded) == self.payload
+
+    def test_get_backend(self):
+        """Test backend selection."""
+        assert get_backend('json').name == 'json'
+        assert get_backend('auto').name in BACKENDS
+
+        with pytest.raises(ValueError):
+            get_backend('not_a_json_library')
+
+    def test_jsonify(self):
+        """Test jsonify output and pretty print setting."""
+        with self.app.test_request_context():
+            rv = jsonify(self.payload)
+            assert rv.mimetype == 'application/json'
+            assert json.loads(rv.get_data(as_text=True)) == self.payload
+            assert '\n ' not in rv.get_data(as_text=True).rstrip()
+
+            self.app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
+            try:
+                rv = jsonify(minion1=True)
+            finally:
+                self.app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+            assert '\n ' in rv.get_data(as_text=True)
+            assert json.loads(rv.get_data(as_text=True)) == {'minion1': True}
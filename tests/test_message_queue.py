@@ -0,0 +1,54 @@
+"""All the tests of our project."""
+import logging
+import pickle
+
+import pytest
+
+from mock import patch
+
+from projety.message_queue import (SERIALIZERS, SerializedRedisManager,
+                                   get_serializer)
+
+logger = logging.getLogger(__name__)
+
+
+class TestMessageQueue(object):
+    """Test for the serializers of the socket.io message queue."""
+
+    message = {'method': 'emit', 'event': 'job_result',
+               'data': {'minion1': True, 'minion2': False},
+               'namespace': '/', 'room': 'abc', 'skip_sid': None,
+               'callback': None}
+
+    def test_serializers(self):
+        """Test that every serializer gives back the message."""
+        for name in SERIALIZERS:
+            loaded, dumps, loads = get_serializer(name)
+            assert loads(dumps(self.message)) == self.message
+
+        with pytest.raises(ValueError):
+            get_serializer('xml')
+
+    def test_msgpack(self):
+        """Test that msgpack messages keep their text and binary data."""
+        msgpack = pytest.importorskip('msgpack')
+        name, dumps, loads = get_serializer('msgpack')
+        assert name == 'msgpack'
+        message = dict(self.message, data={u'minion\xe9': b'\x00\xff'})
+        data = dumps(message)
+        assert msgpack.unpackb(data, raw=False) == message
+        assert loads(data) == message
+
+    def test_manager(self):
+        """Test publishing and decoding of any format."""
+        manager = SerializedRedisManager('redis://', write_only=True,
+                                         serializer='msgpack')
+        with patch.object(manager.redis, 'publish') as publish:
+            manager.emit('job_result', {'minion1': True}, room='abc')
+            channel, data = publish.call_args[0]
+        assert channel == 'flask-socketio'
+        assert manager.decode(data)['data'] == {'minion1': True}
+
+        # Messages of the servers still using pickle
+        assert manager.decode(pickle.dumps(self.message)) == self.message
+        assert manager.decode(b'not a message') is None
@@ -0,0 +1,123 @@
+"""All the tests of our project."""
+import logging
+
+import pytest
+from mock import patch
+
+from projety.metrics import (Metrics, RedisMetricsStore, merge, exposition,
+                             on_task_publish, on_task_prerun, metrics)
+from projety.metrics import logger as metrics_logger
+from utils import TestAPI, FakeRedis
+
+logger = logging.getLogger(__name__)
+
+
+class FakeRequest(object):
+    """Just what on_task_prerun reads."""
+
+    def __init__(self, headers):
+        """Init."""
+        self.headers = headers
+
+
+class FakeTask(object):
+    """Just what on_task_prerun reads."""
+
+    name = 'projety.events.ping_minions'
+
+    def __init__(self, headers):
+        """Init."""
+        self.request = FakeRequest(headers)
+
+
+@pytest.mark.usefixtures('app_class')
+class TestMetrics(TestAPI):
+    """Test for the Prometheus metrics."""
+
+    def test_merge(self):
+        """Test that the snapshots of many workers are summed."""
+        first = Metrics()
+        first.inc('salt_job_timeouts_total', function='test.ping')
+        first.observe('salt_job_duration_seconds', 0.02, function='test.ping')
+        second = Metrics()
+        second.inc('salt_job_timeouts_total', 2, function='test.ping')
+        second.observe('salt_job_duration_seconds', 3, function='test.ping')
+
+        text = exposition(merge([first.snapshot(), second.snapshot()]))
+        assert '# TYPE salt_job_timeouts_total counter' in text
+        assert 'salt_job_timeouts_total{function="test.ping"} 3' in text
+        assert '# TYPE salt_job_duration_seconds histogram' in text
+        assert 'salt_job_duration_seconds_bucket{function="test.ping",' \
+               'le="0.025"} 1' in text
+        assert 'salt_job_duration_seconds_bucket{function="test.ping",' \
+               'le="+Inf"} 2' in text
+        assert 'salt_job_duration_seconds_count{function="test.ping"} 2' \
+            in text
+
+    def test_redis_store(self):
+        """Test that every worker publishes its snapshot to Redis."""
+        store = RedisMetricsStore(FakeRedis(), ttl=30)
+        workers = [Metrics(), Metrics()]
+        for i, worker in enumerate(workers):
+            worker.inc('cache_requests_total', cache='minions', result='hit')
+            store.publish('worker{0}'.format(i), worker.snapshot())
+
+        assert len(store.snapshots()) == 2
+        assert store.redis.expires['projety:metrics:worker0']
+        text = exposition(merge(store.snapshots()))
+        for i in range(2):
+            assert 'cache_requests_total{cache="minions",result="hit",' \
+                   'worker="worker%d"} 1' % i in text
+
+        # Expired workers are dropped from the registry
+        store.redis.delete('projety:metrics:worker0')
+        assert [s['worker'] for s in store.snapshots()] == ['worker1']
+        assert store.redis.smembers('projety:metrics:workers') == \
+            set(['worker1'])
+
+    def test_publish_errors(self):
+        """Test that a store down is logged once, not at every interval."""
+        worker = Metrics()
+        worker.store = RedisMetricsStore(FakeRedis())
+        worker.interval = 0
+        with patch.object(worker.store, 'publish') as mock_publish, \
+                patch.object(metrics_logger, 'exception') as mock_exception:
+            mock_publish.side_effect = IOError('down')
+            for i in range(3):
+                worker.inc('cache_requests_total')
+            assert mock_publish.call_count == 3
+            assert mock_exception.call_count == 1
+
+            mock_publish.side_effect = None
+            worker.inc('cache_requests_total')
+            assert not worker.failing
+
+    def test_celery_wait(self):
+        """Test that the time tasks wait in the queue is observed."""
+        headers = {}
+        on_task_publish(headers=headers)
+        on_task_prerun(task=FakeTask(headers))
+        on_task_prerun(task=FakeTask({}))
+        text = metrics.exposition()
+        assert 'celery_queue_wait_seconds_count' \
+               '{task="projety.events.ping_minions"} 1' in text
+
+    def test_endpoint(self):
+        """Test that admins can read the metrics of the API."""
+        r, s, h = self.post('/api/v1.0/ping/{0}'.format(self.valid_minion),
+                            token_auth=self.valid_token)
+        assert s == 200
+
+        r, s, h = self.get('/api/metrics', token_auth=self.valid_token)
+        assert s == 200
+        assert h['Content-Type'].startswith('text/plain')
+        assert 'http_request_duration_seconds_count{method="POST",' \
+               'route="/api/v1.0/ping/<string:minion>"}' in r
+        assert 'salt_job_duration_seconds_count{function="test.ping"}' in r
+        assert 'cache_requests_total{cache="minions",result="hit"}' in r
+        assert 'db_query_duration_seconds_count' in r
+        assert 'wsproxy_sessions_active 0' in r
+
+        token = self.get_valid_token(self.restricted_user)
+        r, s, h = self.get('/api/metrics', token_auth=token)
+        assert s == 403
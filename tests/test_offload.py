@@ -0,0 +1,66 @@
+"""All the tests of our project."""
+import logging
+import threading
+import time
+
+import eventlet
+
+from projety.offload import Offloader
+
+logger = logging.getLogger(__name__)
+
+
+class FakeApp(object):
+    """Just what init_app reads."""
+
+    def __init__(self, max_concurrency):
+        """Init."""
+        self.config = {'LOGIN_MAX_CONCURRENCY': max_concurrency}
+        self.extensions = {}
+
+
+class TestOffload(object):
+    """Test for the thread pool of the CPU heavy work."""
+
+    def test_eventlet(self):
+        """Test that functions run in native threads, not in the hub."""
+        offloader = Offloader(FakeApp(2), 'eventlet')
+        main = threading.current_thread().ident
+        assert offloader.run(lambda: threading.current_thread().ident) != main
+        assert offloader.run(sum, [1, 2], 3) == 6
+
+        # Greenlets keep running while the pool works
+        ticks = []
+
+        def ticker():
+            for i in range(5):
+                ticks.append(i)
+                eventlet.sleep(0.01)
+        green = eventlet.spawn(ticker)
+        offloader.run(time.sleep, 0.2)
+        assert len(ticks) == 5
+        green.wait()
+
+    def test_concurrency(self):
+        """Test that at most LOGIN_MAX_CONCURRENCY functions run at once."""
+        offloader = Offloader(FakeApp(2))
+        lock = threading.Lock()
+        running = [0]
+        seen = []
+
+        def work():
+            with lock:
+                running[0] += 1
+                seen.append(running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+
+        threads = [threading.Thread(target=offloader.run, args=(work,))
+                   for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        assert len(seen) == 6
+        assert max(seen) == 2
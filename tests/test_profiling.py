@@ -0,0 +1,82 @@
+"""All the tests of our project."""
+import logging
+
+import pytest
+from mock import patch
+
+from projety import db
+from projety.profiling import MemoryProfileStore, RedisProfileStore
+from utils import TestAPI, FakeRedis
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.mark.usefixtures('app_class')
+class TestProfiling(TestAPI):
+    """Test for the profiling of requests."""
+
+    def profiled_get(self, url, token):
+        """GET with the X-Profile header, return the response."""
+        headers = self.get_headers(token_auth=token)
+        headers['X-Profile'] = '1'
+        rv = self.client.get(url, headers=headers)
+        db.session.remove()
+        return rv
+
+    def check_store(self, store):
+        """Run the same scenario on a store."""
+        for i in range(4):
+            store.add({'id': 'p{0}'.format(i), 'status': 200})
+        assert [p['id'] for p in store.recent()] == ['p3', 'p2', 'p1']
+        assert store.get('p3') == {'id': 'p3', 'status': 200}
+        assert store.get('unknown') is None
+
+    def test_stores(self):
+        """Test that the stores keep the last profiles."""
+        self.check_store(MemoryProfileStore(size=3))
+        self.check_store(RedisProfileStore(FakeRedis(), size=3))
+
+    def test_profile(self):
+        """Test that admins get the profile of their requests."""
+        rv = self.profiled_get('/api/v1.0/users', self.valid_token)
+        assert rv.status_code == 200
+        profile_id = rv.headers['X-Profile-Id']
+
+        # Only asked requests are profiled
+        r, s, h = self.get('/api/v1.0/users', token_auth=self.valid_token)
+        assert 'X-Profile-Id' not in h
+
+        r, s, h = self.get('/api/v1.0/profiles/' + profile_id,
+                           token_auth=self.valid_token)
+        assert s == 200
+        assert r['path'] == '/api/v1.0/users'
+        assert r['status'] == 200
+        assert r['sql_count'] >= 1
+        assert r['sql_count'] == len(r['queries'])
+        assert 'cumulative' in r['stats']
+
+        r, s, h = self.get('/api/v1.0/profiles', token_auth=self.valid_token)
+        assert s == 200
+        assert r[0]['id'] == profile_id
+        assert 'stats' not in r[0]
+
+        r, s, h = self.get('/api/v1.0/profiles/unknown',
+                           token_auth=self.valid_token)
+        assert s == 404
+
+    def test_restricted(self):
+        """Test that the requests of other users are not profiled."""
+        token = self.get_valid_token(self.restricted_user)
+        with patch('projety.profiling.cProfile.Profile') as mock_profile:
+            rv = self.profiled_get('/api/v1.0/minions', token)
+            assert rv.status_code == 200
+            assert 'X-Profile-Id' not in rv.headers
+
+            # Nor the requests without a valid token
+            rv = self.profiled_get('/api/v1.0/minions', 'invalid')
+            assert rv.status_code == 401
+            assert not mock_profile.called
+
+        for url in ('/api/v1.0/profiles', '/api/v1.0/profiles/unknown'):
+            r, s, h = self.get(url, token_auth=token)
+            assert s == 403
@@ -0,0 +1,55 @@
+"""All the tests of our project."""
+import logging
+
+import pytest
+
+from utils import TestAPI
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.mark.usefixtures('app_class')
+class TestRemoteApi(TestAPI):
+    """Test for the remote control endpoints."""
+
+    def test_expiries(self):
+        """Test that admins can see the pending expiries."""
+        r, s, h = self.get('/api/v1.0/remote/expiries',
+                           token_auth=self.valid_token)
+        assert s == 200
+        assert r == []
+
+        token = self.get_valid_token(self.restricted_user)
+        r, s, h = self.get('/api/v1.0/remote/expiries', token_auth=token)
+        assert s == 403
+
+    def test_metrics(self):
+        """Test that admins can see the sessions and metrics."""
+        r, s, h = self.get('/api/v1.0/remote/sessions',
+                           token_auth=self.valid_token)
+        assert s == 200
+        assert r['sessions'] == []
+        assert r['metrics']['sessions_active'] == 0
+
+        r, s, h = self.get('/api/v1.0/remote/metrics',
+                           token_auth=self.valid_token)
+        assert s == 200
+        assert h['Content-Type'].startswith('text/plain')
+        assert 'wsproxy_sessions_active 0' in r
+        assert 'wsproxy_handshake_seconds_count 0' in r
+
+        token = self.get_valid_token(self.restricted_user)
+        for url in ('/api/v1.0/remote/sessions', '/api/v1.0/remote/metrics'):
+            r, s, h = self.get(url, token_auth=token)
+            assert s == 403
+
+    def test_kill(self):
+        """Test that admins can kill sessions."""
+        r, s, h = self.delete('/api/v1.0/remote/sessions/unknown',
+                              token_auth=self.valid_token)
+        assert s == 404
+
+        token = self.get_valid_token(self.restricted_user)
+        r, s, h = self.delete('/api/v1.0/remote/sessions/unknown',
+                              token_auth=token)
+        assert s == 403
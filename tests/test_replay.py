@@ -0,0 +1,65 @@
+"""All the tests of our project."""
+import logging
+
+import pytest
+
+from projety import job_replay, socketio
+from projety.replay import MemoryReplayStore, RedisReplayStore
+from utils import TestAPI, FakeRedis
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.mark.usefixtures('app_class')
+class TestReplay(TestAPI):
+    """Test for the replay of socket.io job results."""
+
+    def check_store(self, store):
+        """Run the same scenario on a store."""
+        for i in range(4):
+            store.add(1, {'jid': 'jid{0}'.format(i), 'result': i})
+        store.add(2, {'jid': 'other', 'result': 0})
+
+        # Only the last results of the user are kept, oldest first
+        assert store.find(1, ['jid0', 'jid1', 'jid3', 'other']) == [
+            {'jid': 'jid1', 'result': 1}, {'jid': 'jid3', 'result': 3}]
+        assert store.find(3, ['jid1']) == []
+
+        # Redirections are read once
+        store.redirect(1, 'jid9', 'sid')
+        assert store.target(2, 'jid9') is None
+        assert store.target(1, 'jid9') == 'sid'
+        assert store.target(1, 'jid9') is None
+
+    def test_stores(self):
+        """Test the memory and redis stores."""
+        self.check_store(MemoryReplayStore(size=3))
+        redis = FakeRedis()
+        self.check_store(RedisReplayStore(redis, size=3))
+
+        # Keys expire with the results
+        assert redis.expires['projety:replay:results:1']
+
+    def test_resume(self):
+        """Test that reconnecting clients get the results they missed."""
+        token = self.valid_token
+        user_id = self.get_user(self.valid_user).id
+        client = socketio.test_client(self.app)
+        client.get_received()
+
+        # Result emitted to a disconnected sid
+        data = {'jid': 'done', 'status': 'success', 'result': {'m': True}}
+        assert job_replay.record(user_id, 'old', data) == 'old'
+
+        client.emit('resume', ['done', 'running'], token)
+        recvd = client.get_received()
+        assert [r['name'] for r in recvd] == ['job_result']
+        assert recvd[0]['args'][0] == data
+
+        # Jobs still running emit to the new sid
+        data = {'jid': 'running', 'status': 'success', 'result': {}}
+        assert job_replay.record(user_id, 'old', data) == client.sid
+
+        # Invalid tokens are ignored
+        client.emit('resume', 'done', 'wrong')
+        assert client.get_received() == []
@@ -0,0 +1,73 @@
+"""All the tests of our project."""
+import logging
+import time
+
+import pytest
+
+from projety.salt_backends import SimulatedBackend, get_backend
+
+logger = logging.getLogger(__name__)
+
+
+class TestSaltBackends(object):
+    """Test for the simulated salt master."""
+
+    def test_jobs(self):
+        """Test targets, functions and failures."""
+        backend = SimulatedBackend(minions=20, latency=0.001, seed=0,
+                                   functions=['test.ping', 'custom.run'])
+        keys = backend.list_keys()['minions']
+        assert keys[:2] == ['minion0000', 'minion0001']
+        assert len(backend.match('minion001*')) == 10
+        assert backend.match('minion0000,unknown', 'list') == ['minion0000']
+
+        result = backend.cmd('*', 'test.ping')
+        assert len(result) == 20
+        assert all(result.values())
+        assert backend.cmd('minion0001', 'custom.run') == {'minion0001': True}
+        result = backend.cmd('minion0001', 'grains.items')
+        assert 'is not available' in result['minion0001']
+        assert 'custom.run' in backend.cmd(
+            'minion0001', 'sys.list_functions')['minion0001']
+
+        # Minions not answering in time
+        backend.failure_rate = 0.5
+        result = backend.cmd('*', 'test.ping', timeout=0.01)
+        assert 0 < len(result) < 20
+
+        with pytest.raises(ValueError):
+            get_backend('puppet')
+
+    def test_async(self):
+        """Test jobs running in the background."""
+        backend = SimulatedBackend(minions=2, latency=0.05,
+                                   distribution='constant')
+        jid = backend.cmd_async('minion0000', 'test.echo', ['hello'])
+        assert backend.cmd('minion0000', 'saltutil.find_job', [jid]) == {
+            'minion0000': {'jid': jid}}
+        assert backend.lookup_jid(jid) == {'minion0000': 'hello'}
+        assert backend.cmd('minion0000', 'saltutil.find_job', [jid]) == {
+            'minion0000': {}}
+        assert backend.jobs == {}
+
+        # Jobs never read are dropped keep_jobs after their end
+        backend.keep_jobs = 0
+        jid = backend.cmd_async('minion0000', 'test.ping')
+        time.sleep(0.06)
+        backend.cmd_async('minion0001', 'test.ping')
+        assert jid not in backend.jobs
+        assert len(backend.jobs) == 1
+
+    def test_auth_check(self):
+        """Test ACL as salt checks them."""
+        backend = SimulatedBackend(minions=20)
+        auth_list = ['network.ip_addrs', {'minion000*': ['test.*']}]
+        assert backend.auth_check(auth_list, 'network.ip_addrs', (), '*',
+                                  'glob')
+        assert backend.auth_check(auth_list, 'test.ping', (), 'minion0001',
+                                  'glob')
+        assert backend.auth_check(auth_list, 'test.ping', (),
+                                  'minion0001,minion0002', 'list')
+        assert not backend.auth_check(auth_list, 'test.ping', (), '*', 'glob')
+        assert not backend.auth_check(auth_list, 'grains.items', (),
+                                      'minion0001', 'glob')
@@ -0,0 +1,90 @@
+"""All the tests of our project."""
+import logging
+import time
+
+from mock import patch
+
+from projety.exceptions import SaltError
+from projety.wsproxy.tokens import TokenManager
+from projety.wsproxy.tunnels import Tunnel, close_tunnels
+
+logger = logging.getLogger(__name__)
+
+
+class TestExpiryScheduler(object):
+    """Test for the token expiry scheduler."""
+
+    def add_token(self, manager, minion, uid, last_seen, expiration=10):
+        """Store a token and schedule it."""
+        manager.store.add({'id': uid, 'minion': minion,
+                           'last_seen': last_seen, 'expiration': expiration,
+                           'port': 5900, 'pid': 1234})
+        manager.scheduler.schedule(uid, last_seen + expiration)
+
+    def test_heap(self):
+        """Test deadlines ordering and lazy deletion."""
+        scheduler = TokenManager().scheduler
+        scheduler.schedule('uid1', 30)
+        scheduler.schedule('uid2', 10)
+        scheduler.schedule('uid3', 20)
+        assert scheduler.next_deadline() == 10
+
+        # Refresh and cancel leave stale entries in the heap
+        scheduler.schedule('uid2', 40)
+        scheduler.cancel('uid3')
+        assert len(scheduler.heap) == 4
+        assert scheduler.next_deadline() == 30
+        assert scheduler.pending() == [{'id': 'uid1', 'deadline': 30},
+                                       {'id': 'uid2', 'deadline': 40}]
+
+        assert scheduler.pop_due(now=35) == ['uid1']
+        assert scheduler.pop_due(now=35) == []
+        assert scheduler.pop_due(now=100) == ['uid2']
+        assert scheduler.heap == []
+
+    @patch('projety.wsproxy.tokens.close_tunnels')
+    def test_expire(self, mock_close):
+        """Test that due tokens are expired together."""
+        manager = TokenManager()
+        now = int(time.time())
+        self.add_token(manager, 'minion1', 'uid1', now - 100)
+        self.add_token(manager, 'minion2', 'uid2', now - 100)
+        self.add_token(manager, 'minion3', 'uid3', now)
+
+        # Refreshed by another worker, only the store knows
+        manager.store.refresh('uid2', now)
+
+        assert manager.scheduler.run_once() == ['uid1', 'uid2']
+        tunnels = mock_close.call_args[0][0]
+        assert [t.minion for t in tunnels] == ['minion1']
+        assert not manager.get_token('uid1')
+        assert manager.get_token('uid2')
+        pending = [p['id'] for p in manager.scheduler.pending()]
+        assert pending == ['uid2', 'uid3']
+
+    @patch('projety.wsproxy.tokens.close_tunnels')
+    def test_run(self, mock_close):
+        """Test that the loop wakes up when a token expires."""
+        manager = TokenManager()
+        manager.scheduler.start()
+        self.add_token(manager, 'minion1', 'uid1', int(time.time()) - 2,
+                       expiration=1)
+        for i in range(50):
+            if mock_close.called:
+                break
+            time.sleep(0.1)
+        assert mock_close.call_count == 1
+        assert not manager.get_token('uid1')
+
+    @patch('projety.wsproxy.tunnels.Job.run')
+    def test_close_tunnels(self, mock_run):
+        """Test that every tunnel is closed, even if a job fails."""
+        mock_run.side_effect = [SaltError('timeout'), None, None]
+        close_tunnels([Tunnel('minion1', 5900, 1234),
+                       Tunnel('minion2', 5901, 1234),
+                       Tunnel('minion3', 5902, 4321)])
+        calls = sorted(c[0] for c in mock_run.call_args_list)
+        assert calls == [
+            ('minion1', 'remote_control.close_ssh_connection', [1234]),
+            ('minion2', 'remote_control.close_ssh_connection', [1234]),
+            ('minion3', 'remote_control.close_ssh_connection', [4321])]
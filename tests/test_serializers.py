@@ -0,0 +1,45 @@
+"""All the tests of our project."""
+import logging
+
+import pytest
+
+from projety.models import User
+from projety.serializers import link_for, serialize
+from projety.utils import url_for
+from utils import TestAPI
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.mark.usefixtures('app_class')
+class TestSerializers(TestAPI):
+    """Test for serializers."""
+
+    endpoints = [
+        ('api.get_user', {'id': 1}),
+        ('api.get_acls', {'user_id': 1}),
+        ('api.get_acl', {'user_id': 1, 'acl_id': 2}),
+        ('api.get_role', {'user_id': 1, 'role_id': 2}),
+        ('api.new_token', {}),
+        ('api.get_minion_task', {'minion': 'my minion', 'task': 'test.ping'}),
+        ('api.get_status', {'id': 'a1d652eb', 'extra': 'query'}),
+    ]
+
+    def test_link_for(self):
+        """Test that templates give the same links than url_for."""
+        for endpoint, values in self.endpoints:
+            assert link_for(endpoint, **values) == url_for(endpoint, **values)
+
+        with self.app.test_request_context():
+            for endpoint, values in self.endpoints:
+                assert link_for(endpoint, **values) == \
+                    url_for(endpoint, **values)
+
+    def test_serialize(self):
+        """Test that bulk serialization matches to_dict."""
+        users = User.query.all()
+        assert serialize(users) == [user.to_dict() for user in users]
+
+        acls = [acl for user in users for acl in user.acls]
+        assert len(acls) > 0
+        assert serialize(acls) == [acl.to_dict() for acl in acls]
@@ -1,9 +1,13 @@
 """All the tests of our project."""
 import logging
+import time
 
 import pytest
 
+from mock import patch
+
 from projety import socketio
+from projety.events import bound_users, push_subscriptions, run_pings
 from utils import TestAPI
 
 logger = logging.getLogger(__name__)
@@ -72,3 +76,117 @@ class TestSocketIO(TestAPI):
         # Check that client_bis dont get shit
         recvd = client_bis.get_received()
         assert len(recvd) == 0
+
+    def test_subscriptions(self):
+        """Test that clients only get the minions they subscribed to."""
+        token = self.valid_token
+        client = socketio.test_client(self.app)
+        client_bis = socketio.test_client(self.app)
+        client.get_received()
+        client_bis.get_received()
+
+        client.emit('subscribe', ['web*', 'db01'], token)
+        recvd = client.get_received()
+        assert recvd[0]['name'] == 'subscriptions'
+        assert recvd[0]['args'][0] == {'targets': ['db01', 'web*']}
+
+        push_subscriptions('auto_ping', {'web01': True, 'web02': False,
+                                         'db01': True, 'mail': True})
+        recvd = client.get_received()
+        assert sorted(r['name'] for r in recvd) == ['auto_ping', 'auto_ping']
+        results = {}
+        for r in recvd:
+            results.update(r['args'][0])
+        assert results == {'web01': True, 'web02': False, 'db01': True}
+        assert client_bis.get_received() == []
+
+        # New subscribers get the last known state
+        client_bis.emit('subscribe', 'mail', token)
+        recvd = client_bis.get_received()
+        assert [r['name'] for r in recvd] == ['subscriptions', 'auto_ping']
+        assert recvd[1]['args'][0] == {'mail': True}
+
+        client.emit('unsubscribe', ['web*'], token)
+        recvd = client.get_received()
+        assert recvd[0]['args'][0] == {'targets': ['db01']}
+        push_subscriptions('auto_ping', {'web01': False})
+        assert client.get_received() == []
+
+        # Invalid tokens are ignored
+        client.emit('subscribe', ['web*'], 'wrong')
+        assert client.get_received() == []
+
+    def test_authenticate(self):
+        """Test that authenticated sessions don't need tokens."""
+        client = socketio.test_client(self.app)
+        client.get_received()
+
+        client.emit('authenticate', 'wrong')
+        recvd = client.get_received()
+        assert recvd[0]['name'] == 'authentication_error'
+
+        client.emit('authenticate', self.valid_token)
+        recvd = client.get_received()
+        assert recvd[0]['name'] == 'authenticated'
+        assert recvd[0]['args'][0]['expiration'] > time.time()
+
+        # No token decoding nor SQL for the next events
+        with patch('projety.events.verify_token') as verify:
+            client.emit('sid')
+            client.emit('subscribe', 'app*')
+            assert not verify.called
+        recvd = client.get_received()
+        assert [r['name'] for r in recvd] == ['sid', 'subscriptions']
+        assert recvd[0]['args'][0] == {'sid': client.sid}
+
+        # Expired sessions need a token again
+        bound_users[client.sid] = bound_users[client.sid]._replace(
+            expiration=time.time() - 1)
+        client.emit('sid')
+        recvd = client.get_received()
+        assert [r['name'] for r in recvd] == ['authentication_expired']
+        assert client.sid not in bound_users
+
+        client.emit('authenticate', self.valid_token)
+        assert client.sid in bound_users
+        client.disconnect()
+        assert client.sid not in bound_users
+
+    def test_ping_batch(self):
+        """Test that the pings of a short window share one salt job."""
+        token = self.valid_token
+        client = socketio.test_client(self.app)
+        client_bis = socketio.test_client(self.app)
+        client.get_received()
+        client_bis.get_received()
+
+        self.app.config['PING_BATCH_WINDOW'] = 0.2
+        try:
+            with patch('projety.events.ping_minions.apply_async') as task:
+                client.emit('ping_minion', {'minion': 'web01'}, token)
+                client.emit('ping_minion', {'minion': 'web02'}, token)
+                client_bis.emit('ping_minion', {'minion': 'web01'}, token)
+                assert not task.called
+                socketio.sleep(0.5)
+                assert task.call_count == 1
+        finally:
+            self.app.config['PING_BATCH_WINDOW'] = 0
+        requests = task.call_args[1]['args'][0]
+        assert len(requests) == 3
+
+        # Unknown minions are refused, the others pinged at once
+        requests.append((requests[0][0], 'unknown', client_bis.sid))
+        with patch('projety.events.get_minions',
+                   return_value=['web01', 'web02']), \
+                patch('projety.events.is_task_allowed', return_value=True), \
+                patch('projety.events.ping_many',
+                      return_value={'web01': True, 'web02': False}) as ping:
+            run_pings(requests)
+            ping.assert_called_once_with(['web01', 'web02'])
+        recvd = client.get_received()
+        assert [r['name'] for r in recvd] == ['job_result']
+        assert recvd[0]['args'][0] == {'web01': True, 'web02': False}
+        recvd = client_bis.get_received()
+        assert len(recvd) == 2
+        assert recvd[0]['args'][0]['error'] == 'bad request'
+        assert recvd[1]['args'][0] == {'web01': True}
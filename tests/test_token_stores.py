@@ -0,0 +1,124 @@
+"""All the tests of our project."""
+import logging
+import time
+
+from mock import patch
+
+from projety.wsproxy.stores import MemoryTokenStore, RedisTokenStore
+from projety.wsproxy.tokens import Token, TokenManager
+from utils import FakeRedis
+
+logger = logging.getLogger(__name__)
+
+
+class TestTokenStores(object):
+    """Test for remote control token stores."""
+
+    def get_data(self, minion, uid, last_seen=None, expiration=3600):
+        """Return a stored token."""
+        if last_seen is None:
+            last_seen = int(time.time())
+        return {'id': uid, 'minion': minion, 'last_seen': last_seen,
+                'expiration': expiration, 'port': 5900, 'pid': 1234}
+
+    def check_store(self, store):
+        """Run the same scenario on a store."""
+        data = self.get_data('minion1', 'uid1')
+        assert store.add(data)
+        assert store.get('uid1') == data
+        assert store.get_minion('minion1') == data
+        assert store.get('unknown') is None
+        assert store.get_minion('unknown') is None
+
+        # Only one token per minion
+        assert not store.add(self.get_data('minion1', 'uid2'))
+        assert store.get_minion('minion1')['id'] == 'uid1'
+
+        # Expiry
+        old = self.get_data('minion2', 'uid3', last_seen=int(time.time()) -
+                            100, expiration=10)
+        assert store.add(old)
+        assert store.expired() == ['uid3']
+        assert store.refresh('uid3', int(time.time()))
+        assert store.expired() == []
+        assert not store.refresh('unknown', int(time.time()))
+        assert len(store.all()) == 2
+
+        # Only one caller gets the deleted token
+        assert store.delete('uid1') == data
+        assert store.delete('uid1') is None
+        assert store.get('uid1') is None
+        assert store.get_minion('minion1') is None
+        assert store.add(self.get_data('minion1', 'uid2'))
+
+    def test_memory_store(self):
+        """Test the memory store."""
+        self.check_store(MemoryTokenStore())
+
+    def test_redis_store(self):
+        """Test the redis store, using a fake redis."""
+        redis = FakeRedis()
+        self.check_store(RedisTokenStore(redis))
+
+        # Two workers sharing the same redis see the same tokens
+        other = RedisTokenStore(redis)
+        assert other.get_minion('minion1')['id'] == 'uid2'
+
+    def test_redis_races(self):
+        """Test that concurrent writes of two workers are not lost."""
+        redis = FakeRedis()
+        store = RedisTokenStore(redis)
+        other = RedisTokenStore(redis)
+        assert store.add(self.get_data('minion1', 'uid1'))
+        get = redis.get
+
+        def racing_get(name):
+            # The other worker deletes the token during our refresh
+            value = get(name)
+            redis.get = get
+            assert other.delete('uid1')
+            return value
+        redis.get = racing_get
+        assert not store.refresh('uid1', int(time.time()))
+        assert store.get('uid1') is None
+        assert redis.zrange(store._expiry_key, 0, -1) == []
+
+        exists = redis.exists
+
+        def racing_exists(name):
+            # The other worker creates a token for the same minion
+            value = exists(name)
+            redis.exists = exists
+            assert other.add(self.get_data('minion1', 'uid2'))
+            return value
+        redis.exists = racing_exists
+        assert not store.add(self.get_data('minion1', 'uid3'))
+        assert store.get_minion('minion1')['id'] == 'uid2'
+        assert store.get('uid3') is None
+
+    @patch('projety.wsproxy.tokens.close_tunnels')
+    @patch('projety.wsproxy.tokens.Token.ping')
+    def test_shared_manager(self, mock_ping, mock_close):
+        """Test that tokens created by one worker are seen by another."""
+        redis = FakeRedis()
+        worker_a = TokenManager(RedisTokenStore(redis))
+        worker_b = TokenManager(RedisTokenStore(redis))
+        mock_ping.return_value = True
+
+        data = self.get_data('minion1', 'uid1', last_seen=0, expiration=10)
+        assert worker_a.store.add(data)
+        token = worker_b.get_token('uid1')
+        assert isinstance(token, Token)
+        assert token.port == 5900
+
+        # Refresh from the other worker
+        assert worker_b.create_token('minion1').uuid == 'uid1'
+        assert worker_a.get_token('uid1').last_seen > 0
+
+        # Expired tokens are cleaned once, by any worker
+        worker_a.store.refresh('uid1', 0)
+        worker_b.clean_old_tokens()
+        worker_a.clean_old_tokens()
+        closed = [t for args in mock_close.call_args_list for t in args[0][0]]
+        assert [t.pid for t in closed] == [1234]
+        assert not worker_a.get_token('uid1')
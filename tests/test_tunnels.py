@@ -0,0 +1,195 @@
+"""All the tests of our project."""
+import itertools
+import logging
+import os
+import socket
+import time
+
+from mock import patch
+import pytest
+
+from projety.exceptions import SaltACLError, SaltError
+from projety.wsproxy.resources import (HostKey, PortAllocator,
+                                       RedisPortAllocator, TunnelResources)
+from projety.wsproxy.tokens import TokenManager
+from projety.wsproxy.tunnels import Tunnel, TunnelPool
+from utils import FakeRedis
+
+logger = logging.getLogger(__name__)
+
+
+class FakeServer(object):
+    """Run background tasks right away."""
+
+    def start_background_task(self, target, *args, **kwargs):
+        """Run the task."""
+        target(*args, **kwargs)
+
+
+@patch('projety.wsproxy.tunnels.Tunnel.close')
+@patch('projety.wsproxy.tunnels.Tunnel.ping')
+@patch('projety.wsproxy.tunnels.is_task_allowed')
+@patch('projety.wsproxy.tunnels.Tunnel.open')
+class TestTunnelPool(object):
+    """Test for the pool of tunnels."""
+
+    def setup_mocks(self, mock_open, mock_allowed, mock_ping):
+        """Open a new tunnel at each call."""
+        self.resources = TunnelResources()
+        ports = itertools.count(6000)
+        mock_open.side_effect = lambda minion, resources, background=False: \
+            Tunnel(minion, next(ports), 1234)
+        mock_allowed.return_value = True
+        mock_ping.return_value = True
+
+    def test_pool(self, mock_open, mock_allowed, mock_ping, mock_close):
+        """Test that tunnels are handed out and replenished."""
+        self.setup_mocks(mock_open, mock_allowed, mock_ping)
+        pool = TunnelPool(FakeServer(), self.resources, minions=['minion1'],
+                          size=2)
+        pool.maintain()
+        assert pool.stats() == {'minion1': 2}
+        assert mock_open.call_args[1] == {'background': True}
+
+        tunnel = pool.acquire('minion1')
+        assert tunnel.port == 6000
+        assert pool.stats() == {'minion1': 2}
+
+        # Not prewarmed
+        assert pool.acquire('minion2') is None
+
+        # Dead tunnels are not handed out
+        mock_ping.return_value = False
+        assert pool.acquire('minion1') is None
+        assert mock_close.call_count == 1
+
+        # Not allowed
+        mock_allowed.return_value = False
+        with pytest.raises(SaltACLError):
+            pool.acquire('minion1')
+        assert pool.stats() == {'minion1': 3}
+
+        pool.close_all()
+        assert pool.stats() == {}
+        assert mock_close.call_count == 4
+
+    def test_top(self, mock_open, mock_allowed, mock_ping, mock_close):
+        """Test that the most requested minions are prewarmed."""
+        self.setup_mocks(mock_open, mock_allowed, mock_ping)
+        pool = TunnelPool(FakeServer(), self.resources, top=1, max_age=60)
+        assert pool.acquire('minion1') is None
+        assert pool.acquire('minion2') is None
+        assert pool.acquire('minion2') is None
+        assert pool.targets() == ['minion2']
+
+        # minion1 is not in the top anymore
+        pool.maintain()
+        assert pool.stats() == {'minion1': 0, 'minion2': 1}
+        assert mock_close.call_count == 1
+
+        # Old tunnels are replaced
+        pool.tunnels['minion2'][0].created_at = int(time.time()) - 120
+        pool.maintain()
+        assert mock_close.call_count == 2
+        assert pool.stats()['minion2'] == 1
+
+    def test_token_manager(self, mock_open, mock_allowed, mock_ping,
+                           mock_close):
+        """Test that tokens use prewarmed tunnels."""
+        self.setup_mocks(mock_open, mock_allowed, mock_ping)
+        pool = TunnelPool(FakeServer(), self.resources, minions=['minion1'])
+        pool.maintain()
+        manager = TokenManager(pool=pool)
+        token = manager.create_token('minion1')
+        assert token.port == 6000
+        assert mock_open.call_count == 2
+
+
+class TestTunnelResources(object):
+    """Test for the resources used by tunnels."""
+
+    def test_ports(self):
+        """Test that ports are reserved once, and released."""
+        busy = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        busy.bind(('127.0.0.1', 0))
+        busy.listen(1)
+        port = busy.getsockname()[1]
+        try:
+            allocator = PortAllocator(port, port + 1)
+            free = allocator.allocate()
+            assert free == port + 1
+            assert allocator.stats() == {'free': 1, 'reserved': 1}
+
+            # The busy port is never handed out
+            with pytest.raises(SaltError):
+                allocator.allocate()
+
+            allocator.release(free)
+            allocator.release(free)
+            allocator.release(1234)
+            assert allocator.stats() == {'free': 2, 'reserved': 0}
+            assert allocator.allocate() == free
+        finally:
+            busy.close()
+
+    def test_shared_ports(self):
+        """Test that workers sharing redis never get the same port."""
+        busy = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        busy.bind(('127.0.0.1', 0))
+        busy.listen(1)
+        port = busy.getsockname()[1]
+        try:
+            redis = FakeRedis()
+            first = RedisPortAllocator(redis, port, port + 2)
+            second = RedisPortAllocator(redis, port, port + 2)
+            ports = set([first.allocate(), second.allocate()])
+            assert ports == set([port + 1, port + 2])
+            assert first.stats() == {'free': 1, 'reserved': 2}
+            with pytest.raises(SaltError):
+                second.allocate()
+
+            # Any worker can release a port
+            second.release(port + 1)
+            second.release(1234)
+            assert first.allocate() == port + 1
+            assert redis.expires[first._key(port + 1)]
+        finally:
+            busy.close()
+
+    def test_host_key(self, tmpdir):
+        """Test that the fingerprint is computed again on change."""
+        key = os.path.join(os.getcwd(), 'tests/test_key.pub')
+        path = tmpdir.join('key.pub')
+        path.write(open(key).read())
+        host_key = HostKey(str(path))
+        with patch('projety.wsproxy.resources.'
+                   'get_ssh_host_key_fingerprint') as mock_fingerprint:
+            mock_fingerprint.return_value = 'fingerprint'
+            assert host_key.fingerprint() == 'fingerprint'
+            assert host_key.fingerprint() == 'fingerprint'
+            assert mock_fingerprint.call_count == 1
+
+            path.write(open(key).read() + '\n')
+            host_key.fingerprint()
+            assert mock_fingerprint.call_count == 2
+
+    @patch('projety.wsproxy.tunnels.Job.run')
+    def test_tunnel_port(self, mock_run):
+        """Test that tunnels release their port."""
+        key = os.path.join(os.getcwd(), 'tests/test_key.pub')
+        resources = TunnelResources(key, (41000, 41001))
+        mock_run.return_value = {'minion1': {'pid': 1234}}
+        tunnel = Tunnel.open('minion1', resources, background=True)
+        assert mock_run.call_args[1]['kwarg'] == {
+            'port': tunnel.port,
+            'hostkey': 'SHA256:pR7vzWSWYchzVdFpAqyVyoWGMTIFPsjnYJfVkrMi2Hg'}
+        assert resources.stats()['reserved'] == 1
+
+        tunnel.close()
+        assert resources.stats()['reserved'] == 0
+
+        # The port is released on failure
+        mock_run.return_value = {}
+        with pytest.raises(SaltError):
+            Tunnel.open('minion1', resources, background=True)
+        assert resources.stats()['reserved'] == 0
@@ -19,4 +19,5 @@ class TestAsync(TestAPI):
 
         key = os.path.join(os.getcwd(), 'tests/test_key.pub')
         fingerprint = get_ssh_host_key_fingerprint(key)
-        assert fingerprint == '85:fb:c5:da:b8:cb:01:3b:52:39:89:f7:9a:6d:34:5f'
+        assert fingerprint == \
+            'SHA256:pR7vzWSWYchzVdFpAqyVyoWGMTIFPsjnYJfVkrMi2Hg'
@@ -0,0 +1,333 @@
+"""All the tests of our project."""
+import logging
+import os
+import select
+import socket
+import struct
+import threading
+import zlib
+
+from base64 import b64decode, b64encode
+
+from projety.wsproxy import WsProxy
+from projety.wsproxy.deflate import PerMessageDeflate, parse_extensions
+from projety.wsproxy.socket import ProxySocket
+from projety.wsproxy.websocket import (WebSocket, encode_frame, unmask,
+                                       OPCODE_BINARY, OPCODE_CLOSE,
+                                       OPCODE_PING, OPCODE_PONG, OPCODE_TEXT,
+                                       OPCODE_CONTINUATION, RSV1)
+
+logger = logging.getLogger(__name__)
+
+
+def client_frame(opcode, payload, fin=True, rsv1=False):
+    """Return a masked frame, as sent by browsers."""
+    frame = bytearray(encode_frame(opcode, payload, rsv1))
+    if not fin:
+        frame[0] &= 0x7f
+    header_size = len(frame) - len(payload)
+    mask = os.urandom(4)
+    frame[1] |= 0x80
+    return bytes(frame[:header_size]) + mask + unmask(payload, mask)
+
+
+def read_frame(sock):
+    """Return ``(first byte, payload)`` of a server frame."""
+    first, length = struct.unpack('!BB', sock.recv(2))
+    if length == 126:
+        length = struct.unpack('!H', sock.recv(2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', sock.recv(8))[0]
+    payload = b''
+    while len(payload) < length:
+        payload += sock.recv(length - len(payload))
+    return first, payload
+
+
+def wait_message(ws):
+    """Return the next message of a websocket, waiting for its socket."""
+    while True:
+        message = ws.wait()
+        if message is not None or ws.closed:
+            return message
+        select.select([ws.socket], [], [], 5)
+
+
+class TestWebSocket(object):
+    """Test for our websocket and permessage-deflate."""
+
+    def test_unmask(self):
+        """Test that masking twice gives the data back."""
+        data = os.urandom(1001)
+        assert unmask(unmask(data, b'abcd'), b'abcd') == data
+        assert unmask(b'\x00\x00\x00\x00\x00', b'\x01\x02\x03\x04') == \
+            b'\x01\x02\x03\x04\x01'
+
+    def test_negotiation(self):
+        """Test the answers to the client offers."""
+        offers = parse_extensions(
+            'permessage-deflate; client_max_window_bits, foo')
+        assert offers == [('permessage-deflate',
+                           {'client_max_window_bits': None}),
+                          ('foo', {})]
+
+        deflate = PerMessageDeflate()
+        response, session = deflate.accept(
+            'permessage-deflate; client_max_window_bits')
+        assert response == 'permessage-deflate'
+        assert session.server_takeover
+
+        response, session = deflate.accept(
+            'permessage-deflate; server_max_window_bits=8, '
+            'permessage-deflate; server_max_window_bits=10; '
+            'client_no_context_takeover')
+        assert response == 'permessage-deflate; client_no_context_takeover' \
+            '; server_max_window_bits=10'
+        assert session.server_bits == 10
+        assert not session.client_takeover
+
+        deflate = PerMessageDeflate(context_takeover=False, max_window_bits=12)
+        response, session = deflate.accept('permessage-deflate')
+        assert response == 'permessage-deflate; server_no_context_takeover' \
+            '; server_max_window_bits=12'
+
+        assert deflate.accept('x-webkit-deflate-frame') == (None, None)
+        assert deflate.accept('permessage-deflate; foo') == (None, None)
+
+    def test_messages(self):
+        """Test framing, fragments and control frames."""
+        server, client = socket.socketpair()
+        ws = WebSocket(server)
+
+        # Two messages in one read, the second is pending
+        client.sendall(client_frame(OPCODE_BINARY, b'hello') +
+                       client_frame(OPCODE_BINARY, b'x' * 1000))
+        assert wait_message(ws) == b'hello'
+        assert ws.pending()
+        assert wait_message(ws) == b'x' * 1000
+        assert not ws.pending()
+        assert ws.wait() is None
+        assert not ws.closed
+
+        # Long messages arrive in many reads
+        client.sendall(client_frame(OPCODE_BINARY, b'y' * 200000))
+        assert wait_message(ws) == b'y' * 200000
+
+        # Fragments, with a ping in the middle
+        client.sendall(client_frame(OPCODE_BINARY, b'abc', fin=False) +
+                       client_frame(OPCODE_PING, b'ping') +
+                       client_frame(OPCODE_CONTINUATION, b'def'))
+        assert wait_message(ws) == b'abcdef'
+        assert read_frame(client) == (0x80 | OPCODE_PONG, b'ping')
+
+        ws.send(b'data')
+        assert read_frame(client) == (0x80 | OPCODE_BINARY, b'data')
+
+        # Unmasked frames are refused
+        client.sendall(encode_frame(OPCODE_BINARY, b'bad'))
+        assert wait_message(ws) is None
+        first, payload = read_frame(client)
+        assert first == 0x80 | OPCODE_CLOSE
+        assert payload == struct.pack('!H', 1002)
+
+    def test_deflate(self):
+        """Test compressed messages, keeping the context."""
+        server, client = socket.socketpair()
+        response, session = PerMessageDeflate(level=1).accept(
+            'permessage-deflate')
+        ws = WebSocket(server, deflate=session)
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        message = b'framebuffer update ' * 100
+
+        sizes = []
+        for i in range(2):
+            ws.send(message)
+            first, payload = read_frame(client)
+            assert first == 0x80 | RSV1 | OPCODE_BINARY
+            sizes.append(len(payload))
+            assert decompressor.decompress(payload + b'\x00\x00\xff\xff') \
+                == message
+        # The second message refers to the first one
+        assert sizes[1] < sizes[0] < len(message)
+
+        # Small messages are not compressed
+        ws.send(b'small')
+        assert read_frame(client) == (0x80 | OPCODE_BINARY, b'small')
+
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = compressor.compress(message) + \
+            compressor.flush(zlib.Z_SYNC_FLUSH)
+        client.sendall(client_frame(OPCODE_BINARY, data[:-4], rsv1=True))
+        assert wait_message(ws) == message
+        assert session.stats()['bytes_in'] == len(message) * 2
+
+    def test_burst(self):
+        """Test that a burst of small frames is read from one buffer."""
+        server, client = socket.socketpair()
+        ws = WebSocket(server)
+        frames = [client_frame(OPCODE_BINARY, struct.pack('!I', i) * 10)
+                  for i in range(5000)]
+        sender = threading.Thread(target=client.sendall,
+                                  args=(b''.join(frames),))
+        sender.start()
+        for i in range(5000):
+            assert wait_message(ws) == struct.pack('!I', i) * 10
+            # Frames read are dropped in large blocks, not one by one
+            assert ws.offset < len(ws.buffer) or ws.offset == 0
+        sender.join(5)
+        assert ws.offset == 0
+        assert len(ws.buffer) == 0
+
+    def test_non_blocking(self):
+        """Test that half frames and full sockets never block."""
+        server, client = socket.socketpair()
+        ws = WebSocket(server)
+
+        # Half a frame is kept until the rest arrives
+        frame = client_frame(OPCODE_BINARY, b'half' * 100)
+        client.sendall(frame[:50])
+        assert ws.wait() is None
+        assert not ws.closed
+        client.sendall(frame[50:])
+        assert wait_message(ws) == b'half' * 100
+
+        # Frames the client doesn't read wait in the output buffer
+        message = os.urandom(4 * 1024 * 1024)
+        ws.send(message)
+        assert ws.pending_output()
+        assert not ws.flush()
+
+        received = []
+
+        def read():
+            received.append(read_frame(client))
+        thread = threading.Thread(target=read)
+        thread.start()
+        while not ws.flush():
+            select.select([], [server], [], 5)
+        thread.join(5)
+        assert received == [(0x80 | OPCODE_BINARY, message)]
+        assert not ws.pending_output()
+
+        # The client closing is only seen by wait
+        client.close()
+        assert wait_message(ws) is None
+        assert ws.closed
+
+    def test_stalled_client(self):
+        """Test that a client sending half a frame doesn't stall others."""
+        server = WsProxy(async_mode='threading')
+        peers = []
+        for i in range(2):
+            ws_socket, browser = socket.socketpair()
+            proxy_socket, target = socket.socketpair()
+            browser.settimeout(5)
+            target.settimeout(5)
+            session = ProxySocket(server, server._generate_id())
+            session.proxy_socket = proxy_socket
+            thread = threading.Thread(target=session._websocket_handler,
+                                      args=(WebSocket(ws_socket),))
+            thread.daemon = True
+            thread.start()
+            peers.append((browser, target))
+
+        (stalled, stalled_target), (browser, target) = peers
+        frame = client_frame(OPCODE_BINARY, b'stalled')
+        stalled.sendall(frame[:3])
+        for i in range(3):
+            browser.sendall(client_frame(OPCODE_BINARY, b'hello'))
+            assert target.recv(100) == b'hello'
+            target.sendall(b'world')
+            assert read_frame(browser) == (0x80 | OPCODE_BINARY, b'world')
+
+        stalled.sendall(frame[3:])
+        assert stalled_target.recv(100) == b'stalled'
+
+    def test_handshake(self):
+        """Test that the extension is only accepted with eventlet."""
+        environ = {'HTTP_SEC_WEBSOCKET_VERSION': '13',
+                   'HTTP_SEC_WEBSOCKET_KEY': 'dGhlIHNhbXBsZSBub25jZQ==',
+                   'HTTP_SEC_WEBSOCKET_PROTOCOL': 'binary',
+                   'HTTP_SEC_WEBSOCKET_EXTENSIONS': 'permessage-deflate',
+                   'eventlet.input': None}
+        responses = []
+
+        def start_response(status, headers):
+            responses.append(dict(headers))
+
+        for mode, accepted in (('eventlet', True), ('threading', False)):
+            server = WsProxy(async_mode=mode, deflate=PerMessageDeflate())
+            session = ProxySocket(server, server._generate_id())
+            assert session.do_websocket_handshake(environ, start_response)
+            headers = responses.pop()
+            assert headers['Sec-WebSocket-Accept'] == \
+                's3pPLMBiTxaQ9kYGzzhZRbK+xOo='
+            assert ('Sec-WebSocket-Extensions' in headers) == accepted
+            assert (session.deflate is not None) == accepted
+
+    def test_subprotocols(self):
+        """Test the choice of the subprotocol."""
+        environ = {'HTTP_SEC_WEBSOCKET_VERSION': '13',
+                   'HTTP_SEC_WEBSOCKET_KEY': 'dGhlIHNhbXBsZSBub25jZQ==',
+                   'eventlet.input': None}
+        responses = []
+
+        def start_response(status, headers):
+            responses.append(dict(headers))
+
+        server = WsProxy(async_mode='eventlet')
+        for offer, protocol, raw in ((None, None, False),
+                                     ('base64, binary', 'binary', False),
+                                     ('base64', 'base64', True)):
+            if offer:
+                environ['HTTP_SEC_WEBSOCKET_PROTOCOL'] = offer
+            session = ProxySocket(server, server._generate_id())
+            assert session.do_websocket_handshake(environ, start_response)
+            headers = responses.pop()
+            assert headers.get('Sec-WebSocket-Protocol') == protocol
+            assert session.base64 == (protocol == 'base64')
+            assert session.raw_websocket == raw
+
+        environ['HTTP_SEC_WEBSOCKET_PROTOCOL'] = 'chat'
+        session = ProxySocket(server, server._generate_id())
+        assert not session.do_websocket_handshake(environ, start_response)
+
+    def test_base64(self):
+        """Test the relay of base64 sessions."""
+        server = WsProxy(async_mode='threading')
+        ws_socket, browser = socket.socketpair()
+        proxy_socket, target = socket.socketpair()
+        session = ProxySocket(server, server._generate_id())
+        session.base64_batch_size = 1000
+        session.do_websocket_handshake(
+            {'HTTP_SEC_WEBSOCKET_VERSION': '13',
+             'HTTP_SEC_WEBSOCKET_KEY': 'dGhlIHNhbXBsZSBub25jZQ==',
+             'HTTP_SEC_WEBSOCKET_PROTOCOL': 'base64'},
+            lambda status, headers: None)
+        session.proxy_socket = proxy_socket
+        thread = threading.Thread(target=session._websocket_handler,
+                                  args=(WebSocket(ws_socket),))
+        thread.daemon = True
+        thread.start()
+
+        browser.sendall(client_frame(OPCODE_TEXT, b64encode(b'\x00hello')))
+        assert target.recv(100) == b'\x00hello'
+
+        # Target data is sent in text messages of at most the batch size
+        data = os.urandom(2500)
+        target.sendall(data)
+        received = b''
+        while len(received) < len(data):
+            first, payload = read_frame(browser)
+            assert first == 0x80 | OPCODE_TEXT
+            decoded = b64decode(payload)
+            assert len(decoded) <= 1000
+            received += decoded
+        assert received == data
+
+        # Invalid data ends the session
+        browser.sendall(client_frame(OPCODE_TEXT, b'abc'))
+        thread.join(5)
+        assert not thread.is_alive()
+        assert session.closed
+        assert session.counters['bytes_to_client'] == 2500
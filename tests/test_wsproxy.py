@@ -0,0 +1,427 @@
+"""All the tests of our project."""
+import errno
+import logging
+import os
+import socket
+import threading
+import time
+
+from mock import patch
+import pytest
+
+from projety.wsproxy import WsProxy
+from projety.wsproxy.buffer import RelayBuffer
+from projety.wsproxy.metrics import exposition
+from projety.wsproxy.multiplexer import EVENT_READ, EVENT_WRITE
+from projety.wsproxy.sessions import STATE_CLOSED, STATE_OPEN
+from projety.wsproxy.socket import ProxySocket, connect_tunnel
+
+logger = logging.getLogger(__name__)
+
+
+class FakeWebSocket(object):
+    """Minimal non-blocking websocket, one message per recv."""
+
+    def __init__(self, sock):
+        """Init."""
+        self.socket = sock
+        self.socket.setblocking(False)
+        self.output = RelayBuffer()
+        self.closed = False
+
+    def wait(self):
+        """Return a message, None if nothing to read or closed."""
+        try:
+            data = self.socket.recv(65536)
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.closed = True
+            return None
+        if not data:
+            self.closed = True
+        return data or None
+
+    def pending(self):
+        """Return whether a message is buffered, never."""
+        return False
+
+    def pending_output(self):
+        """Return whether data is waiting for the socket."""
+        return bool(self.output)
+
+    def flush(self):
+        """Send what the socket accepts, True when done."""
+        try:
+            while self.output:
+                self.output.send_to(self.socket)
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        return not self.output
+
+    def send(self, message):
+        """Queue a message."""
+        self.output.append(message)
+        self.flush()
+
+
+class LargeMessageWebSocket(FakeWebSocket):
+    """Turn every read in a message of 8 MiB, as browsers may send."""
+
+    size = 8 * 1024 * 1024
+
+    def wait(self):
+        """Return a large message made of the first byte read."""
+        data = super(LargeMessageWebSocket, self).wait()
+        if data is None:
+            return None
+        return data[:1] * self.size
+
+
+class RecordingWebSocket(object):
+    """Websocket keeping the messages sent."""
+
+    def __init__(self):
+        """Init."""
+        self.messages = []
+
+    def pending_output(self):
+        """Return whether data is waiting, never."""
+        return False
+
+    def flush(self):
+        """Return True, nothing is ever waiting."""
+        return True
+
+    def send(self, message):
+        """Keep a message."""
+        self.messages.append(message)
+
+
+class SlowSocket(object):
+    """Socket accepting only a few bytes per send."""
+
+    def __init__(self, max_size):
+        """Init."""
+        self.max_size = max_size
+        self.data = b''
+
+    def send(self, data):
+        """Keep at most max_size bytes."""
+        data = memoryview(data)[:self.max_size].tobytes()
+        self.data += data
+        return len(data)
+
+
+class TestWsProxy(object):
+    """Test for the wsproxy relay."""
+
+    def create_session(self, server, websocket=FakeWebSocket):
+        """Return a proxy socket with its browser and target peers."""
+        ws_socket, browser = socket.socketpair()
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        session = ProxySocket(server, server._generate_id())
+        session.proxy_socket = connect_tunnel(listener.getsockname()[1])
+        target, address = listener.accept()
+        listener.close()
+        thread = threading.Thread(target=session._websocket_handler,
+                                  args=(websocket(ws_socket),))
+        thread.daemon = True
+        thread.start()
+        return session, thread, browser, target
+
+    def recv_exactly(self, sock, size):
+        """Read size bytes from a socket."""
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            assert chunk
+            data += chunk
+        return data
+
+    def test_relay(self):
+        """Test that sessions share the multiplexer and relay data."""
+        server = WsProxy(async_mode='threading')
+        sessions = [self.create_session(server) for i in range(3)]
+
+        for i, (session, thread, browser, target) in enumerate(sessions):
+            message = b'browser {0}'.format(i)
+            browser.sendall(message)
+            assert self.recv_exactly(target, len(message)) == message
+
+            message = b'target {0}'.format(i) * 10000
+            target.sendall(message)
+            assert self.recv_exactly(browser, len(message)) == message
+
+        # Closing the target ends the session, the others are still alive
+        session, thread, browser, target = sessions[0]
+        target.close()
+        thread.join(5)
+        assert not thread.is_alive()
+        assert session.closed
+
+        session, thread, browser, target = sessions[1]
+        browser.sendall(b'still there')
+        assert self.recv_exactly(target, 11) == b'still there'
+
+        # Closing the browser ends the session too
+        browser.close()
+        thread.join(5)
+        assert not thread.is_alive()
+        assert session not in server.multiplexer.sessions
+
+    def test_relay_buffer(self):
+        """Test partial sends on the relay buffer."""
+        buf = RelayBuffer()
+        assert not buf
+        buf.append(b'0123456789')
+        buf.append(b'abc')
+        assert len(buf) == 13
+
+        sock = SlowSocket(4)
+        while buf:
+            buf.send_to(sock)
+        assert sock.data == b'0123456789abc'
+        assert len(buf) == 0
+
+        # Chunks are gathered in a buffer, the last one is split
+        buf.append(b'0123456789')
+        buf.append(b'abc')
+        view = memoryview(bytearray(12))
+        assert buf.pop_into(view) == 12
+        assert view.tobytes() == b'0123456789ab'
+        assert len(buf) == 1
+        assert buf.pop_into(view) == 1
+        assert view[:1].tobytes() == b'c'
+        assert not buf
+
+    def test_watermarks(self):
+        """Test that reads stop above the high watermark."""
+        server = WsProxy(async_mode='threading',
+                         client_watermarks=(100, 20),
+                         target_watermarks=(None, None))
+        session = ProxySocket(server, server._generate_id())
+        assert session.wanted_events() == (EVENT_READ, EVENT_READ)
+
+        session.cqueue.append(b'x' * 60)
+        assert session.wanted_events() == (EVENT_READ | EVENT_WRITE,
+                                           EVENT_READ)
+
+        # Above high watermark, stop reading from the target
+        session.cqueue.append(b'x' * 60)
+        assert session.cqueue.paused
+        assert session.wanted_events() == (EVENT_READ | EVENT_WRITE, 0)
+
+        # Still above low watermark
+        sock = SlowSocket(90)
+        session.cqueue.send_to(sock)
+        assert session.cqueue.paused
+
+        # Resume once drained
+        session.cqueue.send_to(sock)
+        assert not session.cqueue.paused
+        assert session.wanted_events() == (EVENT_READ, EVENT_READ)
+
+        stats = session.stats()
+        assert stats['client_buffer']['peak_size'] == 120
+        assert stats['client_buffer']['pause_count'] == 1
+        assert stats['target_buffer']['size'] == 0
+
+    def test_slow_browser(self):
+        """Test that a browser not reading only pauses its own target."""
+        server = WsProxy(async_mode='threading',
+                         client_watermarks=(262144, 65536))
+        slow, slow_thread, slow_browser, slow_target = \
+            self.create_session(server)
+        session, thread, browser, target = self.create_session(server)
+        for sock in (slow_browser, browser, target):
+            sock.settimeout(5)
+
+        data = os.urandom(8 * 1024 * 1024)
+        writer = threading.Thread(target=slow_target.sendall, args=(data,))
+        writer.daemon = True
+        writer.start()
+
+        # The data waits in cqueue, which stops the reads of the target
+        deadline = time.time() + 5
+        while not slow.cqueue.paused and time.time() < deadline:
+            time.sleep(0.01)
+        assert slow.cqueue.paused
+        assert len(slow.cqueue) < 262144 + ProxySocket.buffer_size
+        assert len(slow.ws.output) <= server.coalesce_size
+        assert writer.is_alive()
+
+        # Meanwhile the other sessions are relayed
+        for i in range(3):
+            browser.sendall(b'hello')
+            assert self.recv_exactly(target, 5) == b'hello'
+            target.sendall(b'world')
+            assert self.recv_exactly(browser, 5) == b'world'
+
+        # Everything arrives once the browser reads
+        assert self.recv_exactly(slow_browser, len(data)) == data
+        writer.join(5)
+        assert not writer.is_alive()
+        assert slow.cqueue.stats()['pause_count'] >= 1
+
+    def test_slow_target(self):
+        """Test that a target not reading only pauses its own session."""
+        server = WsProxy(async_mode='threading')
+        slow, slow_thread, slow_browser, slow_target = \
+            self.create_session(server, LargeMessageWebSocket)
+        session, thread, browser, target = self.create_session(server)
+        for sock in (slow_target, browser, target):
+            sock.settimeout(5)
+
+        # The message doesn't fit in the tunnel, it waits in tqueue
+        slow_browser.sendall(b'a')
+        deadline = time.time() + 5
+        while not slow.tqueue.paused and time.time() < deadline:
+            time.sleep(0.01)
+        assert slow.tqueue.paused
+
+        # Meanwhile the other sessions are relayed
+        for i in range(3):
+            browser.sendall(b'hello')
+            assert self.recv_exactly(target, 5) == b'hello'
+            target.sendall(b'world')
+            assert self.recv_exactly(browser, 5) == b'world'
+
+        # Everything arrives once the target reads
+        size = LargeMessageWebSocket.size
+        assert self.recv_exactly(slow_target, size) == b'a' * size
+
+    def test_coalesce(self):
+        """Test that small chunks are merged and held a little."""
+        server = WsProxy(async_mode='threading', coalesce_size=10,
+                         coalesce_delay=60)
+        session = ProxySocket(server, server._generate_id())
+        session.ws = RecordingWebSocket()
+        session.proxy_socket, target = socket.socketpair()
+
+        target.sendall(b'aaaa')
+        session._recv_from_proxy()
+        assert session.flush_at is not None
+        assert session.wanted_events() == (EVENT_READ, EVENT_READ)
+
+        # Sent once the frame is full or the delay is over
+        for data in (b'bbbb', b'cccc'):
+            target.sendall(data)
+            session._recv_from_proxy()
+        assert session.wanted_events()[0] & EVENT_WRITE
+        session._send_to_ws()
+        assert session.ws.messages == [b'aaaabbbbcc']
+        assert session.wanted_events()[0] & EVENT_WRITE
+        session._send_to_ws()
+        assert session.ws.messages == [b'aaaabbbbcc', b'cc']
+        assert session.flush_at is None
+
+        target.sendall(b'dd')
+        session._recv_from_proxy()
+        assert not session.wanted_events()[0] & EVENT_WRITE
+        session.flush_at -= 60
+        assert session.wanted_events()[0] & EVENT_WRITE
+
+        # The multiplexer waits for the delay
+        server = WsProxy(async_mode='threading', coalesce_delay=0.05)
+        session, thread, browser, target = self.create_session(server)
+        browser.settimeout(5)
+        target.sendall(b'a')
+        target.sendall(b'b')
+        assert self.recv_exactly(browser, 2) == b'ab'
+        assert session.counters['packets_to_client'] == 1
+        browser.close()
+        thread.join(5)
+        assert not thread.is_alive()
+
+    def test_metrics(self):
+        """Test the session counters and the proxy metrics."""
+        server = WsProxy(async_mode='threading')
+        session, thread, browser, target = self.create_session(server)
+        session.connected = True
+        server.sessions.add(session)
+
+        browser.sendall(b'hello')
+        assert self.recv_exactly(target, 5) == b'hello'
+        target.sendall(b'x' * 1000)
+        assert self.recv_exactly(browser, 1000) == b'x' * 1000
+
+        # Received data is counted before being relayed
+        stats = server.stats()
+        assert len(stats) == 1
+        assert stats[0]['counters']['bytes_from_client'] == 5
+        assert stats[0]['counters']['packets_from_client'] == 1
+        assert stats[0]['counters']['bytes_from_target'] == 1000
+
+        target.close()
+        thread.join(5)
+        metrics = server.collect_metrics()
+        assert metrics['sessions_active'] == 0
+        assert metrics['sessions_total'] == 1
+        assert metrics['sessions_closed'] == 1
+        assert metrics['counters']['bytes_to_target'] == 5
+        assert metrics['counters']['bytes_to_client'] == 1000
+
+        server.metrics.observe('handshake', 0.02)
+        text = exposition(server.collect_metrics())
+        assert 'wsproxy_bytes_from_target_total 1000' in text
+        assert 'wsproxy_handshake_seconds_bucket{le="0.01"} 0' in text
+        assert 'wsproxy_handshake_seconds_bucket{le="0.025"} 1' in text
+        assert 'wsproxy_handshake_seconds_count 1' in text
+
+    def test_failed_session(self):
+        """Test that sessions failing before the relay are not counted."""
+        server = WsProxy(async_mode='threading')
+        environ = {'HTTP_UPGRADE': 'websocket', 'PATH_INFO': '/websockify',
+                   'QUERY_STRING': 'token=token'}
+        with patch.object(server, 'validate_connection') as mock_validate, \
+                patch.object(ProxySocket, 'do_websocket_handshake') as \
+                mock_handshake, \
+                patch.object(ProxySocket, 'do_proxy') as mock_proxy:
+            mock_validate.return_value = True
+            mock_handshake.return_value = True
+            mock_proxy.side_effect = Exception('Unable to websocket')
+            with pytest.raises(Exception):
+                server.handle_request(environ, lambda *args: None)
+        metrics = server.collect_metrics()
+        assert metrics['sessions_total'] == 0
+        assert metrics['sessions_closed'] == 0
+        assert len(server.sessions) == 0
+
+    def test_sessions(self):
+        """Test the session registry, its limit and killing sessions."""
+        server = WsProxy(async_mode='threading', max_sessions=1)
+        environ = {'HTTP_UPGRADE': 'websocket', 'PATH_INFO': '/websockify',
+                   'QUERY_STRING': 'token=unknown'}
+        responses = []
+
+        def start_response(status, headers):
+            responses.append(status)
+
+        # Refused sessions are forgotten
+        server.handle_request(environ, start_response)
+        assert responses.pop() == '400 BAD REQUEST'
+        assert len(server.sessions) == 0
+
+        session, thread, browser, target = self.create_session(server)
+        server.sessions.add(session)
+        server.handle_request(environ, start_response)
+        assert responses.pop() == '503 SERVICE UNAVAILABLE'
+
+        browser.sendall(b'hello')
+        assert self.recv_exactly(target, 5) == b'hello'
+        stats = server.stats()
+        assert [s['state'] for s in stats] == [STATE_OPEN]
+        assert server.collect_metrics()['registry']['states'] == \
+            {'new': 0, 'open': 1, 'closing': 0}
+
+        # Killed sessions are ended by the multiplexer
+        assert not server.kill_session('unknown')
+        assert server.kill_session(session.sid)
+        thread.join(5)
+        assert not thread.is_alive()
+        assert session.state == STATE_CLOSED
+        assert session.sid not in server.sessions
+        assert target.recv(10) == b''
@@ -1,7 +1,11 @@
 """Basic class for our test."""
 import base64
+import fnmatch
 import json
+import time
+
 import pytest
+from redis.exceptions import WatchError
 
 from projety import db
 from projety.models import User
@@ -132,3 +136,240 @@ class TestAPI(object):
             except:
                 pass
         return body, rv.status_code, rv.headers
+
+
+class FakeRedis(object):
+    """
+    In memory stand-in for redis.StrictRedis.
+
+    Only the commands we use are implemented, values are stored as given.
+    """
+
+    def __init__(self):
+        """Init."""
+        self.data = {}
+        self.expires = {}
+        # Bumped on every write, for WATCH
+        self.versions = {}
+
+    def _touch(self, name):
+        self.versions[name] = self.versions.get(name, 0) + 1
+
+    def _check(self, name):
+        """Drop a key if its TTL is over."""
+        if name in self.expires and self.expires[name] <= time.time():
+            del self.expires[name]
+            self.data.pop(name, None)
+            self._touch(name)
+        return name in self.data
+
+    def pipeline(self, transaction=True):
+        """Return a pipeline, commands run on execute."""
+        return FakePipeline(self)
+
+    def transaction(self, func, *watches, **kwargs):
+        """Run func in a pipeline watching keys, retry on WatchError."""
+        value_from_callable = kwargs.pop('value_from_callable', False)
+        pipe = self.pipeline()
+        while True:
+            try:
+                pipe.watch(*watches)
+                value = func(pipe)
+                result = pipe.execute()
+                return value if value_from_callable else result
+            except WatchError:
+                continue
+            finally:
+                pipe.reset()
+
+    def exists(self, name):
+        """EXISTS."""
+        return self._check(name)
+
+    def get(self, name):
+        """GET."""
+        if not self._check(name):
+            return None
+        return self.data[name]
+
+    def mget(self, keys):
+        """MGET."""
+        return [self.get(key) for key in keys]
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        """SET."""
+        exists = self._check(name)
+        if (nx and exists) or (xx and not exists):
+            return None
+        self.data[name] = value
+        self.expires.pop(name, None)
+        self._touch(name)
+        if ex is not None:
+            self.expire(name, ex)
+        return True
+
+    def delete(self, *names):
+        """DEL."""
+        count = 0
+        for name in names:
+            if self._check(name):
+                del self.data[name]
+                self.expires.pop(name, None)
+                self._touch(name)
+                count += 1
+        return count
+
+    def expire(self, name, time_):
+        """EXPIRE."""
+        if not self._check(name):
+            return False
+        self.expires[name] = time.time() + time_
+        self._touch(name)
+        return True
+
+    def keys(self, pattern='*'):
+        """KEYS."""
+        return [key for key in list(self.data)
+                if self._check(key) and fnmatch.fnmatch(key, pattern)]
+
+    def lpush(self, name, *values):
+        """LPUSH."""
+        self._check(name)
+        items = self.data.setdefault(name, [])
+        items[:0] = reversed(values)
+        self._touch(name)
+        return len(items)
+
+    def ltrim(self, name, start, end):
+        """LTRIM."""
+        if self._check(name):
+            self.data[name] = self.lrange(name, start, end)
+            self._touch(name)
+        return True
+
+    def lrange(self, name, start, end):
+        """LRANGE."""
+        if not self._check(name):
+            return []
+        if end == -1:
+            return self.data[name][start:]
+        return self.data[name][start:end + 1]
+
+    def sadd(self, name, *values):
+        """SADD."""
+        self._check(name)
+        members = self.data.setdefault(name, set())
+        added = len(set(values) - members)
+        members.update(values)
+        self._touch(name)
+        return added
+
+    def smembers(self, name):
+        """SMEMBERS."""
+        if not self._check(name):
+            return set()
+        return set(self.data[name])
+
+    def srem(self, name, *values):
+        """SREM."""
+        if not self._check(name):
+            return 0
+        members = self.data[name]
+        removed = len(members.intersection(values))
+        members.difference_update(values)
+        self._touch(name)
+        return removed
+
+    def zadd(self, name, **kwargs):
+        """ZADD, only with member=score keyword arguments."""
+        self._check(name)
+        zset = self.data.setdefault(name, {})
+        added = len([member for member in kwargs if member not in zset])
+        zset.update(kwargs)
+        self._touch(name)
+        return added
+
+    def zrem(self, name, *values):
+        """ZREM."""
+        if not self._check(name):
+            return 0
+        zset = self.data[name]
+        self._touch(name)
+        return len([zset.pop(value) for value in values if value in zset])
+
+    def _sorted(self, name):
+        if not self._check(name):
+            return []
+        return sorted(self.data[name].items(), key=lambda i: (i[1], i[0]))
+
+    def zrange(self, name, start, end):
+        """ZRANGE."""
+        members = [member for member, score in self._sorted(name)]
+        if end == -1:
+            return members[start:]
+        return members[start:end + 1]
+
+    def zrangebyscore(self, name, min, max):
+        """ZRANGEBYSCORE, supports -inf/+inf and exclusive bounds."""
+        def bound(value):
+            value = str(value)
+            if value in ('-inf', '+inf', 'inf'):
+                return float(value), False
+            if value.startswith('('):
+                return float(value[1:]), True
+            return float(value), False
+        low, low_excl = bound(min)
+        high, high_excl = bound(max)
+        return [member for member, score in self._sorted(name)
+                if (score > low if low_excl else score >= low) and
+                (score < high if high_excl else score <= high)]
+
+
+class FakePipeline(object):
+    """
+    Pipeline of FakeRedis, commands are queued until execute.
+
+    After ``watch`` commands run immediately until ``multi``, and execute
+    raises WatchError if a watched key was written in between.
+    """
+
+    def __init__(self, redis):
+        """Init."""
+        self.redis = redis
+        self.reset()
+
+    def reset(self):
+        """Forget the queued commands and the watched keys."""
+        self.commands = []
+        self.watched = None
+        self.immediate = False
+
+    def watch(self, *names):
+        """WATCH, the next commands run immediately."""
+        self.watched = dict((name, self.redis.versions.get(name, 0))
+                            for name in names)
+        self.immediate = True
+
+    def multi(self):
+        """MULTI, the next commands are queued."""
+        self.immediate = False
+
+    def __getattr__(self, name):
+        """Queue any command."""
+        method = getattr(self.redis, name)
+        if self.immediate:
+            return method
+
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        """Run all the queued commands."""
+        commands, watched = self.commands, self.watched
+        self.reset()
+        if watched and any(self.redis.versions.get(name, 0) != version
+                           for name, version in watched.items()):
+            raise WatchError('Watched variable changed.')
+        return [method(*args, **kwargs) for method, args, kwargs in commands]